@@ -0,0 +1,366 @@
+"""Daily per-user engagement stats, computed in bulk with NumPy.
+
+`flask analytics --day 2019-03-01` writes one `user_daily_stats` row per
+user who was active or is followed: messages posted that day with their
+histogram by hour, likes given and received, followers, and follower
+growth since the previous day's row. Likes and follows carry no
+timestamps, so their figures are totals as of the run, and growth is only
+as good as the previous day's run.
+
+Rows are never loaded as ORM objects. Each query streams plain id columns
+in chunks of `CHUNK_SIZE` rows, each chunk becomes NumPy arrays, and the
+counting is `np.bincount` over user ids. With `--csv-dir` the same stats
+come from CSV exports in the `generator/` format (`messages.csv`,
+`follows.csv` and, if present, `likes.csv` with `user_id,message_id`
+columns, message ids being line numbers in `messages.csv`), each file
+split into byte ranges that are parsed by a pool of processes.
+"""
+
+import csv
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from itertools import islice
+
+import click
+import numpy as np
+from flask.cli import with_appcontext
+
+from models import (db, Message, Likes, Follows, ArchivedMessage, ArchivedLike,
+                    UserDailyStats)
+from sharding import shards
+
+CHUNK_SIZE = 50000
+
+HOURS = 24
+
+COUNTS = ('messages', 'likes_given', 'likes_received', 'followers')
+
+
+def combine(a, b):
+    """`a + b` along the first axis, padding the shorter one with zeros."""
+
+    if len(a) < len(b):
+        a, b = b, a
+    total = a.copy()
+    total[:len(b)] += b
+    return total
+
+
+class DailyStats:
+    """Per-user counts, as arrays indexed by user id."""
+
+    def __init__(self):
+        self.counts = {name: np.zeros(0, dtype=np.int64) for name in COUNTS}
+        self.hourly = np.zeros((0, HOURS), dtype=np.int64)
+
+    def add(self, name, user_ids, weights=None):
+        if len(user_ids):
+            counts = np.bincount(user_ids, weights=weights).astype(np.int64)
+            self.counts[name] = combine(self.counts[name], counts)
+
+    def add_messages(self, user_ids, hours):
+        if len(user_ids):
+            self.add('messages', user_ids)
+            cells = np.bincount(user_ids * HOURS + hours)
+            cells = np.pad(cells, (0, -len(cells) % HOURS), 'constant')
+            self.hourly = combine(self.hourly, cells.reshape(-1, HOURS))
+
+    def merge(self, other):
+        for name in COUNTS:
+            self.counts[name] = combine(self.counts[name], other.counts[name])
+        self.hourly = combine(self.hourly, other.hourly)
+
+    def column(self, name, size):
+        """Counts `name` for user ids 0 to `size - 1`."""
+
+        if name == 'hourly':
+            return combine(np.zeros((size, HOURS), dtype=np.int64), self.hourly)
+        return combine(np.zeros(size, dtype=np.int64), self.counts[name])
+
+    @property
+    def size(self):
+        return max(len(self.hourly), *(len(a) for a in self.counts.values()))
+
+
+def stream_columns(engine, query, chunk_size=CHUNK_SIZE):
+    """Yield `query`'s integer columns as a tuple of arrays per chunk of rows."""
+
+    result = engine.execution_options(stream_results=True).execute(query)
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield tuple(np.array(column, dtype=np.int64) for column in zip(*rows))
+    finally:
+        result.close()
+
+
+def day_messages(table, day):
+    start = datetime.combine(day, datetime.min.time())
+    return (db.select([table.c.user_id,
+                       db.extract('hour', table.c.timestamp)])
+            .where(table.c.timestamp >= start)
+            .where(table.c.timestamp < start + timedelta(days=1)))
+
+
+def database_stats(day, chunk_size=CHUNK_SIZE):
+    """`DailyStats` for `day`, from the database (or the shards)."""
+
+    stats = DailyStats()
+    messages, likes = Message.__table__, Likes.__table__
+
+    if shards.enabled:
+        engines = [shards.engine(name) for name in shards.names]
+    else:
+        engines = [db.engine]
+
+    def stream(query):
+        for engine in engines:
+            yield from stream_columns(engine, query, chunk_size)
+
+    for user_ids, hours in stream(day_messages(messages, day)):
+        stats.add_messages(user_ids, hours)
+
+    for user_ids, in stream(db.select([likes.c.user_id])):
+        stats.add('likes_given', user_ids)
+
+    for user_ids, in stream(db.select([Follows.user_being_followed_id])):
+        stats.add('followers', user_ids)
+
+    if shards.enabled:
+        # A like lives on the liker's shard and the message on its
+        # author's, so count likes per message first, then find authors.
+        liked = [ids for ids, in stream(db.select([likes.c.message_id]))]
+        liked, times = np.unique(np.concatenate(liked or [[]]).astype(np.int64),
+                                 return_counts=True)
+        for ids, authors in stream(db.select([messages.c.id, messages.c.user_id])):
+            found = np.isin(ids, liked)
+            stats.add('likes_received', authors[found],
+                      weights=times[np.searchsorted(liked, ids[found])])
+        return stats
+
+    received = (db.select([messages.c.user_id])
+                .select_from(likes.join(messages, likes.c.message_id == messages.c.id)))
+    for user_ids, in stream(received):
+        stats.add('likes_received', user_ids)
+
+    # The cold tier (see archive.py) only exists in the main database.
+    archived, archived_likes = ArchivedMessage.__table__, ArchivedLike.__table__
+
+    for user_ids, hours in stream(day_messages(archived, day)):
+        stats.add_messages(user_ids, hours)
+
+    for user_ids, in stream(db.select([archived_likes.c.user_id])):
+        stats.add('likes_given', user_ids)
+
+    received = (db.select([archived.c.user_id])
+                .select_from(archived_likes.join(
+                    archived, archived_likes.c.message_id == archived.c.id)))
+    for user_ids, in stream(received):
+        stats.add('likes_received', user_ids)
+
+    return stats
+
+
+def byte_ranges(path, parts):
+    """Split the rows of a CSV file into about `parts` (start, end) byte ranges.
+
+    Ranges start at the beginning of a line, so this assumes no quoted
+    field contains a newline (true of the `generator/` CSVs).
+    """
+
+    size = os.path.getsize(path)
+
+    with open(path, 'rb') as file:
+        file.readline()
+        bounds = [file.tell()]
+        for part in range(1, parts):
+            file.seek(max(bounds[0] + (size - bounds[0]) * part // parts, bounds[-1]))
+            file.readline()
+            bounds.append(file.tell())
+
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def read_rows(path, start, end, chunk_size):
+    """Yield lists of up to `chunk_size` rows of `path` from byte `start` to `end`.
+
+    Also yields the header (a dict of column name to index) first.
+    """
+
+    with open(path, 'rb') as file:
+        yield {name: i for i, name in enumerate(next(csv.reader([file.readline().decode()])))}
+
+        def lines():
+            position = file.seek(start)
+            while position < end:
+                line = file.readline()
+                if not line:
+                    return
+                position += len(line)
+                yield line.decode()
+
+        rows = csv.reader(lines())
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+
+def column(rows, index):
+    return np.array([row[index] for row in rows])
+
+
+def scan_messages(path, start, end, day, chunk_size=CHUNK_SIZE):
+    """Authors of the messages in a byte range of messages.csv, and their stats."""
+
+    stats = DailyStats()
+    authors = []
+    chunks = read_rows(path, start, end, chunk_size)
+    header = next(chunks)
+
+    for rows in chunks:
+        user_ids = column(rows, header['user_id']).astype(np.int64)
+        timestamps = column(rows, header['timestamp']).astype('datetime64[us]')
+        days = timestamps.astype('datetime64[D]')
+        on_day = days == np.datetime64(day, 'D')
+        hours = (timestamps[on_day] - days[on_day]).astype('timedelta64[h]')
+        stats.add_messages(user_ids[on_day], hours.astype(np.int64))
+        authors.append(user_ids)
+
+    return np.concatenate(authors or [[]]).astype(np.int64), stats
+
+
+def scan_follows(path, start, end, chunk_size=CHUNK_SIZE):
+    stats = DailyStats()
+    chunks = read_rows(path, start, end, chunk_size)
+    header = next(chunks)
+
+    for rows in chunks:
+        stats.add('followers',
+                  column(rows, header['user_being_followed_id']).astype(np.int64))
+
+    return stats
+
+
+def scan_likes(path, start, end, chunk_size=CHUNK_SIZE):
+    """Stats of a byte range of likes.csv, and its like count per message id."""
+
+    stats = DailyStats()
+    per_message = np.zeros(0, dtype=np.int64)
+    chunks = read_rows(path, start, end, chunk_size)
+    header = next(chunks)
+
+    for rows in chunks:
+        stats.add('likes_given', column(rows, header['user_id']).astype(np.int64))
+        message_ids = column(rows, header['message_id']).astype(np.int64)
+        per_message = combine(per_message, np.bincount(message_ids))
+
+    return per_message, stats
+
+
+def csv_stats(directory, day, workers=None, chunk_size=CHUNK_SIZE):
+    """`DailyStats` for `day`, from CSV exports in `directory`."""
+
+    workers = workers or os.cpu_count()
+    stats = DailyStats()
+
+    with ProcessPoolExecutor(workers) as pool:
+        def scan(filename, function, *args):
+            path = os.path.join(directory, filename)
+            if not os.path.exists(path):
+                return []
+            return [pool.submit(function, path, start, end, *args, chunk_size)
+                    for start, end in byte_ranges(path, workers)]
+
+        messages = scan('messages.csv', scan_messages, day)
+        follows = scan('follows.csv', scan_follows)
+        likes = scan('likes.csv', scan_likes)
+
+        authors = []
+        for future in messages:
+            part_authors, part = future.result()
+            authors.append(part_authors)
+            stats.merge(part)
+        for future in follows:
+            stats.merge(future.result())
+        per_message = np.zeros(0, dtype=np.int64)
+        for future in likes:
+            part_per_message, part = future.result()
+            per_message = combine(per_message, part_per_message)
+            stats.merge(part)
+
+    # Message ids are line numbers, so `authors[id - 1]` wrote message `id`.
+    authors = np.concatenate(authors or [[]]).astype(np.int64)
+    liked = per_message[1:len(authors) + 1]
+    stats.add('likes_received', authors[:len(liked)], weights=liked)
+
+    return stats
+
+
+def save(day, stats, batch_size=1000):
+    """Replace `day`'s rows in `user_daily_stats` with `stats`; return the row count."""
+
+    previous = np.array(db.session
+                        .query(UserDailyStats.user_id, UserDailyStats.followers)
+                        .filter(UserDailyStats.day == day - timedelta(days=1))
+                        .all(), dtype=np.int64).reshape(-1, 2)
+
+    size = max(stats.size, previous[:, 0].max() + 1 if len(previous) else 0)
+    counts = {name: stats.column(name, size) for name in COUNTS}
+    hourly = stats.column('hourly', size).astype('<u4')
+
+    followed_before = np.zeros(size, dtype=np.int64)
+    followed_before[previous[:, 0]] = previous[:, 1]
+    growth = counts['followers'] - followed_before
+
+    active = np.zeros(size, dtype=bool)
+    for values in counts.values():
+        active |= values > 0
+    active |= followed_before > 0
+    user_ids = np.flatnonzero(active)
+
+    table = UserDailyStats.__table__
+    db.session.execute(table.delete().where(table.c.day == day))
+
+    for batch in range(0, len(user_ids), batch_size):
+        ids = user_ids[batch:batch + batch_size]
+        db.session.execute(table.insert(), [
+            dict({name: int(counts[name][id]) for name in COUNTS},
+                 day=day, user_id=int(id), follower_growth=int(growth[id]),
+                 hourly=hourly[id].tobytes())
+            for id in ids
+        ])
+
+    db.session.commit()
+    return len(user_ids)
+
+
+@click.command('analytics')
+@click.option('--day', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help="Day to summarize (default: yesterday, UTC).")
+@click.option('--csv-dir', type=click.Path(exists=True, file_okay=False), default=None,
+              help="Read messages.csv, follows.csv and likes.csv from here "
+                   "instead of the database.")
+@click.option('--workers', type=int, default=None,
+              help="Processes parsing CSVs (default: one per core).")
+@with_appcontext
+def analytics_command(day, csv_dir, workers):
+    """Summarize a day's activity per user into user_daily_stats."""
+
+    day = day.date() if day else datetime.utcnow().date() - timedelta(days=1)
+
+    started = time.perf_counter()
+    if csv_dir:
+        stats = csv_stats(csv_dir, day, workers)
+    else:
+        stats = database_stats(day)
+    rows = save(day, stats)
+
+    click.echo(f"Summarized {rows} users for {day} "
+               f"in {time.perf_counter() - started:.1f}s.")
@@ -1,28 +1,197 @@
 import os
+from collections import Counter
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (Flask, Response, render_template, request, flash, redirect,
+                   session, g, abort, jsonify, stream_with_context)
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
-
+from werkzeug.wsgi import ClosingIterator
+
+from analytics import analytics_command
+from archive import (archive_command, get_message, recent_messages, tiered_page,
+                     timeline)
+from authors import author_fields, backfill_authors_command, queue_update
+from availability import availability
+from bus import bus, bus_status_command
+from compression import compressor
+from degrade import Degrader
+from export import FORMATS as EXPORT_FORMATS, export_command, export_user
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Follows, Likes
+from importer import import_command, import_lines, open_stream
+from jobs import jobs, run_workers_command
+from live import broker, followed_ids, new_message_ids, timeline_events
+from limits import Limiter
+from models import (db, connect_db, User, Message, Follows, Likes, ArchivedMessage,
+                    ArchivedLike)
+from pagecache import PageCache
+from pagination import keyset_page, next_page_url, stream_template
+from parallel import queries
+from profiling import (ProfilerMiddleware, profile_report_command,
+                       profile_token_command)
+from search import search_index_command, search_messages
+from sharding import ShardMoving, shards, shards_command
+from singleflight import flights, snapshot
+from slowlog import slow_query_log, slow_queries_command
+from stats import stats_log
+from tags import (COLD, backfill_command, linkify_tags, mentioning_messages,
+                  tagged_messages)
+from templating import compile_templates, init_bytecode_cache, precompile_command
+from versions import versions
+from warmup import primer, warm_up_command
 
 CURR_USER_KEY = "curr_user"
 
 app = Flask(__name__)
 
 # Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
+# if not set there, use development local db. A sqlite:/// URL (e.g.
+# sqlite:///warbler.db) runs Warbler on an embedded SQLite file instead.
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgres:///warbler'))
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
+app.config['USERS_PER_PAGE'] = 48
+app.config['MESSAGES_PER_PAGE'] = 50
+app.config['MESSAGES_HOT_DAYS'] = int(os.environ.get('MESSAGES_HOT_DAYS', 365))
+app.config['LIVE_MAX_STREAMS'] = int(os.environ.get('LIVE_MAX_STREAMS', 100))
+app.config['LIVE_HEARTBEAT'] = 15
+
+# Messages, likes and follows can be split across databases by user id;
+# SHARD_URLS is a comma-separated list of their URLs. See sharding.py.
+SHARD_URLS = [url for url in os.environ.get('SHARD_URLS', '').split(',') if url]
+app.config['SQLALCHEMY_BINDS'] = {f'shard{i}': url for i, url in enumerate(SHARD_URLS)}
+app.config['SHARDS'] = list(app.config['SQLALCHEMY_BINDS'])
+
+# Statements slower than this are logged, with their query plan, to a
+# rotating file; see `flask slow-queries`. Set to 0 to turn off.
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 200))
+app.config['SLOW_QUERY_LOG'] = os.environ.get('SLOW_QUERY_LOG', 'slow_queries.log')
+
+# Requests with a token from `flask profile-token` are profiled into
+# PROFILE_DIR; PROFILE_SAMPLE_RATE of all requests are sampled for
+# `flask profile-report`.
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', 'profiles')
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+
+# Compiled templates are cached on disk, so new workers skip compiling
+# them; `flask precompile-templates` fills the cache at build time, and
+# PRECOMPILE_TEMPLATES=1 does it when the app boots.
+app.config['JINJA_CACHE_DIR'] = os.environ.get(
+    'JINJA_CACHE_DIR', os.path.join(app.root_path, '.jinja_cache'))
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Rate limits are (requests, per seconds), applied per client IP and, when
+# logged in, per user. Concurrency caps bound how many bcrypt-heavy
+# requests run at once in this worker.
+app.config['RATELIMIT_ENABLED'] = (
+    os.environ.get('RATELIMIT_ENABLED', '1') == '1')
+app.config['RATELIMIT_RULES'] = {
+    'login': (10, 60),
+    'signup': (5, 60),
+    'profile': (10, 60),
+    'search': (30, 60),
+    'messages_add': (30, 60),
+    'export': (5, 3600),
+    'import': (5, 3600),
+    'availability': (60, 60),
+}
+app.config['RATELIMIT_CONCURRENCY'] = {
+    'bcrypt': int(os.environ.get('BCRYPT_CONCURRENCY', 4)),
+}
+
+# Compress text responses; registered first so it runs after every other
+# after_request hook (including the debug toolbar's).
+app.config['COMPRESS_ENABLED'] = os.environ.get('COMPRESS_ENABLED', '1') == '1'
+app.config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', 6))
+compressor.init_app(app)
+
 toolbar = DebugToolbarExtension(app)
 
+# Logged-out visitors get public pages from an in-memory cache, checked
+# before any hook that touches the database (so register it first).
+app.config['PAGE_CACHE_ENABLED'] = os.environ.get('PAGE_CACHE_ENABLED', '1') == '1'
+app.config['PAGE_CACHE_TTL'] = int(os.environ.get('PAGE_CACHE_TTL', 60))
+page_cache = PageCache(identity=lambda: session.get(CURR_USER_KEY))
+page_cache.init_app(app)
+
 connect_db(app)
+shards.init_app(app)
+
+# Version bumps (see versions.py) are shared with the other worker
+# processes through the database, with LISTEN/NOTIFY on Postgres; each
+# process applies the others' within BUS_POLL_INTERVAL seconds.
+app.config['BUS_ENABLED'] = os.environ.get('BUS_ENABLED', '1') == '1'
+app.config['BUS_POLL_INTERVAL'] = float(os.environ.get('BUS_POLL_INTERVAL', 1))
+bus.init_app(app)
+
+limiter = Limiter(identity=lambda: session.get(CURR_USER_KEY))
+limiter.init_app(app)
+
+# While the database's average statement time is over DEGRADE_LATENCY_MS,
+# the timeline and profiles are served from their last good render.
+app.config['DEGRADE_ENABLED'] = os.environ.get('DEGRADE_ENABLED', '1') == '1'
+app.config['DEGRADE_LATENCY_MS'] = float(os.environ.get('DEGRADE_LATENCY_MS', 100))
+degrader = Degrader(identity=lambda: session.get(CURR_USER_KEY))
+degrader.init_app(app)
+
+# Work a request needn't wait for is queued in the `jobs` table and run
+# by `flask run-workers`; see jobs.py.
+app.config['JOBS_WORKERS'] = int(os.environ.get('JOBS_WORKERS', os.cpu_count() or 1))
+jobs.init_app(app)
+
+# Messages carry a copy of their author's username and avatar; after a
+# profile change a job updates them, AUTHOR_SNAPSHOT_DELAY seconds later.
+app.config['AUTHOR_SNAPSHOT_DELAY'] = int(os.environ.get('AUTHOR_SNAPSHOT_DELAY', 10))
+
+# Composite pages run their independent queries at the same time, on
+# up to PARALLEL_QUERY_THREADS extra connections; see parallel.py.
+app.config['PARALLEL_QUERIES'] = os.environ.get('PARALLEL_QUERIES', '1') == '1'
+app.config['PARALLEL_QUERY_THREADS'] = int(os.environ.get('PARALLEL_QUERY_THREADS', 16))
+queries.init_app(app)
+
+# Warm-up (see warmup.py) renders the profiles of this many of the
+# most-followed users, so their first visitors hit the page cache.
+app.config['WARMUP_HOT_PROFILES'] = int(os.environ.get('WARMUP_HOT_PROFILES', 20))
+
+flights.init_app(app)
+slow_query_log.init_app(app)
+
+# Each worker logs its counters every STATS_INTERVAL seconds (0 turns
+# this off); see stats.py.
+app.config['STATS_INTERVAL'] = float(os.environ.get('STATS_INTERVAL', 60))
+stats_log.add('degrade', degrader.stats)
+stats_log.add('ratelimit_rejected', limiter.rejected)
+stats_log.add('compression', compressor.stats)
+stats_log.add('singleflight', flights.stats)
+stats_log.init_app(app)
+
+app.wsgi_app = ProfilerMiddleware(app)
+init_bytecode_cache(app)
+
+app.cli.add_command(export_command)
+app.cli.add_command(import_command)
+app.cli.add_command(slow_queries_command)
+app.cli.add_command(profile_token_command)
+app.cli.add_command(profile_report_command)
+app.cli.add_command(precompile_command)
+app.cli.add_command(backfill_command)
+app.cli.add_command(search_index_command)
+app.cli.add_command(archive_command)
+app.cli.add_command(warm_up_command)
+app.cli.add_command(shards_command)
+app.cli.add_command(analytics_command)
+app.cli.add_command(run_workers_command)
+app.cli.add_command(bus_status_command)
+app.cli.add_command(backfill_authors_command)
+
+app.add_template_filter(linkify_tags)
+
+if os.environ.get('PRECOMPILE_TEMPLATES') == '1':
+    timings = compile_templates(app)
+    app.logger.info("Compiled %d templates in %.1f ms",
+                    len(timings), sum(timings.values()))
 
 
 ##############################################################################
@@ -54,6 +223,8 @@ def do_logout():
 
 
 @app.route('/signup', methods=["GET", "POST"])
+@limiter.limit('signup', methods=["POST"])
+@limiter.concurrency('bcrypt', methods=["POST"])
 def signup():
     """Handle user signup.
 
@@ -68,6 +239,15 @@ def signup():
     form = UserAddForm()
 
     if form.validate_on_submit():
+        # Turn away duplicates before paying for the password hash.
+        taken = availability.taken(form.username.data, form.email.data)
+        if taken['username']:
+            flash("Username already taken", 'danger')
+            return render_template('users/signup.html', form=form)
+        if taken['email']:
+            flash("Email already registered", 'danger')
+            return render_template('users/signup.html', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
@@ -75,12 +255,15 @@ def signup():
                 email=form.email.data,
                 image_url=form.image_url.data or User.image_url.default.arg,
             )
+            db.session.flush()
+            shards.place(user.id)
             db.session.commit()
 
         except IntegrityError:
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        availability.add(user.username, user.email)
         do_login(user)
 
         print(user)
@@ -90,7 +273,20 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
+@app.route('/api/users/available')
+@limiter.limit('availability')
+def users_available():
+    """Are the 'username' and/or 'email' params free to sign up with?"""
+
+    taken = availability.taken(request.args.get('username'),
+                               request.args.get('email'))
+
+    return jsonify({field: not is_taken for field, is_taken in taken.items()})
+
+
 @app.route('/login', methods=["GET", "POST"])
+@limiter.limit('login', methods=["POST"])
+@limiter.concurrency('bcrypt', methods=["POST"])
 def login():
     """Handle user login."""
 
@@ -123,41 +319,121 @@ def logout():
 # General user routes:
 
 @app.route('/users')
+@limiter.limit('search', when=lambda: request.args.get('q'))
 def list_users():
     """Page with listing of users.
 
     Can take a 'q' param in querystring to search by that username.
+    Paged by user id; pass the 'after' param to get the next page.
     """
 
     search = request.args.get('q')
+    after = request.args.get('after', type=int)
 
-    if not search:
-        if not g.user:
-            users = User.query.all()
-        else:
-            # likes = [l.message_id for l in Likes.query.filter_by(user_id = g.user.id).all()]
-            users = User.query.filter(User.id != g.user.id).all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    query = User.query
+    if search:
+        query = query.filter(User.username.like(f"%{search}%"))
+    elif g.user:
+        query = query.filter(User.id != g.user.id)
 
-    return render_template('users/index.html', users=users)
+    users, cursor = keyset_page(query, User.id, after,
+                                app.config['USERS_PER_PAGE'])
 
+    return stream_template('users/index.html',
+                           users=users,
+                           following_ids=following_ids_among(users),
+                           next_url=next_page_url(cursor))
 
-@app.route('/users/<int:user_id>')
-def show_users(user_id):
-    """Show user profile."""
+
+def following_ids_among(users):
+    """Ids of those `users` that the current user follows."""
+
+    if not g.user or not users:
+        return set()
+
+    return {f.user_being_followed_id for f in (shards
+            .reader(g.user.id)
+            .query(Follows)
+            .filter(Follows.user_following_id == g.user.id,
+                    Follows.user_being_followed_id.in_([u.id for u in users])))}
+
+
+USER_FIELDS = ('id', 'username', 'image_url', 'header_image_url', 'bio', 'location')
+MESSAGE_FIELDS = ('id', 'text', 'timestamp')
+
+
+def load_profile(user_id):
+    """Data for a profile page, as snapshots that requests can share."""
 
     user = User.query.get_or_404(user_id)
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
+    parts = queries.gather(messages=lambda: recent_messages([user_id]),
+                           counts=lambda: shards.counts(user_id))
+
+    return {
+        'user': snapshot(user, USER_FIELDS),
+        'counts': parts['counts'],
+        'messages': [snapshot(msg, MESSAGE_FIELDS) for msg in parts['messages']],
+    }
+
+
+def is_following(viewer_id, user_id):
+    """Does user `viewer_id` follow user `user_id`?"""
+
+    session = shards.reader(viewer_id)
+    return session.query(session.query(Follows).filter_by(
+        user_following_id=viewer_id,
+        user_being_followed_id=user_id).exists()).scalar()
+
+
+@app.route('/users/<int:user_id>')
+@page_cache.cached
+@degrader.stale_on_slow_db
+def show_users(user_id):
+    """Show user profile."""
+
+    page_cache.depends(f'user:{user_id}')
+    viewer_id = g.user.id if g.user else None
+
+    parts = queries.gather(
+        profile=lambda: flights.run(('show_users', user_id),
+                                    lambda: load_profile(user_id),
+                                    stamp=versions.stamp(f'user:{user_id}')),
+        following=lambda: (viewer_id not in (None, user_id)
+                           and is_following(viewer_id, user_id)),
+    )
+    return render_template('users/show.html', following=parts['following'],
+                           **parts['profile'])
+
+
+def most_followed(n):
+    """Ids of the `n` users with the most followers."""
+
+    def top(name, session):
+        return (session
+                .query(Follows.user_being_followed_id, db.func.count())
+                .group_by(Follows.user_being_followed_id)
                 .all())
-    return render_template('users/show.html', user=user, messages=messages)
+
+    followers = Counter()
+    for rows in (shards.scatter(top) if shards.enabled else [top(None, db.session)]):
+        followers.update(dict(rows))
+    return [id for id, count in followers.most_common(n)]
+
+
+@primer('hot_profiles')
+def prime_hot_profiles(app):
+    """Render the most-followed users' profiles, as an anonymous visitor.
+
+    Fills the page cache and the last-good renders of those pages, and
+    with them their counters, before the first visitors ask.
+    """
+
+    client = app.test_client()
+    for user_id in most_followed(app.config['WARMUP_HOT_PROFILES']):
+        client.get(f'/users/{user_id}').close()
 
 
 @app.route('/users/<int:user_id>/following')
@@ -169,7 +445,23 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    if shards.enabled:
+        query = User.query.filter(User.id.in_(shards.following_ids(user_id)))
+    else:
+        query = (User
+                 .query
+                 .join(Follows, Follows.user_being_followed_id == User.id)
+                 .filter(Follows.user_following_id == user_id))
+    following, cursor = keyset_page(query, User.id,
+                                    request.args.get('after', type=int),
+                                    app.config['USERS_PER_PAGE'])
+
+    return stream_template('users/following.html',
+                           user=user,
+                           counts=shards.counts(user.id),
+                           following=following,
+                           following_ids=following_ids_among(following),
+                           next_url=next_page_url(cursor))
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -181,7 +473,31 @@ def show_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    after = request.args.get('after', type=int)
+    per_page = app.config['USERS_PER_PAGE']
+
+    if shards.enabled:
+        # Followers are on every shard; page through them by id on each.
+        ids = shards.follower_ids(user_id, after, per_page + 1)
+        followers = (User
+                     .query
+                     .filter(User.id.in_(ids[:per_page]))
+                     .order_by(User.id)
+                     .all())
+        cursor = ids[per_page - 1] if len(ids) > per_page else None
+    else:
+        query = (User
+                 .query
+                 .join(Follows, Follows.user_following_id == User.id)
+                 .filter(Follows.user_being_followed_id == user_id))
+        followers, cursor = keyset_page(query, User.id, after, per_page)
+
+    return stream_template('users/followers.html',
+                           user=user,
+                           counts=shards.counts(user.id),
+                           followers=followers,
+                           following_ids=following_ids_among(followers),
+                           next_url=next_page_url(cursor))
 
 
 @app.route('/users/<int:user_id>/likes')
@@ -193,9 +509,21 @@ def show_likes(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    likes = [l.message_id for l in Likes.query.filter_by(user_id=g.user.id).all()]
-    messages = Message.query.filter(Message.id.in_(likes)).all()
-    return render_template('users/likes.html', user=user, messages=messages)
+    likes = [l.message_id for l in (shards
+             .reader(g.user.id)
+             .query(Likes)
+             .filter_by(user_id=g.user.id)
+             .all())]
+    if shards.enabled:
+        messages = shards.find_messages(likes)
+    else:
+        archived = (db.session
+                    .query(ArchivedLike.message_id)
+                    .filter(ArchivedLike.user_id == g.user.id))
+        messages = (Message.query.filter(Message.id.in_(likes)).all()
+                    + ArchivedMessage.query.filter(ArchivedMessage.id.in_(archived)).all())
+    return render_template('users/likes.html', user=user, messages=messages,
+                           counts=shards.counts(user.id))
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -207,8 +535,10 @@ def add_follow(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    session = shards.writer(g.user.id)
+    session.add(Follows(user_following_id=g.user.id,
+                        user_being_followed_id=followed_user.id))
+    session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -221,9 +551,15 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    session = shards.writer(g.user.id)
+    follow = (session
+              .query(Follows)
+              .filter_by(user_following_id=g.user.id,
+                         user_being_followed_id=follow_id)
+              .first())
+    if follow is not None:
+        session.delete(follow)
+        session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -235,9 +571,16 @@ def like_message(msg_id):
         flash("Unauthorized, can not add like.", "danger")
         return redirect("/")
 
-    new_like = Likes(user_id=g.user.id, message_id=msg_id)
-    db.session.add(new_like)
-    db.session.commit()
+    msg = get_message(msg_id)
+    if msg is None:
+        abort(404)
+
+    session = shards.writer(g.user.id)
+    if isinstance(msg, ArchivedMessage):
+        session.merge(ArchivedLike(user_id=g.user.id, message_id=msg_id))
+    else:
+        session.add(Likes(user_id=g.user.id, message_id=msg_id))
+    session.commit()
 
     return redirect('/')
 
@@ -248,13 +591,20 @@ def unlike_message(msg_id):
         flash("Unauthorized, can not delete like.", "danger")
         return redirect("/")
 
-    like = Likes.query.filter_by(user_id=g.user.id, message_id=msg_id).all()
-    db.session.delete(like[0])
-    db.session.commit()
+    session = shards.writer(g.user.id)
+    like = session.query(Likes).filter_by(user_id=g.user.id, message_id=msg_id).first()
+    if like is None and not shards.enabled:
+        like = ArchivedLike.query.get((g.user.id, msg_id))
+    if like is None:
+        abort(404)
+    session.delete(like)
+    session.commit()
     return redirect('/')
 
 
 @app.route('/users/profile', methods=["GET", "POST"])
+@limiter.limit('profile', methods=["POST"])
+@limiter.concurrency('bcrypt', methods=["POST"])
 def profile():
     """Update profile for current user."""
 
@@ -270,12 +620,20 @@ def profile():
 
         valid_user = User.authenticate(user.username, password)
         if valid_user:
+            author = author_fields(user)
+            if form.username.data != user.username:
+                jobs.enqueue('reindex_mentions',
+                             {'old': user.username, 'new': form.username.data},
+                             key=f'{user.username}:{form.username.data}')
             user.username = form.username.data
             user.email = form.email.data   
             user.image_url = form.image_url.data
             user.header_image_url = form.header_image_url.data  
             user.bio = form.bio.data
+            if author_fields(user) != author:
+                queue_update(user)
             db.session.commit()
+            availability.add(user.username, user.email)
             return redirect(f'/users/{g.user.id}')
         else:
             flash('Invalid Password', 'danger')
@@ -294,16 +652,66 @@ def delete_user():
 
     do_logout()
 
+    # Their rows on the shards are purged in the background.
+    if shards.enabled:
+        jobs.enqueue('purge_user_shards', {
+            'user_id': g.user.id,
+            'shard': shards.assignments([g.user.id])[g.user.id],
+        })
     db.session.delete(g.user)
     db.session.commit()
 
     return redirect("/signup")
 
 
+@app.route('/users/<int:user_id>/export')
+@limiter.limit('export')
+def export_data(user_id):
+    """Download a gzipped dump of this user's account data.
+
+    Takes a 'format' param in querystring: 'ndjson' (default) or 'csv'.
+    """
+
+    if not g.user or g.user.id != user_id:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        flash("Unknown export format.", "danger")
+        return redirect(f"/users/{user_id}")
+
+    filename = f"warbler-{g.user.username}.{fmt}.gz"
+    return Response(stream_with_context(export_user(user_id, fmt)),
+                    mimetype='application/gzip',
+                    headers={'Content-Disposition':
+                             f'attachment; filename="{filename}"'})
+
+
+@app.route('/users/import', methods=["POST"])
+@limiter.limit('import')
+def import_data():
+    """Bulk import messages and follows for the current user.
+
+    The request body is NDJSON (optionally with Content-Encoding: gzip);
+    see importer.Importer for the record format. Responds with a JSON
+    summary of what was imported and which lines were skipped.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    gzipped = request.headers.get('Content-Encoding') == 'gzip'
+    summary = import_lines(g.user.id, open_stream(request.stream, gzipped))
+
+    return jsonify(summary)
+
+
 ##############################################################################
 # Messages routes:
 
 @app.route('/messages/new', methods=["GET", "POST"])
+@limiter.limit('messages_add', methods=["POST"])
 def messages_add():
     """Add a message:
 
@@ -317,9 +725,19 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
+        session = shards.writer(g.user.id)
+        msg = Message(id=shards.allocate_message_id(session),
+                      text=form.text.data,
+                      user_id=g.user.id,
+                      **author_fields(g.user))
+        session.add(msg)
+        session.flush()
+        # Hashtags and mentions are only indexed in the main database.
+        if not shards.enabled:
+            jobs.enqueue('index_messages', {'message_id': msg.id},
+                         key=f'message:{msg.id}')
+        session.commit()
+        broker.publish(g.user.id, msg.id)
 
         return redirect(f"/users/{g.user.id}")
 
@@ -327,11 +745,85 @@ def messages_add():
 
 
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@page_cache.cached
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    def load_message():
+        msg = get_message(message_id)
+        if msg is None:
+            abort(404)
+
+        message = snapshot(msg, MESSAGE_FIELDS)
+        message.user = snapshot(msg.user, USER_FIELDS)
+        return message
+
+    page_cache.depends(f'message:{message_id}')
+    message = flights.run(('messages_show', message_id), load_message,
+                          stamp=versions.stamp(f'message:{message_id}'))
+    page_cache.depends(f'user:{message.user.id}')
+    return render_template('messages/show.html', message=message)
+
+
+# Hashtags, mentions and search are only indexed in the main database, and
+# with sharding on, messages aren't there.
+INDEX_SHARDED = "Hashtags, mentions and search are off while messages are sharded.\n"
+
+
+@app.route('/tags/<tag>')
+def messages_tagged(tag):
+    """Show messages with this hashtag, newest first."""
+
+    if shards.enabled:
+        return Response(INDEX_SHARDED, 501)
+
+    messages, cursor = tiered_page(tagged_messages(tag), tagged_messages(tag, COLD),
+                                   request.args.get('after', type=int),
+                                   app.config['MESSAGES_PER_PAGE'])
+
+    return render_template('messages/index.html',
+                           title=f"#{tag.lower()}",
+                           messages=messages,
+                           next_url=next_page_url(cursor))
+
+
+@app.route('/search')
+@limiter.limit('search')
+def search():
+    """Search messages by their text, best matches first."""
+
+    if shards.enabled:
+        return Response(INDEX_SHARDED, 501)
+
+    q = request.args.get('q', '').strip()
+    messages, cursor = [], None
+    if q:
+        messages, cursor = search_messages(q, request.args.get('after'),
+                                           app.config['MESSAGES_PER_PAGE'])
+
+    return render_template('messages/index.html',
+                           title=f'Warbles matching "{q}"',
+                           messages=messages,
+                           next_url=next_page_url(cursor))
+
+
+@app.route('/users/<int:user_id>/mentions')
+def show_mentions(user_id):
+    """Show messages that mention this user, newest first."""
+
+    if shards.enabled:
+        return Response(INDEX_SHARDED, 501)
+
+    user = User.query.get_or_404(user_id)
+    messages, cursor = tiered_page(mentioning_messages(user_id),
+                                   mentioning_messages(user_id, COLD),
+                                   request.args.get('after', type=int),
+                                   app.config['MESSAGES_PER_PAGE'])
+
+    return render_template('messages/index.html',
+                           title=f"Mentioning @{user.username}",
+                           messages=messages,
+                           next_url=next_page_url(cursor))
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -342,22 +834,81 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
-    if g.user.id != msg.user_id:
+    msg = get_message(message_id)
+    if msg is None or g.user.id != msg.user_id:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    db.session.delete(msg)
-    db.session.commit()
+    session = shards.writer(g.user.id)
+    session.delete(msg)
+    session.commit()
 
     return redirect(f"/users/{g.user.id}")
 
 
+##############################################################################
+# Live timeline updates
+
+# Message ids only grow within a shard; see live.py.
+LIVE_SHARDED = "Live updates are off while messages are sharded."
+
+
+@app.route('/api/timeline/new')
+def timeline_new():
+    """How many timeline messages are newer than the 'since' message id?"""
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+    if shards.enabled:
+        return jsonify(error=LIVE_SHARDED), 501
+
+    since = request.args.get('since', 0, type=int)
+    ids = new_message_ids(g.user.id, since)
+
+    return jsonify(count=len(ids), newest=max(ids, default=since))
+
+
+@app.route('/api/timeline/stream')
+def timeline_stream():
+    """Server-sent events with the ids of new timeline messages.
+
+    A reconnecting browser's `Last-Event-ID` (the newest id it was sent)
+    takes precedence over the page's 'since'. When too many streams are
+    open, answers 503 and the page falls back to polling
+    /api/timeline/new.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+    if shards.enabled:
+        return jsonify(error=LIVE_SHARDED), 501
+
+    user_id = g.user.id
+    since = request.args.get('since', 0, type=int)
+    last_event_id = request.headers.get('Last-Event-ID', '')
+    if last_event_id.isdigit():
+        since = int(last_event_id)
+    authors = followed_ids(user_id)
+    db.session.remove()
+
+    if not broker.open_stream(app.config['LIVE_MAX_STREAMS']):
+        return Response("Too many live streams\n", 503, {'Retry-After': '30'})
+
+    events = timeline_events(app, user_id, since, authors,
+                             heartbeat=app.config['LIVE_HEARTBEAT'])
+    return Response(ClosingIterator(events, broker.close_stream),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
 ##############################################################################
 # Homepage and error pages
 
 
 @app.route('/')
+@page_cache.cached
+@degrader.stale_on_slow_db
 def homepage():
     """Show homepage:
 
@@ -366,24 +917,26 @@ def homepage():
     """
 
     if g.user:
-        following_users = [u.user_being_followed_id for u in Follows.query.filter_by(user_following_id=g.user.id)]
-        following_users.append(g.user.id)
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_users))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        # Only the id goes to the other threads, not the ORM instance.
+        user_id = g.user.id
 
-        # get likes and pass these in
-        likes = [l.message_id for l in Likes.query.filter_by(user_id = g.user.id).all()]
+        parts = queries.gather(messages=lambda: timeline(user_id),
+                               counts=lambda: shards.counts(user_id))
 
-        return render_template('home.html', messages=messages, likes=likes)
+        return render_template('home.html', live=not shards.enabled, **parts)
 
     else:
         return render_template('home-anon.html')
 
 
+@app.errorhandler(ShardMoving)
+def shard_moving(error):
+    """This user's data is being moved between shards; retry shortly."""
+
+    return Response("Your account is being moved; try again in a moment.\n",
+                    503, {'Retry-After': '5'})
+
+
 ##############################################################################
 # Turn off all caching in Flask
 #   (useful for dev; in production, this kind of stuff is typically
@@ -0,0 +1,222 @@
+"""Hot/cold tiers for messages.
+
+`messages` holds the hot tier: messages newer than `MESSAGES_HOT_DAYS`,
+plus anything newer posted or imported since the last archive run.
+`flask archive-messages` moves older messages, with their likes and
+hashtag and mention rows, to the cold tier (`messages_archive`,
+`likes_archive`, `message_tags_archive` and `mentions_archive`) in
+batches. The cold tier has a search index of its own (see search.py).
+
+Timelines and profiles go to the hot tier first, and only touch the cold
+tier when the hot tier can't fill the page, so those of active users are
+read from a table whose size tracks recent activity, not total history.
+Tag and mention pages read both tiers. With sharding on, messages are
+read from the shards instead and there is no cold tier.
+"""
+
+from datetime import datetime, timedelta
+from heapq import merge
+from operator import attrgetter
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy.orm import contains_eager
+
+from models import db, Message, Likes, Follows, ArchivedMessage, ArchivedLike, User
+from pagination import keyset_page
+from sharding import shards
+from tags import HOT, COLD
+
+
+def recent_messages(user_ids, limit=100):
+    """The `limit` newest messages by any of `user_ids`, from either tier."""
+
+    if shards.enabled:
+        return shards.recent_messages(user_ids, limit)
+
+    hot = (Message
+           .query
+           .filter(Message.user_id.in_(user_ids))
+           .order_by(Message.timestamp.desc())
+           .limit(limit)
+           .all())
+
+    if len(hot) == limit:
+        return hot
+
+    cold = (ArchivedMessage
+            .query
+            .filter(ArchivedMessage.user_id.in_(user_ids))
+            .order_by(ArchivedMessage.timestamp.desc())
+            .limit(limit - len(hot))
+            .all())
+
+    if not cold:
+        return hot
+
+    return list(merge(hot, cold, key=attrgetter('timestamp'), reverse=True))[:limit]
+
+
+def timeline(user_id, limit=100):
+    """The `limit` newest messages by `user_id` and the users they follow.
+
+    Each comes with its author's username and avatar (their snapshot, or
+    the user row for messages without one), and with `liked` set to whether `user_id` likes it. Each tier is read in one
+    statement: the follows subquery and the likes check run in the
+    database, so neither the followed ids nor all of the user's likes
+    travel to the app.
+    """
+
+    if shards.enabled:
+        return sharded_timeline(user_id, limit)
+
+    hot = timeline_query(Message, Likes, user_id, limit)
+
+    if len(hot) == limit:
+        return hot
+
+    cold = timeline_query(ArchivedMessage, ArchivedLike, user_id, limit - len(hot))
+
+    if not cold:
+        return hot
+
+    return list(merge(hot, cold, key=attrgetter('timestamp'), reverse=True))[:limit]
+
+
+def timeline_query(model, like, user_id, limit):
+    """The newest messages of `model`'s tier on `user_id`'s timeline.
+
+    Messages render from their author snapshots (see authors.py); `users`
+    is only joined for those without one, which the templates fall back
+    to `msg.user` for.
+    """
+
+    authors = db.union(db.select([Follows.user_being_followed_id])
+                       .where(Follows.user_following_id == user_id),
+                       db.select([db.literal(user_id)]))
+    liked = (db.exists()
+             .where(like.user_id == user_id)
+             .where(like.message_id == model.id))
+    unsnapshotted = db.or_(db.func.coalesce(model.author_username, '') == '',
+                           db.func.coalesce(model.author_image_url, '') == '')
+
+    rows = (db.session
+            .query(model, liked.label('liked'))
+            .outerjoin(User, db.and_(User.id == model.user_id, unsnapshotted))
+            .options(contains_eager(model.user).load_only('username', 'image_url'))
+            .filter(model.user_id.in_(authors))
+            .order_by(model.timestamp.desc())
+            .limit(limit)
+            .all())
+
+    for msg, liked in rows:
+        msg.liked = bool(liked)
+    return [msg for msg, liked in rows]
+
+
+def sharded_timeline(user_id, limit):
+    """`timeline` across shards: follows and likes come from the user's shard."""
+
+    session = shards.reader(user_id)
+    followed = [id for id, in (session
+                               .query(Follows.user_being_followed_id)
+                               .filter_by(user_following_id=user_id))]
+    messages = shards.recent_messages(followed + [user_id], limit)
+
+    liked = {id for id, in (session
+                            .query(Likes.message_id)
+                            .filter(Likes.user_id == user_id,
+                                    Likes.message_id.in_([msg.id for msg in messages])))
+             } if messages else set()
+    for msg in messages:
+        msg.liked = msg.id in liked
+    return messages
+
+
+def tiered_page(hot, cold, after=None, per_page=50):
+    """`keyset_page`, newest id first, over the same query on each tier.
+
+    `hot` and `cold` query `Message` and `ArchivedMessage`; ids are
+    unique across the tiers, so the cursor is a message id as usual.
+    """
+
+    hot_items, hot_more = keyset_page(hot, Message.id, after, per_page, descending=True)
+    cold_items, cold_more = keyset_page(cold, ArchivedMessage.id, after, per_page,
+                                        descending=True)
+
+    items = sorted(hot_items + cold_items, key=attrgetter('id'), reverse=True)
+    if len(items) <= per_page and hot_more is None and cold_more is None:
+        return items, None
+
+    items = items[:per_page]
+    return items, items[-1].id
+
+
+def get_message(message_id):
+    """Message `message_id` from whichever tier has it, or None."""
+
+    if shards.enabled:
+        return shards.get_message(message_id)
+
+    return (Message.query.get(message_id)
+            or ArchivedMessage.query.get(message_id))
+
+
+def archive_messages(cutoff, batch_size=1000, echo=None):
+    """Move messages older than `cutoff` to the cold tier.
+
+    Each batch, with its likes, tags and mentions, is copied and then
+    deleted in one transaction (the delete cascades to the hot tier's
+    rows). Returns how many messages were moved.
+    """
+
+    moved = 0
+
+    while True:
+        ids = [id for id, in (db.session
+               .query(Message.id)
+               .filter(Message.timestamp < cutoff)
+               .order_by(Message.id)
+               .limit(batch_size))]
+        if not ids:
+            return moved
+
+        columns = [Message.id, Message.text, Message.timestamp, Message.user_id,
+                   Message.author_username, Message.author_image_url]
+        db.session.execute(ArchivedMessage.__table__.insert().from_select(
+            ['id', 'text', 'timestamp', 'user_id', 'author_username', 'author_image_url'],
+            db.select(columns).where(Message.id.in_(ids))))
+        db.session.execute(ArchivedLike.__table__.insert().from_select(
+            ['user_id', 'message_id'],
+            db.select([Likes.user_id, Likes.message_id])
+              .where(Likes.message_id.in_(ids))
+              .distinct()))
+        for hot, cold, keys in ((HOT.tag, COLD.tag, ['tag', 'message_id']),
+                                (HOT.mention, COLD.mention, ['user_id', 'message_id'])):
+            db.session.execute(cold.__table__.insert().from_select(
+                keys,
+                db.select([hot.__table__.c[key] for key in keys])
+                  .where(hot.message_id.in_(ids))))
+        Likes.query.filter(Likes.message_id.in_(ids)).delete(synchronize_session=False)
+        Message.query.filter(Message.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+        moved += len(ids)
+        if echo:
+            echo(f"Archived {moved} messages")
+
+
+@click.command('archive-messages')
+@click.option('--older-than-days', type=int, default=None,
+              help="Defaults to MESSAGES_HOT_DAYS.")
+@click.option('--batch-size', type=int, default=1000)
+@with_appcontext
+def archive_command(older_than_days, batch_size):
+    """Move old messages to the cold tier."""
+
+    days = older_than_days or current_app.config['MESSAGES_HOT_DAYS']
+    cutoff = datetime.utcnow() - timedelta(days=days)
+
+    moved = archive_messages(cutoff, batch_size, echo=click.echo)
+    click.echo(f"Moved {moved} messages from before {cutoff:%Y-%m-%d} to the archive")
@@ -0,0 +1,115 @@
+"""Author snapshots on messages.
+
+Message lists show each author's username and avatar. Rather than join
+`users` (or lazy-load `Message.user`) for every row, messages carry a
+copy in `author_username` and `author_image_url`, set when they are
+written, so a list renders from the messages alone.
+
+When a user changes either, `profile()` queues an `update_authors` job
+to run `AUTHOR_SNAPSHOT_DELAY` seconds later; until it has, their
+messages show the old values. Further edits in that window fold into
+the same job, which copies whatever is current when it runs, in batches
+of rows each committed on its own. Templates fall back to `msg.user`
+for messages without a snapshot (e.g. seeded ones, until
+`flask backfill-authors` has run).
+"""
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import inspect, text
+
+from jobs import jobs
+from models import db, ArchivedMessage, Message, User
+from sharding import shards
+from versions import versions
+
+SNAPSHOT_FIELDS = {'author_username': 'username', 'author_image_url': 'image_url'}
+
+
+def author_fields(user):
+    """Snapshot columns for a new message by `user`."""
+
+    return {column: getattr(user, field) for column, field in SNAPSHOT_FIELDS.items()}
+
+
+def queue_update(user):
+    """Have `user`'s messages brought up to date with their profile; the caller commits."""
+
+    jobs.enqueue('update_authors', {'user_id': user.id}, key=str(user.id),
+                 delay=current_app.config['AUTHOR_SNAPSHOT_DELAY'])
+
+
+def differs(column, value):
+    if value is None:
+        return column.isnot(None)
+    return db.or_(column.is_(None), column != value)
+
+
+def update_authors(user, batch_size=1000):
+    """Copy `user`'s username and avatar onto their messages; return how many changed.
+
+    Only rows out of date are touched, `batch_size` at a time, with a
+    commit after each batch.
+    """
+
+    values = author_fields(user)
+
+    if shards.enabled:
+        targets = [(shards.writer(user.id), Message.__table__)]
+    else:
+        targets = [(db.session, Message.__table__),
+                   (db.session, ArchivedMessage.__table__)]
+
+    updated = 0
+    for session, table in targets:
+        stale = db.and_(table.c.user_id == user.id,
+                        db.or_(*[differs(table.c[column], value)
+                                 for column, value in values.items()]))
+        while True:
+            ids = [id for id, in session.execute(db.select([table.c.id])
+                                                 .where(stale)
+                                                 .limit(batch_size))]
+            if not ids:
+                break
+            session.execute(table.update().where(table.c.id.in_(ids)).values(values))
+            session.commit()
+            updated += len(ids)
+
+    return updated
+
+
+@jobs.handler('update_authors', batch_size=50)
+def update_authors_job(payloads):
+    user_ids = {payload['user_id'] for payload in payloads}
+
+    for user in User.query.filter(User.id.in_(user_ids)).all():
+        if update_authors(user):
+            versions.bump(f'user:{user.id}')
+
+
+def add_columns(engine, table):
+    """Add the snapshot columns to an existing `table` that lacks them."""
+
+    existing = {column['name'] for column in inspect(engine).get_columns(table.name)}
+    for column in SNAPSHOT_FIELDS:
+        if column not in existing:
+            engine.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column} TEXT"))
+
+
+@click.command('backfill-authors')
+@click.option('--batch-size', type=int, default=1000)
+@with_appcontext
+def backfill_authors_command(batch_size):
+    """Add and fill the author snapshot columns of existing messages."""
+
+    if shards.enabled:
+        for name in shards.names:
+            add_columns(shards.engine(name), Message.__table__)
+    add_columns(db.engine, Message.__table__)
+    add_columns(db.engine, ArchivedMessage.__table__)
+
+    total = 0
+    for user_id, in db.session.query(User.id).order_by(User.id).all():
+        total += update_authors(User.query.get(user_id), batch_size)
+    click.echo(f"Updated {total} messages")
@@ -0,0 +1,146 @@
+"""Cheap username/email availability checks.
+
+A Bloom filter per column, rebuilt from `users` every `refresh` seconds,
+answers "definitely not taken" from memory for most new names. Only names
+the filter might contain are looked up (through the unique index), so
+signups can be turned away before the expensive password hash runs.
+
+Names taken on another worker since the last rebuild slip through as
+"available"; the unique constraints still catch those on commit. One
+request at a time rebuilds a stale filter; the others go on using the
+old one meanwhile.
+"""
+
+import hashlib
+import math
+import threading
+import time
+from collections import Counter
+
+from models import db, User
+from warmup import primer
+
+
+class BloomFilter:
+    """Set membership with false positives but no false negatives."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        # Standard sizing: m = -n ln p / (ln 2)^2 bits, k = m/n ln 2 hashes.
+        capacity = max(capacity, 1000)
+        self.bits = int(-capacity * math.log(error_rate) / (math.log(2) ** 2)) + 1
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.array = bytearray(self.bits // 8 + 1)
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def add(self, value):
+        for pos in self._positions(value):
+            self.array[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, value):
+        return all(self.array[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(value))
+
+
+class Availability:
+    """In-memory pre-check for usernames and emails already in use."""
+
+    def __init__(self, refresh=300):
+        self.refresh = refresh
+        self.usernames = None
+        self.emails = None
+        self.built_at = 0
+        self._lock = threading.Lock()
+        self._rebuilding = threading.Lock()
+        self._added = None
+        self.stats = Counter()
+
+    def rebuild(self):
+        """Rebuild both filters from the `users` table."""
+
+        with self._lock:
+            # Names added while the table is read go into the new filters too.
+            self._added = []
+
+        count = db.session.query(db.func.count(User.id)).scalar()
+        usernames = BloomFilter(count * 2)
+        emails = BloomFilter(count * 2)
+
+        for username, email in (db.session
+                                .query(User.username, User.email)
+                                .yield_per(5000)):
+            usernames.add(username)
+            emails.add(email)
+
+        with self._lock:
+            for username, email in self._added:
+                usernames.add(username)
+                emails.add(email)
+            self.usernames, self.emails = usernames, emails
+            self.built_at = time.monotonic()
+            self._added = None
+        self.stats['rebuilds'] += 1
+
+    def _stale(self):
+        return self.usernames is None or time.monotonic() - self.built_at > self.refresh
+
+    def _fresh(self):
+        if not self._stale():
+            return
+
+        # Without filters yet, wait for them; otherwise, if another request
+        # is rebuilding, keep using the old ones.
+        if not self._rebuilding.acquire(blocking=self.usernames is None):
+            return
+        try:
+            if self._stale():
+                self.rebuild()
+        finally:
+            self._rebuilding.release()
+
+    def add(self, username, email):
+        """Record a new (or renamed) user's username and email."""
+
+        with self._lock:
+            if self.usernames is not None:
+                self.usernames.add(username)
+                self.emails.add(email)
+            if self._added is not None:
+                self._added.append((username, email))
+
+    def taken(self, username=None, email=None):
+        """Which of `username` and `email` are already in use?
+
+        Returns `{'username': bool, 'email': bool}` for those given.
+        """
+
+        self._fresh()
+        result = {}
+
+        for field, value, bloom, column in (
+                ('username', username, self.usernames, User.username),
+                ('email', email, self.emails, User.email)):
+            if value is None:
+                continue
+            if value not in bloom:
+                self.stats['filtered'] += 1
+                result[field] = False
+            else:
+                self.stats['looked_up'] += 1
+                result[field] = db.session.query(
+                    db.session.query(User.id).filter(column == value).exists()
+                ).scalar()
+
+        return result
+
+
+availability = Availability()
+
+
+@primer('availability')
+def build_filters(app):
+    availability.rebuild()
@@ -0,0 +1,306 @@
+"""Benchmarks for Warbler on seeded data.
+
+Run like:
+
+    python bench.py --database-url sqlite:///bench.db timeline --history 10000 100000
+    python bench.py --database-url sqlite:///bench.db timeline-query --follows 10 100 299
+
+Give --database-url more than once to run the same benchmark, on the same
+seeded data, against each backend in turn:
+
+    python bench.py --database-url postgresql:///warbler-bench \
+                    --database-url sqlite:///bench.db throughput
+
+Every run drops and recreates all tables in the target databases, so never
+point it at a database you care about.
+
+Users and follows come from the CSVs under generator/; messages are
+generated, with timestamps spread evenly over the last --years years.
+"""
+
+import argparse
+import csv
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+CHUNK = 5000
+
+
+def load_app(database_url):
+    """Import the app against `database_url`, with request guards off."""
+
+    os.environ['DATABASE_URL'] = database_url
+    os.environ.setdefault('RATELIMIT_ENABLED', '0')
+    os.environ.setdefault('SLOW_QUERY_MS', '0')
+    os.environ.setdefault('DEGRADE_ENABLED', '0')
+
+    from app import app
+    app.config['WTF_CSRF_ENABLED'] = False
+    return app
+
+
+def seed(app, messages, years, seed=0):
+    """Recreate the tables and fill them with `messages` generated messages."""
+
+    from models import db, User, Message, Follows
+
+    rng = random.Random(seed)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        with open('generator/users.csv') as f:
+            users = list(csv.DictReader(f))
+        db.session.execute(User.__table__.insert(), users)
+
+        with open('generator/follows.csv') as f:
+            follows = [{k: int(v) for k, v in row.items()} for row in csv.DictReader(f)]
+        db.session.execute(Follows.__table__.insert(), follows)
+
+        with open('generator/messages.csv') as f:
+            texts = [row['text'] for row in csv.DictReader(f)]
+
+        now = datetime.utcnow()
+        span = years * 365 * 24 * 3600
+        user_ids = range(1, len(users) + 1)
+
+        for start in range(0, messages, CHUNK):
+            rows = [{'text': rng.choice(texts),
+                     'timestamp': now - timedelta(seconds=rng.uniform(0, span)),
+                     'user_id': rng.choice(user_ids)}
+                    for _ in range(min(CHUNK, messages - start))]
+            db.session.execute(Message.__table__.insert(), rows)
+
+        db.session.commit()
+        return len(users)
+
+
+def time_get(app, path, user_ids, repeat=3):
+    """Latencies (ms) of GET `path` logged in as each of `user_ids`."""
+
+    from app import CURR_USER_KEY
+
+    client = app.test_client()
+    timings = []
+
+    for user_id in user_ids:
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        for _ in range(repeat):
+            started = time.perf_counter()
+            resp = client.get(path.format(user_id=user_id))
+            resp.get_data()
+            timings.append((time.perf_counter() - started) * 1000)
+            assert resp.status_code == 200, resp.status
+
+    return timings
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    return (statistics.median(timings),
+            timings[int(len(timings) * 0.95) - 1])
+
+
+def bench_timeline(app, args):
+    """Timeline and profile latency as history grows, before/after archiving."""
+
+    from archive import archive_messages
+
+    print(f"{'history':>10} {'tier':>8} {'/ p50':>9} {'/ p95':>9}"
+          f" {'profile p50':>12} {'profile p95':>12}")
+
+    for history in args.history:
+        users = seed(app, history, args.years)
+        sample = random.Random(1).sample(range(1, users + 1), args.users)
+
+        for tier in ('single', 'hot/cold'):
+            if tier == 'hot/cold':
+                with app.app_context():
+                    cutoff = datetime.utcnow() - timedelta(days=args.hot_days)
+                    archive_messages(cutoff)
+
+            home = summarize(time_get(app, '/', sample))
+            profile = summarize(time_get(app, '/users/{user_id}', sample))
+            print(f"{history:>10} {tier:>8} {home[0]:>9.1f} {home[1]:>9.1f}"
+                  f" {profile[0]:>12.1f} {profile[1]:>12.1f}")
+            sys.stdout.flush()
+
+
+def bench_timeline_query(app, args):
+    """Round trips and payload of the homepage timeline, by follow count."""
+
+    from sqlalchemy import event
+    from archive import recent_messages, timeline
+    from models import db, Follows, Likes, Message
+
+    users = seed(app, args.messages, args.years)
+    rng = random.Random(2)
+    user_id = 1
+
+    def separate():
+        # The homepage's former reads: follows, then messages by the
+        # followed ids, then all the user's likes, and the authors the
+        # template loaded for messages without a snapshot.
+        followed = [f.user_being_followed_id
+                    for f in Follows.query.filter_by(user_following_id=user_id)]
+        messages = recent_messages(followed + [user_id])
+        likes = {id for id, in db.session.query(Likes.message_id).filter_by(user_id=user_id)}
+        authors = {msg.user.id for msg in messages}
+        return len(followed) + len(messages) + len(likes) + len(authors)
+
+    def joined():
+        return len(timeline(user_id))
+
+    print(f"{'follows':>8} {'query':>9} {'trips':>6} {'sent':>9} {'rows':>6} {'p50':>9}")
+
+    with app.app_context():
+        message_ids = [id for id, in db.session.query(Message.id)]
+        db.session.execute(Likes.__table__.insert(),
+                           [{'user_id': user_id, 'message_id': id}
+                            for id in rng.sample(message_ids, min(args.likes, len(message_ids)))])
+        db.session.commit()
+
+        for follows in args.follows:
+            Follows.query.filter_by(user_following_id=user_id).delete()
+            others = rng.sample(range(2, users + 1), min(follows, users - 1))
+            db.session.execute(Follows.__table__.insert(),
+                               [{'user_being_followed_id': id, 'user_following_id': user_id}
+                                for id in others])
+            db.session.commit()
+
+            for name, query in (('separate', separate), ('joined', joined)):
+                sent = []
+
+                def count(conn, cursor, statement, parameters, context, executemany):
+                    sent.append(len(statement) + len(repr(parameters)))
+
+                event.listen(db.engine, 'before_cursor_execute', count)
+                timings = []
+                for _ in range(args.repeat):
+                    db.session.remove()
+                    del sent[:]
+                    started = time.perf_counter()
+                    rows = query()
+                    timings.append((time.perf_counter() - started) * 1000)
+                event.remove(db.engine, 'before_cursor_execute', count)
+
+                print(f"{len(others):>8} {name:>9} {len(sent):>6} {sum(sent):>9}"
+                      f" {rows:>6} {statistics.median(timings):>9.1f}")
+                sys.stdout.flush()
+
+
+def run_mix(app, users, seconds, write_ratio, seed):
+    """Send a read/write request mix for `seconds`; return latencies (ms)."""
+
+    from app import CURR_USER_KEY
+
+    rng = random.Random(seed)
+    client = app.test_client()
+    timings = []
+    deadline = time.perf_counter() + seconds
+
+    while time.perf_counter() < deadline:
+        user_id = rng.randint(1, users)
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        roll = rng.random()
+        started = time.perf_counter()
+        if roll < write_ratio:
+            resp = client.post('/messages/new', data={'text': "Benchmarking"})
+        elif roll < write_ratio + (1 - write_ratio) / 2:
+            resp = client.get('/')
+        else:
+            resp = client.get(f'/users/{rng.randint(1, users)}')
+        resp.get_data()
+        timings.append((time.perf_counter() - started) * 1000)
+        assert resp.status_code in (200, 302), resp.status
+
+    return timings
+
+
+def bench_throughput(app, args):
+    """Requests per second of a timeline/profile/post mix, by thread count."""
+
+    users = seed(app, args.messages, args.years)
+
+    print(f"{'threads':>8} {'req/s':>9} {'p50':>9} {'p95':>9}")
+
+    for threads in args.threads:
+        results = [[] for _ in range(threads)]
+
+        def worker(i):
+            results[i] = run_mix(app, users, args.seconds, args.write_ratio, i)
+
+        workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+        started = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        timings = [ms for result in results for ms in result]
+        p50, p95 = summarize(timings)
+        print(f"{threads:>8} {len(timings) / elapsed:>9.1f} {p50:>9.1f} {p95:>9.1f}")
+        sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--database-url', required=True, action='append',
+                        help="Database to (re)create and benchmark; repeat"
+                             " to compare backends.")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    timeline = commands.add_parser('timeline', help=bench_timeline.__doc__)
+    timeline.add_argument('--history', type=int, nargs='+',
+                          default=[10000, 50000, 200000],
+                          help="Total message counts to try.")
+    timeline.add_argument('--years', type=float, default=5)
+    timeline.add_argument('--hot-days', type=int, default=90)
+    timeline.add_argument('--users', type=int, default=20,
+                          help="How many users to time pages for.")
+    timeline.set_defaults(run=bench_timeline)
+
+    timeline_query = commands.add_parser('timeline-query',
+                                         help=bench_timeline_query.__doc__)
+    timeline_query.add_argument('--messages', type=int, default=50000)
+    timeline_query.add_argument('--years', type=float, default=1)
+    timeline_query.add_argument('--follows', type=int, nargs='+', default=[10, 100, 299],
+                                help="Follow counts to try.")
+    timeline_query.add_argument('--likes', type=int, default=1000,
+                                help="How many messages the user has liked.")
+    timeline_query.add_argument('--repeat', type=int, default=20)
+    timeline_query.set_defaults(run=bench_timeline_query)
+
+    throughput = commands.add_parser('throughput', help=bench_throughput.__doc__)
+    throughput.add_argument('--messages', type=int, default=50000)
+    throughput.add_argument('--years', type=float, default=1)
+    throughput.add_argument('--threads', type=int, nargs='+', default=[1, 4, 16])
+    throughput.add_argument('--seconds', type=float, default=10)
+    throughput.add_argument('--write-ratio', type=float, default=0.1,
+                            help="Share of requests that post a message.")
+    throughput.set_defaults(run=bench_throughput)
+
+    args = parser.parse_args(argv)
+    app = load_app(args.database_url[0])
+
+    for database_url in args.database_url:
+        if len(args.database_url) > 1:
+            print(f"\n== {database_url}")
+        # Flask-SQLAlchemy makes a new engine when the URI changes.
+        app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+        args.run(app, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+"""Sharing version bumps between worker processes.
+
+Each process keeps its own `versions` (see versions.py), so on its own a
+write handled by one gunicorn worker leaves the page cache and
+single-flight keys of the others looking current. `bus` hears every
+local bump and writes it to the `version_bumps` table; a thread in each
+serving process reads the bumps of the others and applies them.
+
+On Postgres the writer also sends `NOTIFY warbler_versions`, and readers
+`LISTEN` on a connection of their own, so bumps usually arrive within
+milliseconds. Readers also re-read the table at least every
+`BUS_POLL_INTERVAL` seconds, which bounds the delay if notifications are
+lost, and is the only transport with `BUS_TRANSPORT = 'table'` or on
+SQLite.
+
+Each reader keeps the lag of the bumps it applied (from `sent_at`, so
+clocks across hosts should agree), and every `BUS_HEARTBEAT` seconds
+reports it, and how far it has read, to `bus_listeners`; see
+`flask bus-status`. Rows older than `BUS_RETENTION` seconds are deleted.
+"""
+
+import os
+import select
+import socket
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import text
+
+from models import db, BusListener, VersionBump
+from versions import versions
+
+CHANNEL = 'warbler_versions'
+
+# Ids are allocated before rows commit, so on Postgres a row can appear
+# after one with a higher id; each read looks this many ids back for them.
+OVERLAP = 100
+
+
+class Bus:
+    """Publishes local version bumps, and applies other processes'."""
+
+    def __init__(self):
+        self.enabled = False
+        self.stats = Counter()
+        self.lags = deque(maxlen=1000)
+        self.last_id = None
+        self.seen = set()
+        self._pid = None
+        self._listener = None
+        self._lock = threading.Lock()
+        self._poll_lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('BUS_ENABLED', True)
+        app.config.setdefault('BUS_TRANSPORT', 'notify')
+        app.config.setdefault('BUS_POLL_INTERVAL', 1.0)
+        app.config.setdefault('BUS_HEARTBEAT', 10)
+        app.config.setdefault('BUS_RETENTION', 3600)
+
+        self.app = app
+        self.config = app.config
+        self.enabled = app.config['BUS_ENABLED']
+
+        if self.enabled:
+            if self.publish not in versions.listeners:
+                versions.listeners.append(self.publish)
+            app.before_request(self.start)
+
+    @property
+    def origin(self):
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    @property
+    def engine(self):
+        return db.get_engine(self.app)
+
+    @property
+    def notifying(self):
+        return (self.config['BUS_TRANSPORT'] == 'notify'
+                and self.engine.dialect.name == 'postgresql')
+
+    def publish(self, names):
+        """Write a bump of `names` made in this process, for the others."""
+
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(VersionBump.__table__.insert().values(
+                    names=' '.join(sorted(names)),
+                    origin=self.origin,
+                    sent_at=time.time()))
+                if self.notifying:
+                    conn.execute(text(f"NOTIFY {CHANNEL}"))
+        except Exception:
+            # The write itself has committed; don't fail the request.
+            self.stats['publish_errors'] += 1
+            self.app.logger.exception("Publishing version bumps %s failed", names)
+        else:
+            self.stats['published'] += 1
+
+    def start(self):
+        """Start this process's reader thread, unless it's running.
+
+        Called before each request; threads don't survive a fork, so each
+        worker starts its own.
+        """
+
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._listener = None
+            self.last_id = None
+            self.lags.clear()
+            threading.Thread(target=self.run, name='version-bus', daemon=True).start()
+
+    def run(self):
+        reported_at = 0
+
+        with self.app.app_context():
+            while True:
+                try:
+                    self.wait()
+                    self.poll()
+                    if time.monotonic() - reported_at >= self.config['BUS_HEARTBEAT']:
+                        self.report()
+                        reported_at = time.monotonic()
+                except Exception:
+                    self.stats['errors'] += 1
+                    self.app.logger.exception("Reading version bumps failed")
+                    self.close_listener()
+                    time.sleep(self.config['BUS_POLL_INTERVAL'])
+
+    def wait(self):
+        """Wait for a notification, or at most `BUS_POLL_INTERVAL` seconds."""
+
+        timeout = self.config['BUS_POLL_INTERVAL']
+
+        if not self.notifying:
+            time.sleep(timeout)
+            return
+
+        if self._listener is None:
+            listener = self.engine.raw_connection()
+            listener.detach()
+            listener.connection.autocommit = True
+            cursor = listener.cursor()
+            cursor.execute(f"LISTEN {CHANNEL}")
+            cursor.close()
+            self._listener = listener
+            self.stats['listens'] += 1
+            # Read the table straight away, for anything missed meanwhile.
+            return
+
+        conn = self._listener.connection
+        if select.select([conn], [], [], timeout)[0]:
+            conn.poll()
+            self.stats['notifications'] += len(conn.notifies)
+            del conn.notifies[:]
+
+    def close_listener(self):
+        if self._listener is not None:
+            try:
+                self._listener.close()
+            except Exception:
+                pass
+            self._listener = None
+
+    def poll(self):
+        """Apply bumps other processes have written since the last poll.
+
+        The first poll only notes where the table ends. Returns the
+        number of bumps applied.
+        """
+
+        table = VersionBump.__table__
+
+        with self._poll_lock:
+            if self.last_id is None:
+                top = self.engine.execute(db.select([db.func.max(table.c.id)])).scalar() or 0
+                self.seen = {id for id, in self.engine.execute(
+                    db.select([table.c.id]).where(table.c.id > top - OVERLAP))}
+                self.last_id = top
+                return 0
+
+            rows = self.engine.execute(table.select()
+                                       .where(table.c.id > self.last_id - OVERLAP)
+                                       .order_by(table.c.id)).fetchall()
+            now = time.time()
+            origin = self.origin
+            applied = 0
+
+            for row in rows:
+                if row.id in self.seen:
+                    continue
+                self.seen.add(row.id)
+                if row.origin == origin:
+                    continue
+                versions.apply(*row.names.split())
+                self.lags.append(max(0.0, now - row.sent_at))
+                applied += 1
+
+            if rows:
+                self.last_id = max(self.last_id, rows[-1].id)
+            self.seen = {id for id in self.seen if id > self.last_id - OVERLAP}
+
+        self.stats['applied'] += applied
+        return applied
+
+    def lag(self):
+        """(median, max) lag in ms of recently applied bumps, or (None, None)."""
+
+        lags = sorted(self.lags)
+        if not lags:
+            return None, None
+        return lags[len(lags) // 2] * 1000, lags[-1] * 1000
+
+    def report(self):
+        """Record this process's progress and lag; delete old rows."""
+
+        p50, worst = self.lag()
+        values = dict(last_id=self.last_id or 0, applied=self.stats['applied'],
+                      lag_p50_ms=p50, lag_max_ms=worst, seen_at=datetime.utcnow())
+        listeners = BusListener.__table__
+        retention = self.config['BUS_RETENTION']
+
+        with self.engine.begin() as conn:
+            if not conn.execute(listeners.update()
+                                .where(listeners.c.origin == self.origin)
+                                .values(values)).rowcount:
+                conn.execute(listeners.insert().values(values, origin=self.origin))
+            conn.execute(VersionBump.__table__.delete()
+                         .where(VersionBump.sent_at < time.time() - retention))
+            conn.execute(listeners.delete()
+                         .where(listeners.c.seen_at
+                                < datetime.utcnow() - timedelta(seconds=retention)))
+
+
+bus = Bus()
+
+
+@click.command('bus-status')
+@with_appcontext
+def bus_status_command():
+    """Show how far behind each process applying version bumps is."""
+
+    top = db.session.query(db.func.max(VersionBump.id)).scalar() or 0
+    heartbeat = current_app.config['BUS_HEARTBEAT']
+
+    def ms(value):
+        return '-' if value is None else f"{value:.0f}ms"
+
+    for listener in BusListener.query.order_by(BusListener.origin):
+        age = (datetime.utcnow() - listener.seen_at).total_seconds()
+        click.echo(f"{listener.origin:32} {max(0, top - listener.last_id):6} behind"
+                   f"  {listener.applied:8} applied"
+                   f"  lag p50 {ms(listener.lag_p50_ms):>7} max {ms(listener.lag_max_ms):>7}"
+                   f"  reported {age:.0f}s ago"
+                   f"{'  (stale)' if age > 3 * heartbeat else ''}")
@@ -0,0 +1,144 @@
+"""Response compression (gzip, and brotli when installed)."""
+
+import gzip
+import time
+import threading
+import zlib
+from collections import Counter
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = {
+    'text/html', 'text/css', 'text/plain', 'text/csv',
+    'application/json', 'application/javascript', 'application/x-ndjson',
+}
+
+
+class Compressor:
+    """Compresses responses in an `after_request` hook.
+
+    Buffered responses under `COMPRESS_MIN_SIZE` bytes are left alone;
+    streamed responses are compressed chunk by chunk, with a sync flush
+    after each so the client still gets data as it is produced.
+
+    `stats` counts responses and bytes in/out per encoding, and the CPU
+    milliseconds spent compressing; buffered responses also report their
+    cost in a `Server-Timing` header.
+    """
+
+    def __init__(self):
+        self.stats = Counter()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('COMPRESS_ENABLED', True)
+        app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+        app.config.setdefault('COMPRESS_LEVEL', 6)
+        app.config.setdefault('COMPRESS_BROTLI_QUALITY', 4)
+        app.config.setdefault('COMPRESS_MIMETYPES', COMPRESSIBLE)
+
+        self.config = app.config
+        app.after_request(self.after_request)
+
+    def encoding(self):
+        """Best encoding this client accepts, or None."""
+
+        accepted = request.accept_encodings
+        if brotli is not None and accepted['br']:
+            return 'br'
+        if accepted['gzip']:
+            return 'gzip'
+        return None
+
+    def count(self, encoding, bytes_in, bytes_out, cpu):
+        with self._lock:
+            self.stats[f'{encoding}_responses'] += 1
+            self.stats[f'{encoding}_bytes_in'] += bytes_in
+            self.stats[f'{encoding}_bytes_out'] += bytes_out
+            self.stats[f'{encoding}_cpu_ms'] += cpu * 1000
+
+    def after_request(self, response):
+        config = self.config
+
+        if (not config['COMPRESS_ENABLED']
+                or response.status_code < 200
+                or response.status_code in (204, 304)
+                or response.mimetype not in config['COMPRESS_MIMETYPES']
+                or 'Content-Encoding' in response.headers
+                or response.direct_passthrough):
+            return response
+
+        encoding = self.encoding()
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = self.stream(response.response, encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < config['COMPRESS_MIN_SIZE']:
+                return response
+
+            started = time.thread_time()
+            if encoding == 'br':
+                body = brotli.compress(data, quality=config['COMPRESS_BROTLI_QUALITY'])
+            else:
+                body = gzip.compress(data, config['COMPRESS_LEVEL'])
+            cpu = time.thread_time() - started
+
+            response.set_data(body)
+            self.count(encoding, len(data), len(body), cpu)
+            response.headers.add('Server-Timing', f'compress;dur={cpu * 1000:.2f}')
+
+        response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        return response
+
+    def stream(self, chunks, encoding):
+        """Compress the iterable `chunks` as it is consumed."""
+
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=self.config['COMPRESS_BROTLI_QUALITY'])
+            compress, flush = compressor.process, compressor.flush
+            finish = compressor.finish
+        else:
+            compressor = zlib.compressobj(self.config['COMPRESS_LEVEL'],
+                                          zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            compress = compressor.compress
+            flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+            finish = compressor.flush
+
+        bytes_in = bytes_out = 0
+        cpu = 0.0
+
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                if not chunk:
+                    continue
+
+                started = time.thread_time()
+                out = compress(chunk) + flush()
+                cpu += time.thread_time() - started
+
+                bytes_in += len(chunk)
+                bytes_out += len(out)
+                yield out
+
+            out = finish()
+            bytes_out += len(out)
+            yield out
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            self.count(encoding, bytes_in, bytes_out, cpu)
+
+
+compressor = Compressor()
@@ -0,0 +1,177 @@
+"""Serve the last good page while the database is slow.
+
+Every statement's time feeds an exponentially weighted moving average of
+database latency. Views decorated with `stale_on_slow_db` keep their
+last good render per (path, viewer); while the average is over
+`DEGRADE_LATENCY_MS`, they answer from that render instead of querying,
+marked stale, and one background request per page re-renders it.
+
+Only GET views are decorated, so writes always go to the primary as
+usual; they also keep the latency average current while pages are being
+served stale.
+"""
+
+import io
+import threading
+import time
+from collections import Counter, OrderedDict
+from functools import wraps
+
+from flask import (Response, current_app, g, make_response, request,
+                   session)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+STALE_MARKER = b'<!-- stale -->'
+STALE_BANNER = (b'<div class="alert alert-warning">Warbler is running slowly;'
+                b' this page may be out of date.</div>')
+
+
+class Degrader:
+    """Tracks database latency and serves cached renders when it is high."""
+
+    def __init__(self, identity):
+        self.identity = identity
+        self.enabled = False
+        self.latency = 0.0
+        self.sampled_at = 0.0
+        self.renders = OrderedDict()
+        self.refreshing = set()
+        self.stats = Counter()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('DEGRADE_ENABLED', True)
+        app.config.setdefault('DEGRADE_LATENCY_MS', 100)
+        app.config.setdefault('DEGRADE_SMOOTHING', 0.2)
+        app.config.setdefault('DEGRADE_MAX_AGE', 600)
+        app.config.setdefault('DEGRADE_MAX_PAGES', 1000)
+
+        self.config = app.config
+        self.enabled = app.config['DEGRADE_ENABLED']
+
+        if self.enabled and not event.contains(Engine, 'before_cursor_execute', self.before):
+            event.listen(Engine, 'before_cursor_execute', self.before)
+            event.listen(Engine, 'after_cursor_execute', self.after)
+            event.listen(Engine, 'handle_error', self.error)
+
+    def before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('degrade_start', []).append(time.perf_counter())
+
+    def after(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = (time.perf_counter() - conn.info['degrade_start'].pop()) * 1000
+        self.observe(elapsed)
+
+    def error(self, context):
+        """Time a statement that raised too (a timeout is latency as well)."""
+
+        if context.connection is not None and context.execution_context is not None:
+            started = context.connection.info.get('degrade_start')
+            if started:
+                self.observe((time.perf_counter() - started.pop()) * 1000)
+
+    def observe(self, ms):
+        """Fold one statement's latency into the moving average."""
+
+        alpha = self.config['DEGRADE_SMOOTHING']
+        with self._lock:
+            self.latency += alpha * (ms - self.latency)
+            self.sampled_at = time.monotonic()
+
+    def degraded(self):
+        """Is the database currently over its latency budget?
+
+        An average nobody has updated for a while (every page being served
+        stale, say) is too old to trust, so it doesn't count.
+        """
+
+        return (self.enabled
+                and self.latency > self.config['DEGRADE_LATENCY_MS']
+                and time.monotonic() - self.sampled_at < 30)
+
+    def key(self):
+        return (request.full_path, self.identity())
+
+    def remember(self, key, response):
+        """Keep `response` as the last good render for `key`."""
+
+        with self._lock:
+            self.renders[key] = (time.monotonic(), response.get_data())
+            self.renders.move_to_end(key)
+            while len(self.renders) > self.config['DEGRADE_MAX_PAGES']:
+                self.renders.popitem(last=False)
+
+    def lookup(self, key):
+        with self._lock:
+            entry = self.renders.get(key)
+        if entry and time.monotonic() - entry[0] < self.config['DEGRADE_MAX_AGE']:
+            return entry
+        return None
+
+    def stale(self, entry):
+        stored_at, body = entry
+        self.stats['stale'] += 1
+
+        response = Response(body.replace(STALE_MARKER, STALE_BANNER, 1),
+                            mimetype='text/html')
+        response.headers['Age'] = str(int(time.monotonic() - stored_at))
+        response.headers['Warning'] = '110 - "Response is Stale"'
+        return response
+
+    def refresh(self, key):
+        """Re-render `key` in the background, unless already under way."""
+
+        with self._lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        app = current_app._get_current_object()
+        environ = dict(request.environ, **{'wsgi.input': io.BytesIO()})
+
+        def run():
+            try:
+                with app.request_context(environ):
+                    g.degrade_refresh = True
+                    rv = app.preprocess_request()
+                    if rv is None:
+                        rv = app.dispatch_request()
+                    app.make_response(rv)
+                self.stats['refreshes'] += 1
+            except Exception:
+                self.stats['refresh_errors'] += 1
+                app.logger.exception("Background refresh of %s failed", key[0])
+            finally:
+                with self._lock:
+                    self.refreshing.discard(key)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def stale_on_slow_db(self, view):
+        """Decorate a GET view to be served stale while the DB is slow."""
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return view(*args, **kwargs)
+
+            key = self.key()
+
+            if not getattr(g, 'degrade_refresh', False) and self.degraded():
+                entry = self.lookup(key)
+                if entry is not None:
+                    self.refresh(key)
+                    return self.stale(entry)
+                self.stats['stale_misses'] += 1
+
+            # A page showing one-off flash messages mustn't be replayed.
+            flashed = bool(session.get('_flashes'))
+            response = make_response(view(*args, **kwargs))
+
+            if (response.status_code == 200
+                    and not response.is_streamed
+                    and not flashed):
+                self.remember(key, response)
+            self.stats['fresh'] += 1
+            return response
+        return wrapper
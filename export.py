@@ -0,0 +1,214 @@
+"""Streaming export of a user's account data."""
+
+import csv
+import io
+import json
+import sys
+import zlib
+from itertools import chain
+
+import click
+from flask.cli import with_appcontext
+
+from models import db, User, Message, Follows, Likes, ArchivedMessage, ArchivedLike
+from sharding import shards
+
+FORMATS = ('ndjson', 'csv')
+
+CSV_FIELDS = ['type', 'id', 'user_id', 'username', 'text', 'timestamp']
+
+CHUNK_SIZE = 1000
+
+
+def export_records(user_id, chunk_size=CHUNK_SIZE):
+    """Yield a dict per message, like, follower and following of the user.
+
+    Every section is read as plain column tuples through a server-side
+    cursor (`yield_per` turns on `stream_results`), so memory use stays
+    constant however big the account is. With sharding on, sections that
+    span shards are read a chunk at a time instead. Archived messages and
+    likes (the cold tier, see archive.py) come before the others, being
+    older.
+    """
+
+    archived = (db.session
+                .query(ArchivedMessage.id, ArchivedMessage.text, ArchivedMessage.timestamp)
+                .filter(ArchivedMessage.user_id == user_id)
+                .order_by(ArchivedMessage.id)
+                .yield_per(chunk_size))
+    messages = (shards.reader(user_id)
+                .query(Message.id, Message.text, Message.timestamp)
+                .filter(Message.user_id == user_id)
+                .order_by(Message.id)
+                .yield_per(chunk_size))
+    for id, text, timestamp in chain(archived, messages):
+        yield {'type': 'message', 'id': id, 'user_id': user_id,
+               'text': text, 'timestamp': timestamp.isoformat()}
+
+    archived_likes = (db.session
+                      .query(ArchivedMessage.id, ArchivedMessage.user_id,
+                             ArchivedMessage.text, ArchivedMessage.timestamp)
+                      .join(ArchivedLike, ArchivedLike.message_id == ArchivedMessage.id)
+                      .filter(ArchivedLike.user_id == user_id)
+                      .order_by(ArchivedMessage.id)
+                      .yield_per(chunk_size))
+    if shards.enabled:
+        likes = sharded_likes(user_id, chunk_size)
+    else:
+        likes = (db.session
+                 .query(Message.id, Message.user_id, Message.text, Message.timestamp)
+                 .join(Likes, Likes.message_id == Message.id)
+                 .filter(Likes.user_id == user_id)
+                 .order_by(Message.id)
+                 .yield_per(chunk_size))
+    for id, author_id, text, timestamp in chain(archived_likes, likes):
+        yield {'type': 'like', 'id': id, 'user_id': author_id,
+               'text': text, 'timestamp': timestamp.isoformat()}
+
+    if shards.enabled:
+        followers = sharded_users(paged_ids(
+            lambda after: shards.follower_ids(user_id, after, chunk_size)))
+    else:
+        followers = (db.session
+                     .query(User.id, User.username)
+                     .join(Follows, Follows.user_following_id == User.id)
+                     .filter(Follows.user_being_followed_id == user_id)
+                     .order_by(User.id)
+                     .yield_per(chunk_size))
+    for id, username in followers:
+        yield {'type': 'follower', 'id': id, 'username': username}
+
+    if shards.enabled:
+        following = sharded_users(chunks_of(sorted(shards.following_ids(user_id)),
+                                            chunk_size))
+    else:
+        following = (db.session
+                     .query(User.id, User.username)
+                     .join(Follows, Follows.user_being_followed_id == User.id)
+                     .filter(Follows.user_following_id == user_id)
+                     .order_by(User.id)
+                     .yield_per(chunk_size))
+    for id, username in following:
+        yield {'type': 'following', 'id': id, 'username': username}
+
+
+def paged_ids(page):
+    """Yield the pages of ids `page(after)` returns, until one is empty."""
+
+    after = None
+    while True:
+        ids = page(after)
+        if not ids:
+            return
+        yield ids
+        after = ids[-1]
+
+
+def chunks_of(ids, size):
+    """Split the iterable `ids` into lists of `size`."""
+
+    ids = list(ids)
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def sharded_likes(user_id, chunk_size):
+    """(id, author id, text, timestamp) of the messages the user liked.
+
+    The likes are on the user's shard; the messages, on their authors'.
+    """
+
+    liked = (shards.reader(user_id)
+             .query(Likes.message_id)
+             .filter(Likes.user_id == user_id)
+             .order_by(Likes.message_id))
+    for ids in chunks_of((id for id, in liked), chunk_size):
+        for msg in sorted(shards.find_messages(ids), key=lambda msg: msg.id):
+            yield msg.id, msg.user_id, msg.text, msg.timestamp
+
+
+def sharded_users(chunks):
+    """(id, username) of the users in each chunk of ids, from the main database."""
+
+    for ids in chunks:
+        yield from (db.session
+                    .query(User.id, User.username)
+                    .filter(User.id.in_(ids))
+                    .order_by(User.id))
+
+
+def encode(records, fmt):
+    """Serialize `records` to lines of text in format `fmt`."""
+
+    if fmt == 'ndjson':
+        for record in records:
+            yield json.dumps(record) + "\n"
+
+    elif fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, CSV_FIELDS)
+        writer.writeheader()
+
+        for record in records:
+            writer.writerow(record)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+        yield buffer.getvalue()
+
+    else:
+        raise ValueError(f"Unknown export format: {fmt}")
+
+
+def gzip_stream(chunks, level=6, flush_size=64 * 1024):
+    """Gzip-compress an iterable of text chunks on the fly.
+
+    Lines are gathered into blocks of about `flush_size` bytes before being
+    handed to the compressor, which keeps both the ratio and the number of
+    (tiny) chunks sent reasonable.
+    """
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    pending = []
+    size = 0
+
+    for chunk in chunks:
+        data = chunk.encode('utf-8')
+        pending.append(data)
+        size += len(data)
+
+        if size >= flush_size:
+            out = compressor.compress(b"".join(pending))
+            pending, size = [], 0
+            if out:
+                yield out
+
+    yield compressor.compress(b"".join(pending)) + compressor.flush()
+
+
+def export_user(user_id, fmt='ndjson', compress=True):
+    """Stream the export of user `user_id` as bytes."""
+
+    chunks = encode(export_records(user_id), fmt)
+
+    if compress:
+        return gzip_stream(chunks)
+    return (chunk.encode('utf-8') for chunk in chunks)
+
+
+@click.command('export-user')
+@click.argument('user_id', type=int)
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default='ndjson')
+@click.option('--gzip/--no-gzip', 'compress', default=True)
+@click.option('--output', '-o', type=click.File('wb'), default='-')
+@with_appcontext
+def export_command(user_id, fmt, compress, output):
+    """Export a user's messages, likes, followers and following."""
+
+    if not User.query.get(user_id):
+        click.echo(f"No user #{user_id}", err=True)
+        sys.exit(1)
+
+    for chunk in export_user(user_id, fmt, compress):
+        output.write(chunk)
@@ -0,0 +1,214 @@
+"""Batched bulk import of messages and follows."""
+
+import gzip
+import json
+import sys
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+
+from authors import author_fields
+from models import db, User, Message, Follows
+from sharding import shards
+from tags import index_messages
+from versions import versions
+
+BATCH_SIZE = 250
+
+MAX_ERRORS = 100
+
+
+class InvalidRecord(ValueError):
+    """A line of an import that can't be used."""
+
+
+def parse_message(record):
+    """Validate a message record; return the row to insert (sans user_id)."""
+
+    text = record.get('text')
+    if not isinstance(text, str) or not text.strip():
+        raise InvalidRecord("message has no text")
+    if len(text) > Message.text.type.length:
+        raise InvalidRecord(f"message is over {Message.text.type.length} characters")
+
+    timestamp = record.get('timestamp')
+    if timestamp is None:
+        timestamp = datetime.utcnow()
+    else:
+        try:
+            timestamp = datetime.fromisoformat(timestamp)
+        except (TypeError, ValueError):
+            raise InvalidRecord(f"bad timestamp: {timestamp!r}")
+
+    return {'text': text, 'timestamp': timestamp}
+
+
+def parse_follow(record):
+    """Validate a follow record; return the username to follow."""
+
+    username = record.get('username')
+    if not isinstance(username, str) or not username:
+        raise InvalidRecord("follow has no username")
+
+    return username
+
+
+class Importer:
+    """Reads NDJSON records for one user and writes them in batches.
+
+    Records look like `{"type": "message", "text": ..., "timestamp": ...}`
+    or `{"type": "follow", "username": ...}`; the `following` records of an
+    export are accepted as follows, and the other exported types are
+    skipped. Each batch is one multi-row INSERT, committed on its own
+    along with the batch's hashtag and mention rows. With sharding on,
+    rows go to the user's shard, and hashtags and mentions aren't indexed.
+    """
+
+    def __init__(self, user_id, batch_size=BATCH_SIZE):
+        self.user_id = user_id
+        self.batch_size = batch_size
+        self.messages = []
+        self.follows = []
+        self.counts = {'messages': 0, 'follows': 0, 'skipped': 0}
+        self.errors = []
+
+    def run(self, lines):
+        """Import every line of `lines`; return a summary dict."""
+
+        for lineno, line in enumerate(lines, 1):
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            if not line.strip():
+                continue
+
+            try:
+                self.add(json.loads(line))
+            except (ValueError, AttributeError) as exc:
+                self.counts['skipped'] += 1
+                if len(self.errors) < MAX_ERRORS:
+                    self.errors.append({'line': lineno, 'error': str(exc)})
+
+        self.flush_messages()
+        self.flush_follows()
+
+        return dict(self.counts, errors=self.errors)
+
+    def add(self, record):
+        kind = record.get('type')
+
+        if kind == 'message':
+            self.messages.append(parse_message(record))
+            if len(self.messages) >= self.batch_size:
+                self.flush_messages()
+
+        elif kind in ('follow', 'following'):
+            self.follows.append(parse_follow(record))
+            if len(self.follows) >= self.batch_size:
+                self.flush_follows()
+
+        elif kind in ('like', 'follower'):
+            self.counts['skipped'] += 1
+
+        else:
+            raise InvalidRecord(f"unknown record type: {kind!r}")
+
+    def flush_messages(self):
+        if not self.messages:
+            return
+
+        session = shards.writer(self.user_id)
+        author = author_fields(User.query.get(self.user_id))
+        rows = [dict(row, user_id=self.user_id, **author) for row in self.messages]
+        table = Message.__table__
+
+        if shards.enabled:
+            # Shards give out the ids themselves; hashtags and mentions
+            # are only indexed in the main database.
+            for row in rows:
+                row['id'] = shards.allocate_message_id(session)
+            session.execute(table.insert().values(rows))
+            inserted = []
+        # The new ids are needed to index the batch's hashtags and mentions.
+        elif session.bind.dialect.name == 'postgresql':
+            inserted = session.execute(
+                table.insert().values(rows).returning(Message.id, Message.text)).fetchall()
+        else:
+            # No RETURNING, but SQLite holds its write lock from the insert
+            # to the commit, so the batch's ids are the range ending at the
+            # last one it was given; read them back rather than guess.
+            last = session.execute(table.insert().values(rows)).lastrowid
+            inserted = (session
+                        .query(Message.id, Message.text)
+                        .filter(Message.id.between(last - len(rows) + 1, last),
+                                Message.user_id == self.user_id)
+                        .order_by(Message.id)
+                        .all())
+
+        index_messages(inserted)
+        session.commit()
+        versions.bump(f'user:{self.user_id}')
+
+        self.counts['messages'] += len(rows)
+        self.messages = []
+
+    def flush_follows(self):
+        if not self.follows:
+            return
+
+        session = shards.writer(self.user_id)
+        usernames = set(self.follows)
+        found = dict(db.session
+                     .query(User.username, User.id)
+                     .filter(User.username.in_(usernames)))
+        already = {id for id, in (session
+                   .query(Follows.user_being_followed_id)
+                   .filter(Follows.user_following_id == self.user_id,
+                           Follows.user_being_followed_id.in_(found.values())))}
+
+        rows = [{'user_following_id': self.user_id,
+                 'user_being_followed_id': id}
+                for id in set(found.values()) - already - {self.user_id}]
+        if rows:
+            session.execute(Follows.__table__.insert().values(rows))
+            session.commit()
+            versions.bump(f'user:{self.user_id}',
+                          *(f"user:{row['user_being_followed_id']}" for row in rows))
+
+        self.counts['follows'] += len(rows)
+        self.counts['skipped'] += len(self.follows) - len(rows)
+        self.follows = []
+
+
+def import_lines(user_id, lines, batch_size=BATCH_SIZE):
+    """Import NDJSON `lines` (text or bytes) for user `user_id`."""
+
+    return Importer(user_id, batch_size).run(lines)
+
+
+def open_stream(stream, gzipped=False):
+    """Get the lines of binary `stream`, decompressing them if `gzipped`."""
+
+    if gzipped:
+        return gzip.GzipFile(fileobj=stream)
+    return stream
+
+
+@click.command('import-user')
+@click.argument('user_id', type=int)
+@click.argument('source', type=click.File('rb'))
+@click.option('--batch-size', type=int, default=BATCH_SIZE)
+@with_appcontext
+def import_command(user_id, source, batch_size):
+    """Import NDJSON messages and follows (optionally gzipped) for a user."""
+
+    if not User.query.get(user_id):
+        click.echo(f"No user #{user_id}", err=True)
+        sys.exit(1)
+
+    gzipped = source.name.endswith('.gz')
+    summary = import_lines(user_id, open_stream(source, gzipped), batch_size)
+
+    for error in summary.pop('errors'):
+        click.echo(f"line {error['line']}: {error['error']}", err=True)
+    click.echo(", ".join(f"{k}: {v}" for k, v in summary.items()))
@@ -0,0 +1,309 @@
+"""Durable background jobs, kept in the `jobs` table.
+
+A view calls `jobs.enqueue(kind, payload)` for work it needn't wait for.
+The job row is committed along with the request's own changes, so it is
+neither lost if the process dies nor run if the request rolls back.
+
+`flask run-workers` starts a pool of worker processes. Each claims due
+jobs under a lease of `JOBS_LEASE` seconds (a crashed worker's jobs are
+claimed again once it runs out), runs them through the handler
+registered for their kind, and retries failures after `JOBS_BACKOFF`
+seconds, doubling each time, up to `JOBS_MAX_ATTEMPTS` attempts.
+
+Handlers take a list of payloads: a worker claims up to the handler's
+`batch_size` due jobs of one kind and runs them in one call, then
+commits whatever the handler changed in the main database together with
+the jobs' completion. While a job enqueued with an idempotency `key` is
+waiting to run, enqueueing another of its kind with the same key does
+nothing; the key is released when a worker claims the job, so a change
+made while it runs queues a fresh one. Done jobs are deleted
+`JOBS_RETENTION` seconds later.
+"""
+
+import json
+import multiprocessing
+import os
+import random
+import signal
+import time
+import uuid
+from collections import Counter, namedtuple
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy.dialects import postgresql
+
+from models import db, Job
+
+Handler = namedtuple('Handler', 'function batch_size')
+
+
+class Jobs:
+    """Registry of job handlers, and the queue operations on `jobs`."""
+
+    def __init__(self):
+        self.handlers = {}
+        self.stats = Counter()
+
+    def init_app(self, app):
+        app.config.setdefault('JOBS_WORKERS', os.cpu_count() or 1)
+        app.config.setdefault('JOBS_MAX_ATTEMPTS', 5)
+        app.config.setdefault('JOBS_BACKOFF', 10)
+        app.config.setdefault('JOBS_LEASE', 300)
+        app.config.setdefault('JOBS_POLL_INTERVAL', 1)
+        app.config.setdefault('JOBS_RETENTION', 24 * 60 * 60)
+        self.config = app.config
+
+    def handler(self, kind, batch_size=1):
+        """Register the decorated `function(payloads)` to run jobs of `kind`."""
+
+        def register(function):
+            self.handlers[kind] = Handler(function, batch_size)
+            return function
+        return register
+
+    def enqueue(self, kind, payload, key=None, delay=0):
+        """Add a job to `db.session`; the caller commits.
+
+        `payload` must be JSON-serializable. Returns False, adding
+        nothing, when a job of `kind` with this `key` is waiting to run.
+        """
+
+        now = datetime.utcnow()
+        values = dict(kind=kind, key=key, payload=json.dumps(payload),
+                      state='queued', attempts=0, created_at=now,
+                      run_at=now + timedelta(seconds=delay))
+        table = Job.__table__
+
+        if key is None:
+            statement = table.insert().values(values)
+        elif db.engine.dialect.name == 'postgresql':
+            statement = (postgresql.insert(table).values(values)
+                         .on_conflict_do_nothing(index_elements=['kind', 'key']))
+        elif db.engine.dialect.name == 'sqlite':
+            statement = table.insert().values(values).prefix_with('OR IGNORE')
+        elif db.session.query(Job.id).filter_by(kind=kind, key=key).first():
+            return False
+        else:
+            statement = table.insert().values(values)
+
+        added = db.session.execute(statement).rowcount == 1
+        self.stats['enqueued' if added else 'duplicates'] += 1
+        return added
+
+    def due(self, now):
+        return db.or_(db.and_(Job.state == 'queued', Job.run_at <= now),
+                      db.and_(Job.state == 'running', Job.locked_until < now))
+
+    def claim(self):
+        """Lease a batch of due jobs of one kind; returns (kind, token, jobs).
+
+        `jobs` is a list of (id, payload, attempts) tuples, empty when
+        nothing is due.
+        """
+
+        now = datetime.utcnow()
+        due = self.due(now)
+        token = uuid.uuid4().hex
+
+        first = (db.session
+                 .query(Job.kind)
+                 .filter(due, Job.kind.in_(self.handlers))
+                 .order_by(Job.run_at)
+                 .first())
+        if first is None:
+            db.session.commit()
+            return None, token, []
+
+        kind, = first
+        ids = [id for id, in (db.session
+                              .query(Job.id)
+                              .filter(due, Job.kind == kind)
+                              .order_by(Job.run_at)
+                              .limit(self.handlers[kind].batch_size)
+                              .with_for_update(skip_locked=True))]
+        if not ids:
+            db.session.commit()
+            return kind, token, []
+
+        # Re-checking `due` keeps two workers from taking the same job on
+        # databases that ignore FOR UPDATE (SQLite serializes the UPDATEs).
+        (Job.query
+         .filter(Job.id.in_(ids), due)
+         .update({'state': 'running',
+                  'key': None,
+                  'locked_by': token,
+                  'locked_until': now + timedelta(seconds=self.config['JOBS_LEASE']),
+                  'attempts': Job.attempts + 1},
+                 synchronize_session=False))
+        db.session.commit()
+
+        claimed = (db.session
+                   .query(Job.id, Job.payload, Job.attempts)
+                   .filter(Job.locked_by == token)
+                   .order_by(Job.id)
+                   .all())
+        self.stats['claimed'] += len(claimed)
+        return kind, token, claimed
+
+    def run_batch(self, kind, token, claimed):
+        """Run claimed jobs; mark them done, or schedule their retries."""
+
+        ids = [id for id, payload, attempts in claimed]
+
+        try:
+            self.handlers[kind].function([json.loads(payload)
+                                          for id, payload, attempts in claimed])
+        except Exception as exc:
+            db.session.rollback()
+            current_app.logger.exception("Jobs %s of kind %r failed", ids, kind)
+            self.retry(token, claimed, exc)
+            return False
+
+        try:
+            (Job.query
+             .filter(Job.id.in_(ids), Job.locked_by == token)
+             .update({'state': 'done', 'locked_until': None,
+                      'finished_at': datetime.utcnow()},
+                     synchronize_session=False))
+            db.session.commit()
+        except Exception:
+            # The handler's changes are rolled back with the jobs' completion;
+            # the jobs are claimed again once their lease runs out.
+            db.session.rollback()
+            current_app.logger.exception("Finishing jobs %s of kind %r failed", ids, kind)
+            self.stats['unfinished'] += len(ids)
+            return False
+
+        self.stats['done'] += len(ids)
+        return True
+
+    def retry(self, token, claimed, exc):
+        now = datetime.utcnow()
+        error = f"{type(exc).__name__}: {exc}"
+
+        for id, payload, attempts in claimed:
+            if attempts >= self.config['JOBS_MAX_ATTEMPTS']:
+                values = {'state': 'failed', 'finished_at': now}
+                self.stats['failed'] += 1
+            else:
+                delay = self.config['JOBS_BACKOFF'] * 2 ** (attempts - 1)
+                values = {'state': 'queued',
+                          'run_at': now + timedelta(seconds=delay * random.uniform(1, 1.25))}
+                self.stats['retried'] += 1
+
+            (Job.query
+             .filter(Job.id == id, Job.locked_by == token)
+             .update(dict(values, error=error, locked_until=None),
+                     synchronize_session=False))
+
+        db.session.commit()
+
+    def run_pending(self, limit=None):
+        """Run due jobs in this process until none are left; return how many ran."""
+
+        ran = 0
+        while limit is None or ran < limit:
+            kind, token, claimed = self.claim()
+            if not claimed:
+                break
+            self.run_batch(kind, token, claimed)
+            ran += len(claimed)
+        return ran
+
+    def prune(self):
+        """Delete jobs that finished more than `JOBS_RETENTION` seconds ago.
+
+        Failed jobs are kept for inspection.
+        """
+
+        cutoff = datetime.utcnow() - timedelta(seconds=self.config['JOBS_RETENTION'])
+        deleted = (Job.query
+                   .filter(Job.state == 'done', Job.finished_at < cutoff)
+                   .delete(synchronize_session=False))
+        db.session.commit()
+        return deleted
+
+    def work(self, stop, prune_every=60):
+        """Run jobs as they come due until `stop` is set."""
+
+        pruned_at = time.monotonic()
+
+        while not stop.is_set():
+            try:
+                kind, token, claimed = self.claim()
+            except Exception:
+                # e.g. the database is down, or (SQLite) another worker
+                # won the race to write; try again after a pause.
+                db.session.rollback()
+                current_app.logger.exception("Claiming jobs failed")
+                claimed = []
+
+            if claimed:
+                try:
+                    self.run_batch(kind, token, claimed)
+                except Exception:
+                    # e.g. scheduling the retries failed; the lease runs out.
+                    db.session.rollback()
+                    current_app.logger.exception("Running jobs of kind %r failed", kind)
+            else:
+                stop.wait(self.config['JOBS_POLL_INTERVAL'])
+
+            if time.monotonic() - pruned_at > prune_every:
+                pruned_at = time.monotonic()
+                try:
+                    self.prune()
+                except Exception:
+                    db.session.rollback()
+                    current_app.logger.exception("Pruning jobs failed")
+
+
+jobs = Jobs()
+
+
+def run_worker(app, stop):
+    """Body of a worker process."""
+
+    # Ctrl-C reaches the whole process group; let the parent tell us to stop.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    with app.app_context():
+        # Don't share the parent's pooled connections.
+        db.engine.dispose()
+        jobs.work(stop)
+
+
+@click.command('run-workers')
+@click.option('--processes', type=int, default=None,
+              help="Worker processes (default: JOBS_WORKERS).")
+@click.option('--burst', is_flag=True,
+              help="Run the jobs due now in this process, then exit.")
+@with_appcontext
+def run_workers_command(processes, burst):
+    """Run background jobs until interrupted."""
+
+    if burst:
+        click.echo(f"Ran {jobs.run_pending()} jobs.")
+        return
+
+    app = current_app._get_current_object()
+    processes = processes or app.config['JOBS_WORKERS']
+    context = multiprocessing.get_context('fork')
+    stop = context.Event()
+
+    workers = [context.Process(target=run_worker, args=(app, stop), name=f'jobs-{i}')
+               for i in range(processes)]
+    for worker in workers:
+        worker.start()
+
+    def shut_down(signum, frame):
+        stop.set()
+
+    signal.signal(signal.SIGINT, shut_down)
+    signal.signal(signal.SIGTERM, shut_down)
+    click.echo(f"Started {processes} workers; Ctrl-C finishes their batches and stops.")
+
+    for worker in workers:
+        worker.join()
@@ -0,0 +1,199 @@
+"""Rate limiting and admission control for Warbler."""
+
+import threading
+import time
+from collections import Counter, OrderedDict
+from functools import wraps
+
+from flask import Response, request
+
+
+class MemoryStore:
+    """Token buckets kept in this process's memory.
+
+    At most `MAX_KEYS` buckets are kept; past that the least recently
+    used one, which has been idle longest and so is likely full again,
+    is dropped. Any other backend only has to provide
+    `take(keys, rate, capacity)`, and do it atomically, to be shared
+    between workers.
+    """
+
+    MAX_KEYS = 100000
+
+    def __init__(self):
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, keys, rate, capacity):
+        """Take one token from each bucket in `keys` if all have one.
+
+        Returns whether they did; when any bucket is empty, none is
+        drawn from.
+        """
+
+        now = time.monotonic()
+
+        with self._lock:
+            buckets = {}
+            for key in keys:
+                tokens, stamp = self._buckets.get(key, (capacity, now))
+                buckets[key] = min(capacity, tokens + (now - stamp) * rate)
+            allowed = all(tokens >= 1 for tokens in buckets.values())
+            for key, tokens in buckets.items():
+                self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+                self._buckets.move_to_end(key)
+
+            while len(self._buckets) > self.MAX_KEYS:
+                self._buckets.popitem(last=False)
+
+        return allowed
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class RedisStore:
+    """Token buckets shared between workers through a Redis client.
+
+    Pass in an existing client (e.g. `redis.Redis.from_url(...)`); the
+    bucket update runs as a single Lua script so it is atomic.
+    """
+
+    SCRIPT = """
+    local rate = tonumber(ARGV[1])
+    local capacity = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local levels = {}
+    local allowed = 1
+    for i, key in ipairs(KEYS) do
+        local bucket = redis.call('HMGET', key, 'tokens', 'stamp')
+        local tokens = tonumber(bucket[1]) or capacity
+        local stamp = tonumber(bucket[2]) or now
+        levels[i] = math.min(capacity, tokens + (now - stamp) * rate)
+        if levels[i] < 1 then
+            allowed = 0
+        end
+    end
+    for i, key in ipairs(KEYS) do
+        redis.call('HSET', key, 'tokens', levels[i] - allowed, 'stamp', now)
+        redis.call('EXPIRE', key, math.ceil(capacity / rate) + 1)
+    end
+    return allowed
+    """
+
+    def __init__(self, client, prefix="warbler:rl:"):
+        self.client = client
+        self.prefix = prefix
+        self._take = client.register_script(self.SCRIPT)
+
+    def take(self, keys, rate, capacity):
+        return bool(self._take(keys=[self.prefix + key for key in keys],
+                               args=[rate, capacity, time.time()]))
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+
+class Limiter:
+    """Per-IP and per-user token buckets, plus concurrency caps.
+
+    Rules are configured in `RATELIMIT_RULES` as
+    `{name: (requests, per_seconds)}` and concurrency caps in
+    `RATELIMIT_CONCURRENCY` as `{name: max_in_flight}`.
+    """
+
+    def __init__(self, identity=None, store=None):
+        self.identity = identity or (lambda: None)
+        self.store = store or MemoryStore()
+        self.rejected = Counter()
+        self.enabled = True
+        self.rules = {}
+        self._semaphores = {}
+
+    def init_app(self, app):
+        app.config.setdefault('RATELIMIT_ENABLED', True)
+        app.config.setdefault('RATELIMIT_RULES', {})
+        app.config.setdefault('RATELIMIT_CONCURRENCY', {})
+
+        self.enabled = app.config['RATELIMIT_ENABLED']
+        self.rules = dict(app.config['RATELIMIT_RULES'])
+        self._semaphores = {
+            name: threading.BoundedSemaphore(size)
+            for name, size in app.config['RATELIMIT_CONCURRENCY'].items()
+        }
+
+        if app.config.get('RATELIMIT_STORE') is not None:
+            self.store = app.config['RATELIMIT_STORE']
+
+    def reject(self, name, retry_after=1):
+        """Count a rejection and build the (cheap, template-free) 429."""
+
+        self.rejected[name] += 1
+        return Response("Too many requests, slow down.\n", 429,
+                        {'Retry-After': str(retry_after),
+                         'Content-Type': 'text/plain'})
+
+    def allow(self, name):
+        """Check and consume tokens for rule `name` for this client.
+
+        The IP's and the user's buckets are drawn from together, so a
+        request one of them turns away costs the other nothing.
+        """
+
+        requests, per = self.rules[name]
+        rate = requests / per
+
+        keys = [f"{name}:ip:{request.remote_addr}"]
+        user_id = self.identity()
+        if user_id is not None:
+            keys.append(f"{name}:user:{user_id}")
+
+        return self.store.take(keys, rate, requests)
+
+    def limit(self, name, methods=None, when=None):
+        """Decorate a view to apply rate limit rule `name`.
+
+        Only requests whose method is in `methods` (default: all) and, if
+        given, for which `when()` is true, are counted.
+        """
+
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if (self.enabled
+                        and name in self.rules
+                        and (methods is None or request.method in methods)
+                        and (when is None or when())
+                        and not self.allow(name)):
+                    requests, per = self.rules[name]
+                    return self.reject(name, retry_after=max(1, int(per / requests)))
+
+                return view(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def concurrency(self, name, methods=None):
+        """Decorate a view so at most N requests of pool `name` run at once.
+
+        Requests over the cap are rejected right away rather than queued.
+        """
+
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                semaphore = self._semaphores.get(name)
+                if (not self.enabled
+                        or semaphore is None
+                        or (methods is not None and request.method not in methods)):
+                    return view(*args, **kwargs)
+
+                if not semaphore.acquire(blocking=False):
+                    return self.reject(name)
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    semaphore.release()
+            return wrapper
+        return decorator
@@ -0,0 +1,143 @@
+"""Live timeline updates: an in-process message broker and SSE stream.
+
+Each open stream waits on a shared condition variable rather than a queue
+of its own, and holds no database connection while it waits. Under a
+green-thread worker (`gunicorn -k gevent app:app`) an idle stream then
+costs a greenlet, not an OS thread.
+
+The broker only sees messages posted through this process, so streams
+also re-check the database every `heartbeat` seconds; messages posted on
+another worker show up within that delay.
+
+Streams pick up where they left off by message id, which only grows
+within one shard, so live updates are off while sharding is on.
+"""
+
+import json
+import threading
+import time
+from collections import deque
+
+from models import db, Message, Follows
+from sharding import shards
+
+
+class Broker:
+    """Fan-out of (author_id, message_id) events to waiting streams."""
+
+    def __init__(self, backlog=1000):
+        self._events = deque(maxlen=backlog)
+        self._seq = 0
+        self._cond = threading.Condition()
+        self.streams = 0
+
+    @property
+    def seq(self):
+        return self._seq
+
+    def open_stream(self, limit):
+        """Count a new stream in; return False if `limit` are already open."""
+
+        with self._cond:
+            if self.streams >= limit:
+                return False
+            self.streams += 1
+            return True
+
+    def close_stream(self):
+        with self._cond:
+            self.streams -= 1
+
+    def publish(self, author_id, message_id):
+        with self._cond:
+            self._seq += 1
+            self._events.append((self._seq, author_id, message_id))
+            self._cond.notify_all()
+
+    def wait(self, after_seq, timeout):
+        """Wait up to `timeout` for events after `after_seq`.
+
+        Returns `(seq, events)`, where `events` is a list of
+        `(author_id, message_id)` pairs.
+        """
+
+        with self._cond:
+            if self._seq == after_seq:
+                self._cond.wait(timeout)
+
+            events = [(author, msg) for seq, author, msg in self._events
+                      if seq > after_seq]
+            return self._seq, events
+
+
+broker = Broker()
+
+
+def followed_ids(user_id):
+    """Ids of the authors on `user_id`'s timeline (followed users and self)."""
+
+    ids = shards.following_ids(user_id)
+    ids.add(user_id)
+    return ids
+
+
+def new_message_ids(user_id, since_id, limit=100):
+    """Ids of timeline messages for `user_id` newer than `since_id`."""
+
+    following = (db.session
+                 .query(Follows.user_being_followed_id)
+                 .filter(Follows.user_following_id == user_id))
+
+    rows = (db.session
+            .query(Message.id)
+            .filter(Message.id > since_id,
+                    db.or_(Message.user_id == user_id,
+                           Message.user_id.in_(following)))
+            .order_by(Message.id.desc())
+            .limit(limit))
+
+    return [id for id, in rows]
+
+
+def sse(event, data, id=None):
+    lines = f"id: {id}\n" if id is not None else ""
+    return f"{lines}event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def timeline_events(app, user_id, since_id, authors, heartbeat=15, lifetime=300):
+    """Yield server-sent events with ids of new timeline messages.
+
+    Runs outside the request context; the database is only touched in
+    short app contexts, so no connection is held between checks, which
+    also re-read `authors` so follows made meanwhile are picked up. The
+    stream ends after `lifetime` seconds and the browser reconnects;
+    each event's id is the newest message id announced, which the
+    browser sends back as `Last-Event-ID` so the stream resumes after it.
+
+    The caller counts the stream in with `broker.open_stream`, and out
+    with `broker.close_stream` once the response is closed.
+    """
+
+    newest = since_id
+    seq = broker.seq
+    deadline = time.monotonic() + lifetime
+    last_check = time.monotonic()
+
+    yield "retry: 5000\n\n"
+
+    while time.monotonic() < deadline:
+        seq, events = broker.wait(seq, heartbeat)
+        ids = [msg for author, msg in events
+               if author in authors and msg > newest]
+
+        if not ids and time.monotonic() - last_check >= heartbeat:
+            with app.app_context():
+                ids = new_message_ids(user_id, newest)
+                authors = followed_ids(user_id)
+            last_check = time.monotonic()
+
+        if ids:
+            newest = max(ids)
+            yield sse('warbles', {'ids': sorted(ids), 'newest': newest}, id=newest)
+        else:
+            yield ": ping\n\n"
@@ -1,12 +1,96 @@
 """SQLAlchemy models for Warbler."""
 
+import sqlite3
+import struct
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+
+
+class Database(SQLAlchemy):
+    """Flask-SQLAlchemy, plus the settings for running on a SQLite file.
+
+    With `DATABASE_URL=sqlite:///warbler.db`, Warbler runs embedded, and
+    every connection gets the `SQLITE_PRAGMAS` below (WAL journaling, so
+    readers don't block the writer; foreign keys on, so ON DELETE CASCADE
+    works as on Postgres). Connections are pooled like any other
+    database's: up to `SQLITE_POOL_SIZE` are kept open, and threads
+    beyond that (parallel queries, shard scatters, live streams, the
+    version bus) get extra ones, closed when they're returned, rather
+    than another thread's connection being closed under it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sqlite_pragmas = {}
+
+    def init_app(self, app):
+        app.config.setdefault('SQLITE_PRAGMAS', {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'foreign_keys': 'ON',
+            'busy_timeout': 5000,
+            'mmap_size': 256 * 1024 * 1024,
+            'cache_size': -64 * 1024,
+            'temp_store': 'MEMORY',
+        })
+        app.config.setdefault('SQLITE_POOL_SIZE', 64)
+        super().init_app(app)
+
+    def apply_driver_hacks(self, app, info, options):
+        rv = super().apply_driver_hacks(app, info, options)
+
+        if info.drivername == 'sqlite':
+            self.sqlite_pragmas = app.config['SQLITE_PRAGMAS']
+            if info.database not in (None, '', ':memory:'):
+                options['poolclass'] = QueuePool
+                options['pool_size'] = app.config['SQLITE_POOL_SIZE']
+                options['max_overflow'] = -1
+                # Pooled connections move between threads.
+                options.setdefault('connect_args', {})['check_same_thread'] = False
+
+        return rv
+
+    def _execute_for_all_tables(self, app, bind, operation, skip_tables=False):
+        # create_all/drop_all run on one pooled connection; other SQLite
+        # connections (the session's among them) can go on compiling
+        # against the schema from before it, so none are kept.
+        self.session.remove()
+        super()._execute_for_all_tables(app, bind, operation, skip_tables)
+
+        app = self.get_app(app)
+        if bind == '__all__':
+            binds = [None] + list(app.config.get('SQLALCHEMY_BINDS') or ())
+        elif isinstance(bind, str) or bind is None:
+            binds = [bind]
+        else:
+            binds = bind
+        for bind in binds:
+            engine = self.get_engine(app, bind)
+            if engine.dialect.name == 'sqlite':
+                engine.dispose()
+
+
+db = Database()
+
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Apply `db.sqlite_pragmas` to each new SQLite connection."""
+
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+
+    cursor = dbapi_connection.cursor()
+    for name, value in db.sqlite_pragmas.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
 
 
 class Follows(db.Model):
@@ -121,15 +205,46 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
+        found_user_list = [user for user in self.followers if user.id == other_user.id]
         return len(found_user_list) == 1
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
+        found_user_list = [user for user in self.following if user.id == other_user.id]
         return len(found_user_list) == 1
 
+    def counts(self):
+        """Get this user's message/following/followers/likes counts."""
+
+        return self.counts_for(self.id)
+
+    @classmethod
+    def counts_for(cls, user_id):
+        """Get a user's message/following/followers/likes counts by id.
+
+        One round trip of COUNT subqueries, rather than loading each
+        whole relationship just to take its length. Takes an id, not a
+        `User`, so it can run on another thread (and session).
+        """
+
+        def count(column, value):
+            return (db.select([db.func.count()])
+                    .where(column == value)
+                    .as_scalar())
+
+        # Messages and likes in the cold tier (see archive.py) count too.
+        row = db.session.query(
+            (count(Message.user_id, user_id)
+             + count(ArchivedMessage.user_id, user_id)).label('messages'),
+            count(Follows.user_following_id, user_id).label('following'),
+            count(Follows.user_being_followed_id, user_id).label('followers'),
+            (count(Likes.user_id, user_id)
+             + count(ArchivedLike.user_id, user_id)).label('likes'),
+        ).one()
+
+        return row._asdict()
+
     @classmethod
     def signup(cls, username, email, password, image_url):
         """Sign up user.
@@ -197,9 +312,350 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Copies of the author's username and avatar, for rendering message
+    # lists without loading `user` (see authors.py).
+    author_username = db.Column(
+        db.Text,
+    )
+
+    author_image_url = db.Column(
+        db.Text,
+    )
+
+    user = db.relationship('User')
+
+
+class ArchivedMessage(db.Model):
+    """A message moved to the cold tier (see archive.py)."""
+
+    __tablename__ = 'messages_archive'
+
+    __table_args__ = (
+        db.Index('ix_messages_archive_user_timestamp', 'user_id', 'timestamp'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    text = db.Column(
+        db.String(140),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        index=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    author_username = db.Column(
+        db.Text,
+    )
+
+    author_image_url = db.Column(
+        db.Text,
+    )
+
     user = db.relationship('User')
 
 
+class ArchivedLike(db.Model):
+    """A like of an archived message."""
+
+    __tablename__ = 'likes_archive'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages_archive.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+
+class MessageTag(db.Model):
+    """A hashtag used in a message (stored lowercased, without the '#')."""
+
+    __tablename__ = 'message_tags'
+
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+
+class Mention(db.Model):
+    """A user @-mentioned in a message."""
+
+    __tablename__ = 'mentions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+
+class ArchivedMessageTag(db.Model):
+    """A hashtag used in an archived message."""
+
+    __tablename__ = 'message_tags_archive'
+
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages_archive.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+
+class ArchivedMention(db.Model):
+    """A user @-mentioned in an archived message."""
+
+    __tablename__ = 'mentions_archive'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages_archive.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+
+class ShardAssignment(db.Model):
+    """Which shard holds a user's messages, likes and follows (see sharding.py)."""
+
+    __tablename__ = 'shard_directory'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    shard = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    moving = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+    )
+
+
+class UserDailyStats(db.Model):
+    """One user's activity on one day (see analytics.py)."""
+
+    __tablename__ = 'user_daily_stats'
+
+    day = db.Column(
+        db.Date,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    messages = db.Column(db.Integer, nullable=False, default=0)
+
+    likes_given = db.Column(db.Integer, nullable=False, default=0)
+
+    likes_received = db.Column(db.Integer, nullable=False, default=0)
+
+    followers = db.Column(db.Integer, nullable=False, default=0)
+
+    follower_growth = db.Column(db.Integer, nullable=False, default=0)
+
+    # Messages posted in each hour of the day, as 24 little-endian uint32s.
+    hourly = db.Column(
+        db.LargeBinary,
+        nullable=False,
+    )
+
+    def hours(self):
+        """Messages posted in each hour (UTC) of the day, as a list of 24."""
+
+        return list(struct.unpack('<24I', self.hourly))
+
+
+class Job(db.Model):
+    """A unit of background work (see jobs.py)."""
+
+    __tablename__ = 'jobs'
+
+    __table_args__ = (
+        db.UniqueConstraint('kind', 'key'),
+        db.Index('ix_jobs_due', 'state', 'run_at'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # Idempotency key: at most one waiting job per (kind, key).
+    key = db.Column(
+        db.Text,
+    )
+
+    payload = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # queued, running, done or failed
+    state = db.Column(
+        db.Text,
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    locked_by = db.Column(
+        db.Text,
+    )
+
+    locked_until = db.Column(
+        db.DateTime,
+    )
+
+    error = db.Column(
+        db.Text,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+
+class VersionBump(db.Model):
+    """Version names bumped by one process, for the others (see bus.py)."""
+
+    __tablename__ = 'version_bumps'
+
+    # Readers track the highest id seen, so ids must never be reused.
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # Space-separated version names, e.g. "user:1 message:7".
+    names = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    origin = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # Seconds since the epoch, for measuring propagation lag.
+    sent_at = db.Column(
+        db.Float,
+        nullable=False,
+        index=True,
+    )
+
+
+class BusListener(db.Model):
+    """A process applying version bumps, and how far behind it is."""
+
+    __tablename__ = 'bus_listeners'
+
+    origin = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    last_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    applied = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    lag_p50_ms = db.Column(
+        db.Float,
+    )
+
+    lag_max_ms = db.Column(
+        db.Float,
+    )
+
+    seen_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -0,0 +1,119 @@
+"""Full-page cache for logged-out visitors.
+
+Pages marked with `page_cache.cached` are the same for every anonymous
+visitor, so their rendered HTML is kept in memory and served from a
+`before_request` hook that runs before `add_user_to_g`, without touching
+the database.
+
+An entry is dropped when it is older than `PAGE_CACHE_TTL` seconds, or
+when any version stamp the page declared with `page_cache.depends` has
+moved on (see versions.py). The cache holds at most
+`PAGE_CACHE_MAX_ENTRIES` pages, least recently used first out.
+"""
+
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from flask import Response, g, request, session
+
+from versions import versions
+
+
+class PageCache:
+    """LRU cache of anonymous GET responses, with a TTL."""
+
+    def __init__(self, identity):
+        self.identity = identity
+        self.enabled = False
+        self.endpoints = set()
+        self.entries = OrderedDict()
+        self.stats = Counter()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Register the hooks; call this before any hook that queries."""
+
+        app.config.setdefault('PAGE_CACHE_ENABLED', True)
+        app.config.setdefault('PAGE_CACHE_TTL', 60)
+        app.config.setdefault('PAGE_CACHE_MAX_ENTRIES', 2000)
+
+        self.config = app.config
+        self.enabled = app.config['PAGE_CACHE_ENABLED']
+
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+    def cached(self, view):
+        """Mark a view's anonymous responses as cacheable."""
+
+        self.endpoints.add(view.__name__)
+        return view
+
+    def depends(self, *names):
+        """Note that the page being rendered shows data versioned as `names`."""
+
+        deps = g.get('page_cache_deps')
+        if deps is not None:
+            deps.update(zip(names, versions.stamp(*names)))
+
+    def cacheable(self):
+        return (self.enabled
+                and request.method == 'GET'
+                and request.endpoint in self.endpoints
+                and self.identity() is None
+                and not session.get('_flashes'))
+
+    def before_request(self):
+        if not self.cacheable():
+            return None
+
+        key = request.full_path
+
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+
+        if entry is not None:
+            expires, body, mimetype, deps = entry
+            if time.monotonic() > expires:
+                self.stats['expired'] += 1
+            elif versions.stamp(*deps) != tuple(deps.values()):
+                self.stats['invalidated'] += 1
+            else:
+                self.stats['hits'] += 1
+                response = Response(body, mimetype=mimetype)
+                response.headers['X-Page-Cache'] = 'HIT'
+                return response
+
+        self.stats['misses'] += 1
+        g.page_cache_key = key
+        g.page_cache_deps = {}
+        return None
+
+    def after_request(self, response):
+        key = g.get('page_cache_key')
+
+        if (key is None
+                or response.status_code != 200
+                or response.is_streamed
+                or session.modified):
+            return response
+
+        entry = (time.monotonic() + self.config['PAGE_CACHE_TTL'],
+                 response.get_data(), response.mimetype, g.page_cache_deps)
+
+        with self._lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.config['PAGE_CACHE_MAX_ENTRIES']:
+                self.entries.popitem(last=False)
+
+        self.stats['stores'] += 1
+        response.headers['X-Page-Cache'] = 'MISS'
+        return response
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
@@ -0,0 +1,62 @@
+"""Keyset pagination and streamed rendering helpers for Warbler."""
+
+from flask import (Response, current_app, get_flashed_messages, request,
+                   stream_with_context, url_for)
+
+
+def keyset_page(query, column, after=None, per_page=50, descending=False):
+    """Get one page of `query`, ordered by the unique `column`.
+
+    `after` is the cursor from the previous page (the value of `column` on
+    its last row). Returns `(items, next_cursor)`; `next_cursor` is None on
+    the last page.
+
+    Unlike OFFSET, this stays an index range scan however deep the page is.
+    """
+
+    if after is not None:
+        query = query.filter(column < after if descending else column > after)
+
+    items = (query
+             .order_by(column.desc() if descending else column)
+             .limit(per_page + 1)
+             .all())
+
+    if len(items) <= per_page:
+        return items, None
+
+    items = items[:per_page]
+    return items, getattr(items[-1], column.key)
+
+
+def next_page_url(cursor):
+    """URL for the same page as this request, continuing after `cursor`."""
+
+    if cursor is None:
+        return None
+
+    args = request.args.to_dict()
+    args.update(request.view_args or {})
+    args['after'] = cursor
+    return url_for(request.endpoint, **args)
+
+
+def stream_template(template_name, **context):
+    """Render `template_name` as a streamed response.
+
+    The first chunks go out while later parts of the template (and any
+    lazy query results it iterates) are still being produced.
+    """
+
+    app = current_app._get_current_object()
+
+    # Flashes are popped from the session while rendering, but a streamed
+    # body is rendered after the session cookie is sent; fetch them now
+    # so the pop is saved and the template reads them from the cache.
+    get_flashed_messages(with_categories=True)
+
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(app.config.get('TEMPLATE_STREAM_BUFFER', 5))
+
+    return Response(stream_with_context(stream), mimetype='text/html')
@@ -0,0 +1,122 @@
+"""Running a page's independent queries at the same time.
+
+`queries.gather(name=function, ...)` calls each function and returns
+their results by name. The first runs in the calling thread; the rest
+run at the same time in a thread pool, each in an app context of its
+own, and so with its own session and connection. A page made of
+independent queries then takes about as long as the slowest of them,
+not their sum.
+
+Functions run in the pool should return plain values, or instances
+that are fully loaded: their session is closed when they finish, so
+lazy loads on what they return would fail. Pool threads' own calls to
+`gather` run inline, so parts can't deadlock waiting for pool threads.
+
+Every part's duration and start (relative to its gather) are sent in a
+`Server-Timing` header, alongside each gather's wall time, so the
+overlap shows in the browser's network panel: parts that overlapped add
+up to more than their gather. With `PARALLEL_QUERIES` off, or on an
+in-memory SQLite database (a single connection), parts run one after
+another in the calling thread.
+"""
+
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, g
+
+from models import db
+
+
+class QueryPool:
+    """Thread pool for the independent queries of composite pages."""
+
+    def __init__(self):
+        self.enabled = False
+        self.stats = Counter()
+        self._executor = None
+        self._local = threading.local()
+
+    def init_app(self, app):
+        app.config.setdefault('PARALLEL_QUERIES', True)
+        app.config.setdefault('PARALLEL_QUERY_THREADS', 16)
+
+        self.enabled = app.config['PARALLEL_QUERIES']
+        if self.enabled:
+            self._executor = ThreadPoolExecutor(app.config['PARALLEL_QUERY_THREADS'],
+                                                thread_name_prefix='queries')
+
+        app.after_request(self.add_timing_header)
+
+    def concurrent(self):
+        url = db.engine.url
+        return (self.enabled
+                and not getattr(self._local, 'in_pool', False)
+                and not (url.drivername.startswith('sqlite')
+                         and url.database in (None, '', ':memory:')))
+
+    def gather(self, **functions):
+        """Run `functions` at the same time; return {name: result}.
+
+        An exception in any of them is raised here, once all have finished.
+        """
+
+        app = current_app._get_current_object()
+        started = time.perf_counter()
+        timings = []
+
+        def timed(name, function):
+            start = time.perf_counter()
+            try:
+                return function()
+            finally:
+                timings.append((name, start - started, time.perf_counter() - start))
+
+        def in_pool(name, function):
+            self._local.in_pool = True
+            try:
+                with app.app_context():
+                    return timed(name, function)
+            finally:
+                self._local.in_pool = False
+
+        (first, function), *rest = functions.items()
+
+        if self.concurrent():
+            futures = {name: self._executor.submit(in_pool, name, function)
+                       for name, function in rest}
+            self.stats['concurrent'] += 1
+        else:
+            futures = {}
+            self.stats['inline'] += 1
+
+        try:
+            results = {first: timed(first, function)}
+            for name, function in rest:
+                if name not in futures:
+                    results[name] = timed(name, function)
+        finally:
+            # Wait for every part, even if one failed, so none outlives the request.
+            outcomes = {name: future.exception() for name, future in futures.items()}
+
+        for name, future in futures.items():
+            if outcomes[name] is not None:
+                raise outcomes[name]
+            results[name] = future.result()
+
+        timings.append((f'gather-{first}', 0.0, time.perf_counter() - started))
+        g.setdefault('query_timings', []).extend(timings)
+        return results
+
+    def add_timing_header(self, response):
+        timings = g.get('query_timings')
+        if timings:
+            response.headers['Server-Timing'] = ', '.join(
+                f'{name};dur={duration * 1000:.1f};desc="+{offset * 1000:.1f}ms"'
+                for name, offset, duration in timings)
+        return response
+
+
+queries = QueryPool()
@@ -0,0 +1,270 @@
+"""On-demand and sampled request profiling.
+
+A request carrying a valid signed token (in the `X-Warbler-Profile`
+header or the `_profile` query param) is profiled by a stack sampler and
+its stacks written to `PROFILE_DIR` in the folded format used by
+flamegraph.pl and speedscope. Tokens are made by `flask profile-token`.
+
+With `PROFILE_SAMPLE_RATE` above zero, that fraction of all requests is
+also sampled at a lower frequency, and the stacks are aggregated per
+endpoint (`flask profile-report`). When both are off, a request pays for
+one header lookup and one random number.
+"""
+
+import fcntl
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from werkzeug.exceptions import HTTPException
+from werkzeug.wrappers import Request
+from werkzeug.wsgi import ClosingIterator
+
+HEADER = 'HTTP_X_WARBLER_PROFILE'
+
+PARAM = '_profile'
+
+
+def frame_stack(frame):
+    """Folded-format stack (root first, `;`-separated) for `frame`."""
+
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                     f":{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Sampler:
+    """Background thread sampling the stacks of registered threads."""
+
+    def __init__(self):
+        self._targets = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self, thread_id, interval):
+        """Start sampling `thread_id` every `interval` seconds."""
+
+        stacks = Counter()
+        with self._lock:
+            self._targets[thread_id] = (stacks, interval, [0.0])
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True,
+                                                name='warbler-sampler')
+                self._thread.start()
+        self._wake.set()
+        return stacks
+
+    def stop(self, thread_id):
+        with self._lock:
+            self._targets.pop(thread_id, None)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                targets = dict(self._targets)
+
+            if not targets:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+
+            now = time.perf_counter()
+            frames = sys._current_frames()
+            for thread_id, (stacks, interval, last) in targets.items():
+                if now - last[0] >= interval and thread_id in frames:
+                    stacks[frame_stack(frames[thread_id])] += 1
+                    last[0] = now
+            del frames
+
+            time.sleep(min(interval for _, interval, _ in targets.values()))
+
+
+def make_token(app, path):
+    """Signed token that turns on profiling for requests to `path`."""
+
+    return URLSafeTimedSerializer(app.config['SECRET_KEY'],
+                                  salt='warbler-profile').dumps(path)
+
+
+def check_token(app, token, path):
+    """Is `token` a current profiling token for `path`?"""
+
+    try:
+        signed_path = URLSafeTimedSerializer(
+            app.config['SECRET_KEY'], salt='warbler-profile'
+        ).loads(token, max_age=app.config['PROFILE_TOKEN_MAX_AGE'])
+    except BadSignature:
+        return False
+    return signed_path == path
+
+
+def read_folded(f):
+    stacks = Counter()
+    for line in f:
+        stack, _, count = line.rstrip().rpartition(' ')
+        stacks[stack] += int(count)
+    return stacks
+
+
+def write_folded(f, stacks):
+    for stack, count in stacks.most_common():
+        f.write(f"{stack} {count}\n")
+
+
+class ProfilerMiddleware:
+    """WSGI middleware profiling the requests that ask (or are picked) for it.
+
+    Sampling goes on until the server closes the response, so streamed
+    responses are profiled all the way through, and still streamed.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        self.sampler = Sampler()
+        self.aggregate = defaultdict(Counter)
+        self.sampled = Counter()
+        self._lock = threading.Lock()
+
+        app.config.setdefault('PROFILE_DIR', 'profiles')
+        app.config.setdefault('PROFILE_INTERVAL', 0.001)
+        app.config.setdefault('PROFILE_SAMPLE_RATE', 0)
+        app.config.setdefault('PROFILE_SAMPLE_INTERVAL', 0.01)
+        app.config.setdefault('PROFILE_FLUSH_EVERY', 100)
+        app.config.setdefault('PROFILE_TOKEN_MAX_AGE', 3600)
+
+    def __call__(self, environ, start_response):
+        token = environ.get(HEADER)
+        if token is None and PARAM + '=' in environ.get('QUERY_STRING', ''):
+            token = Request(environ).args.get(PARAM)
+
+        if token is not None and check_token(self.app, token, environ.get('PATH_INFO')):
+            return self.profiled(environ, start_response, on_demand=True)
+
+        rate = self.app.config['PROFILE_SAMPLE_RATE']
+        if rate and random.random() < rate:
+            return self.profiled(environ, start_response, on_demand=False)
+
+        return self.wsgi_app(environ, start_response)
+
+    def endpoint(self, environ):
+        try:
+            endpoint, _ = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            endpoint = None
+        return endpoint or 'unknown'
+
+    def profiled(self, environ, start_response, on_demand):
+        config = self.app.config
+        interval = config['PROFILE_INTERVAL' if on_demand else 'PROFILE_SAMPLE_INTERVAL']
+        endpoint = self.endpoint(environ)
+        thread_id = threading.get_ident()
+
+        stacks = self.sampler.start(thread_id, interval)
+        started = time.perf_counter()
+
+        def finish():
+            self.sampler.stop(thread_id)
+
+            if on_demand:
+                os.makedirs(config['PROFILE_DIR'], exist_ok=True)
+                elapsed = int((time.perf_counter() - started) * 1000)
+                name = f"{endpoint}-{time.strftime('%Y%m%d-%H%M%S')}-{elapsed}ms.folded"
+                with open(os.path.join(config['PROFILE_DIR'], name), 'w') as f:
+                    write_folded(f, stacks)
+            else:
+                self.add_samples(endpoint, stacks)
+
+        try:
+            body = self.wsgi_app(environ, start_response)
+        except BaseException:
+            self.sampler.stop(thread_id)
+            raise
+
+        return ClosingIterator(body, finish)
+
+    def add_samples(self, endpoint, stacks):
+        """Fold a sampled request into the per-endpoint totals.
+
+        Totals are flushed to `PROFILE_DIR/sampled-<endpoint>.folded` every
+        `PROFILE_FLUSH_EVERY` requests, so other processes can report them.
+        """
+
+        with self._lock:
+            self.aggregate[endpoint].update(stacks)
+            self.sampled[endpoint] += 1
+            flush = self.sampled[endpoint] % self.app.config['PROFILE_FLUSH_EVERY'] == 0
+
+        if flush:
+            self.flush(endpoint)
+
+    def flush(self, endpoint):
+        directory = self.app.config['PROFILE_DIR']
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"sampled-{endpoint}.folded")
+
+        with self._lock:
+            stacks = Counter(self.aggregate.pop(endpoint, {}))
+
+        # Other processes flush into the same file; lock it while merging.
+        with open(path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            stacks.update(read_folded(f))
+            f.seek(0)
+            f.truncate()
+            write_folded(f, stacks)
+
+
+def hot_frames(stacks, n):
+    """The `n` leaf frames with the most samples in folded `stacks`."""
+
+    leaves = Counter()
+    for stack, count in stacks.items():
+        leaves[stack.rsplit(';', 1)[-1]] += count
+    return leaves.most_common(n)
+
+
+@click.command('profile-token')
+@click.argument('path')
+@with_appcontext
+def profile_token_command(path):
+    """Print a token that profiles requests to PATH (e.g. /users/1)."""
+
+    click.echo(make_token(current_app, path))
+
+
+@click.command('profile-report')
+@click.option('-n', default=10, help="Frames to show per endpoint.")
+@with_appcontext
+def profile_report_command(n):
+    """Show the hottest frames per endpoint from sampled requests."""
+
+    directory = current_app.config['PROFILE_DIR']
+    if not os.path.isdir(directory):
+        return
+
+    for name in sorted(os.listdir(directory)):
+        if not name.startswith('sampled-'):
+            continue
+
+        with open(os.path.join(directory, name)) as f:
+            stacks = read_folded(f)
+
+        total = sum(stacks.values())
+        click.echo(f"{name[len('sampled-'):-len('.folded')]} ({total} samples)")
+        for frame, count in hot_frames(stacks, n):
+            click.echo(f"    {count / total:6.1%}  {frame}")
+        click.echo()
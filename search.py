@@ -0,0 +1,217 @@
+"""Full-text search over message text.
+
+On Postgres, `messages.search_vector` is a tsvector kept up to date by a
+trigger and indexed with GIN. On SQLite, the FTS5 table `messages_fts`
+indexes `messages.text` as an external-content table kept in sync by
+triggers. Both are created along with the `messages` table, and the
+same again for the archive's `messages_archive`, so archived messages
+stay searchable; run `flask search-index` to add them to an existing
+database. On other
+databases, search falls back to a scan for messages containing every
+word, newest first.
+"""
+
+from operator import attrgetter
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import event, text
+
+from models import db, Message, ArchivedMessage
+
+POSTGRES_DDL = [
+    "ALTER TABLE {table} ADD COLUMN IF NOT EXISTS search_vector tsvector",
+    "CREATE INDEX IF NOT EXISTS ix_{table}_search ON {table} USING GIN (search_vector)",
+    "DROP TRIGGER IF EXISTS {table}_search_update ON {table}",
+    """CREATE TRIGGER {table}_search_update
+       BEFORE INSERT OR UPDATE OF text ON {table}
+       FOR EACH ROW EXECUTE PROCEDURE
+       tsvector_update_trigger(search_vector, 'pg_catalog.english', text)""",
+]
+
+POSTGRES_BACKFILL = """
+    UPDATE {table} SET search_vector = to_tsvector('pg_catalog.english', text)
+    WHERE search_vector IS NULL
+"""
+
+SQLITE_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts
+       USING fts5(text, content='{table}', content_rowid='id')""",
+    """CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN
+         INSERT INTO {table}_fts(rowid, text) VALUES (new.id, new.text);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN
+         INSERT INTO {table}_fts({table}_fts, rowid, text) VALUES ('delete', old.id, old.text);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE OF text ON {table} BEGIN
+         INSERT INTO {table}_fts({table}_fts, rowid, text) VALUES ('delete', old.id, old.text);
+         INSERT INTO {table}_fts(rowid, text) VALUES (new.id, new.text);
+       END""",
+]
+
+SQLITE_BACKFILL = "INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')"
+
+# Only the newest this many matches of each tier are ranked.
+MAX_CANDIDATES = 1000
+
+# Each tier of messages (see archive.py) has an index of its own.
+TABLES = [Message.__table__, ArchivedMessage.__table__]
+
+
+def create_search_index(target, connection, **kw):
+    """Create the search column/table, index and triggers for `target`."""
+
+    if connection.dialect.name == 'postgresql':
+        statements = POSTGRES_DDL
+    elif connection.dialect.name == 'sqlite':
+        statements = SQLITE_DDL
+    else:
+        return
+
+    for statement in statements:
+        connection.execute(text(statement.format(table=target.name)))
+
+
+def drop_search_index(target, connection, **kw):
+    """Drop the FTS5 table (Postgres' column goes with `target`)."""
+
+    if connection.dialect.name == 'sqlite':
+        connection.execute(text(f"DROP TABLE IF EXISTS {target.name}_fts"))
+
+
+for table in TABLES:
+    event.listen(table, 'after_create', create_search_index)
+    event.listen(table, 'before_drop', drop_search_index)
+
+
+def fts5_query(q):
+    """Quote each word of `q` so FTS5 matches them all, literally."""
+
+    words = q.replace('"', ' ').split()
+    return " ".join(f'"{word}"' for word in words)
+
+
+def parse_cursor(after):
+    """(rank, id) from an `after` cursor, or None if it isn't one."""
+
+    rank, sep, id = (after or '').partition(':')
+    try:
+        return float(rank), int(id)
+    except ValueError:
+        return None
+
+
+def scan_messages(q, after, per_page):
+    """`search_messages` without an index: every word, case-insensitively."""
+
+    words = q.lower().split()
+    if not words:
+        return [], None
+
+    messages = []
+    for model in (Message, ArchivedMessage):
+        query = model.query.filter(*[db.func.lower(model.text).contains(word, autoescape=True)
+                                     for word in words])
+        if after:
+            query = query.filter(model.id < after[1])
+        messages.extend(query.order_by(model.id.desc()).limit(per_page + 1))
+    messages.sort(key=attrgetter('id'), reverse=True)
+
+    cursor = None
+    if len(messages) > per_page:
+        messages = messages[:per_page]
+        cursor = f"0.0:{messages[-1].id}"
+    return messages, cursor
+
+
+def search_messages(q, after=None, per_page=50):
+    """Messages matching `q`, best first. Returns `(messages, next_cursor)`.
+
+    Ranking reads every match it scores, so only the newest
+    `MAX_CANDIDATES` matches of each tier are ranked: a page of a common
+    word costs that many, not the whole result set. Results are ordered
+    by (rank, id), and `after` is the cursor from the previous page,
+    which keeps later pages from repeating or skipping any. A malformed
+    `after` is ignored, giving the first page.
+    """
+
+    dialect = db.session.bind.dialect.name
+    params = {'limit': per_page + 1, 'candidates': MAX_CANDIDATES}
+
+    after = parse_cursor(after)
+    if after:
+        params.update(after_rank=after[0], after_id=after[1])
+
+    if dialect == 'postgresql':
+        params['q'] = q
+        sql = """
+            SELECT id, ts_rank(search_vector, query)::float8 AS rank
+            FROM {table}, plainto_tsquery('pg_catalog.english', :q) AS query
+            WHERE search_vector @@ query
+              AND id >= (SELECT min(id) FROM (
+                    SELECT id FROM {table}
+                    WHERE search_vector @@ plainto_tsquery('pg_catalog.english', :q)
+                    ORDER BY id DESC LIMIT :candidates) AS newest)
+        """
+        if after:
+            sql += """
+              AND (ts_rank(search_vector, query)::float8 < :after_rank
+                   OR (ts_rank(search_vector, query)::float8 = :after_rank
+                       AND id < :after_id))
+            """
+        sql += " ORDER BY rank DESC, id DESC LIMIT :limit"
+
+    elif dialect == 'sqlite':
+        # bm25() is lower for better matches, so rank by its negation.
+        params['q'] = fts5_query(q)
+        if not params['q']:
+            return [], None
+        sql = """
+            SELECT rowid AS id, -bm25({table}_fts) AS rank
+            FROM {table}_fts
+            WHERE {table}_fts MATCH :q
+              AND rowid >= (SELECT min(rowid) FROM (
+                    SELECT rowid FROM {table}_fts
+                    WHERE {table}_fts MATCH :q
+                    ORDER BY rowid DESC LIMIT :candidates))
+        """
+        if after:
+            sql += """
+              AND (-bm25({table}_fts) < :after_rank
+                   OR (-bm25({table}_fts) = :after_rank AND rowid < :after_id))
+            """
+        sql += " ORDER BY rank DESC, id DESC LIMIT :limit"
+
+    else:
+        return scan_messages(q, after, per_page)
+
+    # Ids are unique across the tiers, so their hits merge into one order.
+    hits = sorted((hit for table in TABLES
+                   for hit in db.session.execute(text(sql.format(table=table.name)), params)),
+                  key=lambda hit: (hit.rank, hit.id), reverse=True)
+
+    cursor = None
+    if len(hits) > per_page:
+        hits = hits[:per_page]
+        cursor = f"{hits[-1].rank!r}:{hits[-1].id}"
+
+    ids = [hit.id for hit in hits]
+    by_id = {m.id: m for model in (Message, ArchivedMessage)
+             for m in model.query.filter(model.id.in_(ids))}
+    return [by_id[hit.id] for hit in hits if hit.id in by_id], cursor
+
+
+@click.command('search-index')
+@with_appcontext
+def search_index_command():
+    """Create the message search index and fill it from existing messages."""
+
+    with db.engine.begin() as connection:
+        for table in TABLES:
+            create_search_index(table, connection)
+            if connection.dialect.name == 'postgresql':
+                connection.execute(text(POSTGRES_BACKFILL.format(table=table.name)))
+            elif connection.dialect.name == 'sqlite':
+                connection.execute(text(SQLITE_BACKFILL.format(table=table.name)))
+
+    click.echo("Message search index is ready")
@@ -1,6 +1,7 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
+from datetime import datetime
 from app import db
 from models import User, Message, Follows
 
@@ -11,8 +12,11 @@ db.create_all()
 with open('generator/users.csv') as users:
     db.session.bulk_insert_mappings(User, DictReader(users))
 
+# Postgres would parse the timestamp strings itself, but SQLite needs datetimes.
 with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    db.session.bulk_insert_mappings(Message, (
+        dict(row, timestamp=datetime.fromisoformat(row['timestamp']))
+        for row in DictReader(messages)))
 
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follows, DictReader(follows))
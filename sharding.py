@@ -0,0 +1,616 @@
+"""Splitting messages, likes and follows across databases by user id.
+
+Users, and everything keyed by them alone (this directory, hashtags,
+search, the cold tier), stay in the main database. A user's messages, the
+likes they give and the follows they make all live on one shard, recorded
+in `shard_directory` when they sign up, so adding a shard later moves
+nobody until `flask shards rebalance` (or `move`) does.
+
+Sharding is off while `SHARDS` is empty. To turn it on, give each shard a
+Flask-SQLAlchemy bind and list the bind names in `SHARDS`, e.g.
+
+    SQLALCHEMY_BINDS = {'shard0': 'postgresql:///warbler0',
+                        'shard1': 'postgresql:///warbler1'}
+    SHARDS = ['shard0', 'shard1']
+
+then run `flask shards init` to create their tables and, for an existing
+database, `flask shards import-main` to copy its rows out. Only ever
+append to `SHARDS`: a shard's position picks its range of message ids.
+
+One user's rows are read from their shard; reads across users (a
+timeline, someone's followers) query every shard involved at once and
+merge the results. The cold tier still only sees the main database;
+hashtag, mention and search pages and live updates are off.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from heapq import merge
+from itertools import islice
+from operator import attrgetter
+
+import click
+from flask import current_app, g
+from flask.cli import with_appcontext
+from sqlalchemy import func, text
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+
+from jobs import jobs
+from models import db, Follows, Likes, Message, ShardAssignment, User
+
+# Shard N gives out message ids from [N * ID_STRIDE + 1, (N + 1) * ID_STRIDE],
+# so ids are unique across shards and survive a move unchanged.
+ID_STRIDE = 2 ** 26
+
+# The tables split by user, with the column naming each row's owner.
+SHARDED = [
+    (Message.__table__, 'user_id'),
+    (Likes.__table__, 'user_id'),
+    (Follows.__table__, 'user_following_id'),
+]
+
+# Nothing refers to a like by its id, so likes get new ids when copied
+# rather than risk clashing with the ids already on the target shard.
+RENUMBERED = {Likes.__table__: 'id'}
+
+shard_metadata = db.MetaData()
+
+
+def shard_table(table):
+    """Copy of `table` for the shards.
+
+    The copy has no foreign keys, since the rows they point at (users,
+    other users' messages) may be in another database, and message ids are
+    always given explicitly (see `Shards.allocate_message_id`).
+    """
+
+    columns = [db.Column(column.name, column.type,
+                         primary_key=column.primary_key,
+                         nullable=column.nullable,
+                         unique=column.unique,
+                         autoincrement=False if table is Message.__table__
+                         else column.autoincrement)
+               for column in table.columns]
+    copy = db.Table(table.name, shard_metadata, *columns)
+
+    for index in table.indexes:
+        db.Index(index.name, *[copy.c[column.name] for column in index.columns],
+                 unique=index.unique)
+    return copy
+
+
+for table, column in SHARDED:
+    shard_table(table)
+
+# Next message id, on shards without sequences (SQLite).
+message_ids = db.Table(
+    'message_ids', shard_metadata,
+    db.Column('next_id', db.Integer, nullable=False),
+)
+
+
+class ShardMoving(Exception):
+    """The user's rows are being moved to another shard; try again shortly."""
+
+
+class Shards:
+    """Routes each user's rows to their shard."""
+
+    def __init__(self):
+        self.names = []
+        self._executor = None
+
+    @property
+    def enabled(self):
+        return bool(self.names)
+
+    def init_app(self, app):
+        app.config.setdefault('SHARDS', [])
+        app.config.setdefault('SHARD_SCATTER_THREADS', 16)
+
+        self.configure(app.config['SHARDS'], app.config['SHARD_SCATTER_THREADS'])
+        app.teardown_appcontext(self.close_sessions)
+
+    def configure(self, names, threads=16):
+        """Use the binds `names` as the shards (none: sharding off)."""
+
+        self.names = list(names)
+        self._executor = ThreadPoolExecutor(threads) if self.names else None
+
+    def engine(self, name):
+        return db.get_engine(current_app, bind=name)
+
+    def session(self, name):
+        """This app context's session on shard `name`."""
+
+        sessions = g.setdefault('shard_sessions', {})
+        if name not in sessions:
+            sessions[name] = Session(bind=self.engine(name))
+        return sessions[name]
+
+    def close_sessions(self, exc):
+        for session in g.pop('shard_sessions', {}).values():
+            session.close()
+
+    ##########################################################################
+    # Placement
+
+    def default_shard(self, user_id):
+        return self.names[user_id % len(self.names)]
+
+    def assignments(self, user_ids):
+        """`{user_id: shard}` for `user_ids`, remembered for the app context."""
+
+        known = g.setdefault('shard_assignments', {})
+        missing = set(user_ids) - set(known)
+
+        if missing:
+            known.update(db.session
+                         .query(ShardAssignment.user_id, ShardAssignment.shard)
+                         .filter(ShardAssignment.user_id.in_(missing)))
+            for user_id in missing - set(known):
+                known[user_id] = self.default_shard(user_id)
+
+        return {user_id: known[user_id] for user_id in user_ids}
+
+    def place(self, user_id):
+        """Pin a new user to a shard; the caller commits."""
+
+        if self.enabled:
+            db.session.add(ShardAssignment(user_id=user_id,
+                                           shard=self.default_shard(user_id)))
+
+    def reader(self, user_id):
+        """Session for reading `user_id`'s messages, likes and follows."""
+
+        if not self.enabled:
+            return db.session
+        return self.session(self.assignments([user_id])[user_id])
+
+    def writer(self, user_id):
+        """Session for changing `user_id`'s rows.
+
+        Raises ShardMoving while their rows are being moved, so nothing
+        is written to the shard they're leaving.
+        """
+
+        if not self.enabled:
+            return db.session
+
+        assignment = ShardAssignment.query.get(user_id)
+        if assignment is not None and assignment.moving:
+            raise ShardMoving(user_id)
+        return self.session(assignment.shard if assignment
+                            else self.default_shard(user_id))
+
+    def allocate_message_id(self, session):
+        """A new message id from `session`'s shard, or None when unsharded."""
+
+        if not self.enabled:
+            return None
+
+        if session.bind.dialect.name == 'postgresql':
+            return session.execute(text("SELECT nextval('message_ids')")).scalar()
+
+        session.execute(message_ids.update().values(next_id=message_ids.c.next_id + 1))
+        return session.execute(db.select([message_ids.c.next_id - 1])).scalar()
+
+    ##########################################################################
+    # Reads
+
+    def scatter(self, function, names=None):
+        """Run `function(name, session)` on each shard of `names` at once.
+
+        Defaults to every shard. Returns the results in the order of
+        `names`; ORM instances come back detached.
+        """
+
+        app = current_app._get_current_object()
+
+        def run(name):
+            with app.app_context():
+                session = self.session(name)
+                result = function(name, session)
+                session.expunge_all()
+                return result
+
+        names = self.names if names is None else list(names)
+        return list(self._executor.map(run, names))
+
+    def with_authors(self, messages):
+        """Attach each message's author, from the main database.
+
+        Messages whose author no longer exists are dropped.
+        """
+
+        ids = {msg.user_id for msg in messages}
+        users = {user.id: user for user in
+                 User.query.filter(User.id.in_(ids))} if ids else {}
+
+        # Messages of a deleted user linger on the shards until their
+        # `purge_user_shards` job runs; leave them out.
+        messages = [msg for msg in messages if msg.user_id in users]
+        for msg in messages:
+            set_committed_value(msg, 'user', users[msg.user_id])
+        return messages
+
+    def recent_messages(self, user_ids, limit=100):
+        """The `limit` newest messages by any of `user_ids`, across shards."""
+
+        by_shard = {}
+        for user_id, shard in self.assignments(user_ids).items():
+            by_shard.setdefault(shard, []).append(user_id)
+
+        def newest(name, session):
+            return (session
+                    .query(Message)
+                    .filter(Message.user_id.in_(by_shard[name]))
+                    .order_by(Message.timestamp.desc())
+                    .limit(limit)
+                    .all())
+
+        pages = self.scatter(newest, by_shard)
+        merged = merge(*pages, key=attrgetter('timestamp'), reverse=True)
+        return self.with_authors(list(islice(merged, limit)))
+
+    def get_message(self, message_id):
+        """Message `message_id`, looked for on its home shard first."""
+
+        home = message_id // ID_STRIDE
+        names = self.names[home:home + 1] + [name for i, name in enumerate(self.names)
+                                             if i != home]
+        for name in names:
+            msg = self.session(name).query(Message).get(message_id)
+            if msg is not None:
+                found = self.with_authors([msg])
+                return found[0] if found else None
+        return None
+
+    def find_messages(self, message_ids):
+        """Messages with any of `message_ids`, from every shard."""
+
+        if not message_ids:
+            return []
+
+        pages = self.scatter(lambda name, session: (session
+                             .query(Message)
+                             .filter(Message.id.in_(message_ids))
+                             .all()))
+        return self.with_authors([msg for page in pages for msg in page])
+
+    def following_ids(self, user_id):
+        """Ids of the users `user_id` follows."""
+
+        return {id for id, in (self.reader(user_id)
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == user_id))}
+
+    def follower_ids(self, user_id, after=None, limit=50):
+        """Up to `limit` ids of `user_id`'s followers, in order, past `after`."""
+
+        def page(name, session):
+            query = (session
+                     .query(Follows.user_following_id)
+                     .filter(Follows.user_being_followed_id == user_id))
+            if after is not None:
+                query = query.filter(Follows.user_following_id > after)
+            return [id for id, in query.order_by(Follows.user_following_id).limit(limit)]
+
+        return list(islice(merge(*self.scatter(page)), limit))
+
+    def counts(self, user_id):
+        """Like `User.counts_for`, with followers summed across every shard."""
+
+        if not self.enabled:
+            return User.counts_for(user_id)
+
+        def count(column, value):
+            return (db.select([func.count()])
+                    .where(column == value)
+                    .as_scalar())
+
+        counts = self.reader(user_id).query(
+            count(Message.user_id, user_id).label('messages'),
+            count(Follows.user_following_id, user_id).label('following'),
+            count(Likes.user_id, user_id).label('likes'),
+        ).one()._asdict()
+
+        counts['followers'] = sum(self.scatter(lambda name, session: (session
+                                  .query(func.count())
+                                  .select_from(Follows)
+                                  .filter(Follows.user_being_followed_id == user_id)
+                                  .scalar())))
+        return counts
+
+    ##########################################################################
+    # Writes across shards
+
+    def delete_user(self, user_id, home=None):
+        """Delete a user's rows, and others' follows of them and likes of
+        their messages, from every shard. Committed shard by shard.
+
+        `home` is the user's shard, needed once their `shard_directory`
+        row has gone with them.
+        """
+
+        if not self.enabled:
+            return
+
+        home = home or self.assignments([user_id])[user_id]
+        own = self.session(home)
+        message_ids = [id for id, in own.query(Message.id).filter(Message.user_id == user_id)]
+
+        def purge(name, session):
+            (session.query(Follows)
+             .filter(Follows.user_being_followed_id == user_id)
+             .delete(synchronize_session=False))
+            if message_ids:
+                (session.query(Likes)
+                 .filter(Likes.message_id.in_(message_ids))
+                 .delete(synchronize_session=False))
+            if name == home:
+                for table, column in SHARDED:
+                    session.execute(table.delete().where(table.c[column] == user_id))
+            session.commit()
+
+        self.scatter(purge)
+
+    ##########################################################################
+    # Administration
+
+    def create_tables(self):
+        """Create the directory, the sharded tables and each shard's id allocator."""
+
+        ShardAssignment.__table__.create(db.engine, checkfirst=True)
+
+        for index, name in enumerate(self.names):
+            engine = self.engine(name)
+            start = index * ID_STRIDE + 1
+
+            if engine.dialect.name == 'postgresql':
+                shard_metadata.create_all(engine, tables=[
+                    table for table in shard_metadata.sorted_tables
+                    if table is not message_ids])
+                engine.execute(text(
+                    f"CREATE SEQUENCE IF NOT EXISTS message_ids START WITH {start}"))
+            else:
+                shard_metadata.create_all(engine)
+                with engine.begin() as conn:
+                    if conn.execute(db.select([func.count()]).select_from(message_ids)).scalar() == 0:
+                        conn.execute(message_ids.insert().values(next_id=start))
+
+    def skip_ids(self, name, past):
+        """Make shard `name` give out only message ids above `past`."""
+
+        engine = self.engine(name)
+        if engine.dialect.name == 'postgresql':
+            engine.execute(text(
+                "SELECT setval('message_ids', GREATEST(:past, "
+                "(SELECT last_value FROM message_ids)))"), past=past)
+        else:
+            with engine.begin() as conn:
+                conn.execute(message_ids.update()
+                             .where(message_ids.c.next_id <= past)
+                             .values(next_id=past + 1))
+
+    def copy_rows(self, source, target, batch_size, where=None, route=None):
+        """Copy the sharded tables' rows from engine `source`.
+
+        With `where(table, column)`, only matching rows are copied, to
+        engine `target`; with `route(owner_id)`, every row goes to the
+        engine of the shard it names. Returns how many rows were copied.
+        """
+
+        copied = 0
+
+        for table, column in SHARDED:
+            query = table.select()
+            if where is not None:
+                query = query.where(where(table, column))
+
+            result = source.execution_options(stream_results=True).execute(query)
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+
+                batches = {}
+                for row in rows:
+                    engine = target if route is None else self.engine(route(row[column]))
+                    values = dict(row)
+                    values.pop(RENUMBERED.get(table), None)
+                    batches.setdefault(engine, []).append(values)
+                for engine, batch in batches.items():
+                    with engine.begin() as conn:
+                        conn.execute(table.insert(), batch)
+                copied += len(rows)
+
+        return copied
+
+    def import_main(self, batch_size=1000):
+        """Assign every user a shard and copy the main database's rows out.
+
+        Run once, into empty shards. The rows are left in the main
+        database, where hashtags, search and the cold tier still use them.
+        """
+
+        top = db.session.query(func.max(Message.id)).scalar() or 0
+        if top >= ID_STRIDE:
+            raise click.ClickException(f"Message ids must be below {ID_STRIDE} to import")
+
+        assigned = {id for id, in db.session.query(ShardAssignment.user_id)}
+        for user_id, in db.session.query(User.id):
+            if user_id not in assigned:
+                self.place(user_id)
+        db.session.commit()
+
+        directory = dict(db.session.query(ShardAssignment.user_id, ShardAssignment.shard))
+        copied = self.copy_rows(db.engine, None, batch_size, route=directory.__getitem__)
+
+        # The copied ids all fall in the first shard's range.
+        self.skip_ids(self.names[0], top)
+        return copied
+
+    def move_user(self, user_id, target, batch_size=1000):
+        """Move a user's rows to shard `target`; returns how many rows moved.
+
+        The user's writes are refused (ShardMoving) until the copy is done
+        and the directory points at `target`; only then are the old rows
+        deleted. Safe to re-run after a failure.
+        """
+
+        assignment = (ShardAssignment.query.get(user_id)
+                      or ShardAssignment(user_id=user_id,
+                                         shard=self.default_shard(user_id)))
+        source = assignment.shard
+        if source == target:
+            return 0
+
+        assignment.moving = True
+        db.session.add(assignment)
+        db.session.commit()
+
+        def owned(table, column):
+            return table.c[column] == user_id
+
+        # Clear anything an earlier, interrupted move left behind.
+        with self.engine(target).begin() as conn:
+            for table, column in SHARDED:
+                conn.execute(table.delete().where(owned(table, column)))
+
+        moved = self.copy_rows(self.engine(source), self.engine(target),
+                               batch_size, where=owned)
+
+        assignment.shard = target
+        assignment.moving = False
+        db.session.commit()
+        g.pop('shard_assignments', None)
+
+        with self.engine(source).begin() as conn:
+            for table, column in SHARDED:
+                conn.execute(table.delete().where(owned(table, column)))
+
+        return moved
+
+    def plan_rebalance(self, tolerance=0.1, max_moves=100):
+        """Moves `[(user_id, from, to)]` that even out messages per shard.
+
+        Repeatedly moves the largest user that fits in half the gap between
+        the fullest and emptiest shards, until every shard is within
+        `tolerance` of the mean.
+        """
+
+        per_user = self.scatter(lambda name, session: (session
+                                .query(Message.user_id, func.count())
+                                .group_by(Message.user_id)
+                                .all()))
+        users = {name: sorted(counts, key=lambda row: row[1], reverse=True)
+                 for name, counts in zip(self.names, per_user)}
+        loads = {name: sum(count for _, count in rows) for name, rows in users.items()}
+        mean = sum(loads.values()) / len(loads)
+
+        moves = []
+        while len(moves) < max_moves:
+            fullest = max(loads, key=loads.get)
+            emptiest = min(loads, key=loads.get)
+            gap = loads[fullest] - loads[emptiest]
+            if gap <= tolerance * mean:
+                break
+
+            fits = [row for row in users[fullest] if row[1] <= gap / 2]
+            if not fits:
+                break
+
+            user_id, count = fits[0]
+            users[fullest].remove(fits[0])
+            users[emptiest] = sorted(users[emptiest] + [fits[0]],
+                                     key=lambda row: row[1], reverse=True)
+            loads[fullest] -= count
+            loads[emptiest] += count
+            moves.append((user_id, fullest, emptiest))
+
+        return moves
+
+
+shards = Shards()
+
+
+@jobs.handler('purge_user_shards')
+def purge_user_shards(payloads):
+    """Delete deleted users' rows from the shards; payloads name `user_id` and `shard`."""
+
+    for payload in payloads:
+        shards.delete_user(payload['user_id'], payload['shard'])
+
+
+@click.group('shards')
+def shards_command():
+    """Manage the message/like/follow shards."""
+
+
+@shards_command.command('init')
+@with_appcontext
+def init_command():
+    """Create the sharded tables on every shard."""
+
+    shards.create_tables()
+    click.echo(f"Initialized {len(shards.names)} shards")
+
+
+@shards_command.command('import-main')
+@click.option('--batch-size', type=int, default=1000)
+@with_appcontext
+def import_main_command(batch_size):
+    """Copy messages, likes and follows from the main database to the shards."""
+
+    copied = shards.import_main(batch_size)
+    click.echo(f"Copied {copied} rows to {len(shards.names)} shards")
+
+
+@shards_command.command('move')
+@click.argument('user_id', type=int)
+@click.argument('shard')
+@click.option('--batch-size', type=int, default=1000)
+@with_appcontext
+def move_command(user_id, shard, batch_size):
+    """Move one user's rows to SHARD."""
+
+    if shard not in shards.names:
+        raise click.BadParameter(f"not one of {', '.join(shards.names)}", param_hint='SHARD')
+
+    moved = shards.move_user(user_id, shard, batch_size)
+    click.echo(f"Moved {moved} rows of user {user_id} to {shard}")
+
+
+@shards_command.command('rebalance')
+@click.option('--tolerance', type=float, default=0.1,
+              help="Allowed deviation from the mean messages per shard.")
+@click.option('--max-moves', type=int, default=100)
+@click.option('--dry-run', is_flag=True, help="Only print the planned moves.")
+@with_appcontext
+def rebalance_command(tolerance, max_moves, dry_run):
+    """Move users between shards to even out their message counts."""
+
+    for user_id, source, target in shards.plan_rebalance(tolerance, max_moves):
+        if dry_run:
+            click.echo(f"would move user {user_id}: {source} -> {target}")
+        else:
+            moved = shards.move_user(user_id, target)
+            click.echo(f"moved user {user_id}: {source} -> {target} ({moved} rows)")
+
+
+@shards_command.command('status')
+@with_appcontext
+def status_command():
+    """Show how many users and messages each shard holds."""
+
+    directory = dict(db.session
+                     .query(ShardAssignment.shard, func.count())
+                     .group_by(ShardAssignment.shard)
+                     .all())
+    messages = shards.scatter(lambda name, session: (session
+                              .query(func.count(Message.id))
+                              .scalar()))
+
+    for name, count in zip(shards.names, messages):
+        click.echo(f"{name:>12} {directory.get(name, 0):>8} users {count:>10} messages")
@@ -0,0 +1,94 @@
+"""Coalescing of identical concurrent computations.
+
+When many requests for the same page arrive together, only the first
+runs its queries; the rest wait for that result and share it. Shared
+results must not be tied to one request's session, so views hand back
+plain snapshots (see `snapshot`), not ORM instances.
+"""
+
+import threading
+from collections import Counter
+from types import SimpleNamespace
+
+
+def snapshot(instance, fields):
+    """Plain, session-free copy of `fields` of `instance`."""
+
+    return SimpleNamespace(**{field: getattr(instance, field) for field in fields})
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Runs at most one computation per key at a time.
+
+    `stats` counts leaders (computations run), shared results, timeouts
+    and errors overall; `saved[key]` counts, per key, computations that
+    were saved by waiting for another request's result.
+    """
+
+    def __init__(self, timeout=5):
+        self.timeout = timeout
+        self.stats = Counter()
+        self.saved = Counter()
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('SINGLEFLIGHT_TIMEOUT', 5)
+        self.timeout = app.config['SINGLEFLIGHT_TIMEOUT']
+
+    def run(self, key, function, stamp=()):
+        """Result of `function()`, shared with concurrent calls for `key`.
+
+        `stamp` (from `versions.stamp`) is part of the key, so a
+        computation that began before a write isn't shared after it. A
+        caller that waits longer than `timeout` seconds computes its own
+        result; an error in the shared computation is raised in every
+        caller waiting on it.
+        """
+
+        flight = (key, stamp)
+
+        with self._lock:
+            call = self._calls.get(flight)
+            leader = call is None
+            if leader:
+                call = self._calls[flight] = _Call()
+            else:
+                call.waiters += 1
+
+        if leader:
+            self.stats['leaders'] += 1
+            try:
+                call.result = function()
+                return call.result
+            except BaseException as exc:
+                call.error = exc
+                self.stats['errors'] += 1
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[flight]
+                call.done.set()
+
+        if not call.done.wait(self.timeout):
+            self.stats['timeouts'] += 1
+            return function()
+
+        if call.error is not None:
+            raise call.error
+
+        self.stats['shared'] += 1
+        with self._lock:
+            self.saved[key] += 1
+        return call.result
+
+
+flights = SingleFlight()
@@ -0,0 +1,213 @@
+"""Slow-query log with automatic EXPLAIN capture.
+
+Statements that take longer than `SLOW_QUERY_MS` are written, one JSON
+object per line, to the rotating file `SLOW_QUERY_LOG`, along with the
+route that ran them, their (redacted) parameters and the query plan.
+"""
+
+import heapq
+import json
+import logging
+import os
+import time
+from datetime import date, datetime
+from logging.handlers import RotatingFileHandler
+
+import click
+from flask import has_request_context, request
+from flask.cli import with_appcontext
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SENSITIVE = ('password', 'email', 'token', 'secret')
+
+
+def redact(parameters):
+    """Copy of statement `parameters` that is safe to write to a log.
+
+    Numbers, dates and NULLs are kept (they're what makes a plan good or
+    bad); text is replaced by its length, and anything under a sensitive
+    parameter name is dropped.
+    """
+
+    def value(key, val):
+        if key and any(word in key.lower() for word in SENSITIVE):
+            return "<redacted>"
+        if val is None or isinstance(val, (bool, int, float)):
+            return val
+        if isinstance(val, (date, datetime)):
+            return val.isoformat()
+        if isinstance(val, (str, bytes)):
+            return f"<{type(val).__name__} len={len(val)}>"
+        if isinstance(val, (list, tuple)):
+            return [value(None, v) for v in val[:20]] + (["..."] if len(val) > 20 else [])
+        return f"<{type(val).__name__}>"
+
+    if isinstance(parameters, dict):
+        return {k: value(k, v) for k, v in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [value(None, v) for v in parameters]
+    return value(None, parameters)
+
+
+def explain(cursor, dialect, statement, parameters):
+    """Get the plan for `statement` on the connection of DBAPI `cursor`.
+
+    On Postgres, SELECTs are run again under EXPLAIN (ANALYZE, BUFFERS),
+    inside a savepoint so a failure can't break the caller's transaction.
+    Other statements only get a plain EXPLAIN, since ANALYZE would run
+    their writes a second time.
+    """
+
+    is_select = statement.lstrip().lower().startswith(('select', 'with'))
+
+    if dialect == 'postgresql':
+        prefix = "EXPLAIN (ANALYZE, BUFFERS) " if is_select else "EXPLAIN "
+    elif dialect == 'sqlite':
+        prefix = "EXPLAIN QUERY PLAN "
+    else:
+        prefix = "EXPLAIN "
+
+    explain_cursor = cursor.connection.cursor()
+    try:
+        if dialect == 'postgresql':
+            explain_cursor.execute("SAVEPOINT slowlog_explain")
+        try:
+            explain_cursor.execute(prefix + statement, parameters)
+            plan = [" ".join(str(col) for col in row)
+                    for row in explain_cursor.fetchall()]
+        finally:
+            if dialect == 'postgresql':
+                explain_cursor.execute("ROLLBACK TO SAVEPOINT slowlog_explain")
+    except Exception as exc:
+        plan = [f"(no plan: {exc})"]
+    finally:
+        explain_cursor.close()
+
+    return "\n".join(plan)
+
+
+class SlowQueryLog:
+    """Times every statement and logs those over the threshold."""
+
+    def __init__(self):
+        self.threshold = None
+        self.path = None
+        self.explain = True
+        self.explain_interval = 60
+        self.logger = logging.getLogger('warbler.slowlog')
+        self.logger.propagate = False
+        self._explained = {}
+
+    def init_app(self, app):
+        app.config.setdefault('SLOW_QUERY_MS', 200)
+        app.config.setdefault('SLOW_QUERY_LOG', 'slow_queries.log')
+        app.config.setdefault('SLOW_QUERY_EXPLAIN', True)
+        app.config.setdefault('SLOW_QUERY_LOG_BYTES', 10 * 1024 * 1024)
+        app.config.setdefault('SLOW_QUERY_LOG_BACKUPS', 5)
+
+        self.threshold = app.config['SLOW_QUERY_MS']
+        self.path = app.config['SLOW_QUERY_LOG']
+        self.explain = app.config['SLOW_QUERY_EXPLAIN']
+
+        if not self.threshold or not self.path:
+            return
+
+        self.open(self.path,
+                  app.config['SLOW_QUERY_LOG_BYTES'],
+                  app.config['SLOW_QUERY_LOG_BACKUPS'])
+
+        if not event.contains(Engine, 'before_cursor_execute', self.before):
+            event.listen(Engine, 'before_cursor_execute', self.before)
+            event.listen(Engine, 'after_cursor_execute', self.after)
+            event.listen(Engine, 'handle_error', self.error)
+
+    def open(self, path, max_bytes=10 * 1024 * 1024, backups=5):
+        """(Re)direct the log to the rotating file at `path`."""
+
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+            handler.close()
+
+        self.path = path
+        self.logger.addHandler(RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backups))
+        self.logger.setLevel(logging.INFO)
+
+    def before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('slowlog_start', []).append(time.perf_counter())
+
+    def after(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = (time.perf_counter() - conn.info['slowlog_start'].pop()) * 1000
+
+        if not self.threshold or elapsed < self.threshold:
+            return
+
+        entry = {
+            'at': datetime.utcnow().isoformat(),
+            'ms': round(elapsed, 2),
+            'route': request.endpoint if has_request_context() else None,
+            'path': request.path if has_request_context() else None,
+            'statement': statement,
+            'parameters': redact(parameters),
+            'plan': None,
+        }
+
+        if self.explain and not executemany and self._should_explain(statement):
+            entry['plan'] = explain(cursor, conn.dialect.name, statement, parameters)
+
+        self.logger.info(json.dumps(entry))
+
+    def error(self, context):
+        """Drop the start time of a statement that raised instead."""
+
+        if context.connection is not None and context.execution_context is not None:
+            started = context.connection.info.get('slowlog_start')
+            if started:
+                started.pop()
+
+    def _should_explain(self, statement):
+        """Only explain each statement once per `explain_interval` seconds."""
+
+        now = time.monotonic()
+        if len(self._explained) > 1000:
+            self._explained.clear()
+        if now - self._explained.get(statement, -self.explain_interval) < self.explain_interval:
+            return False
+        self._explained[statement] = now
+        return True
+
+    def slowest(self, n=10):
+        """The `n` slowest entries in the log, rotated files included."""
+
+        paths = [self.path] + [f"{self.path}.{i}" for i in range(1, 100)]
+        entries = []
+
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            with open(path) as f:
+                entries.extend(json.loads(line) for line in f if line.strip())
+            entries = heapq.nlargest(n, entries, key=lambda e: e['ms'])
+
+        return entries
+
+
+slow_query_log = SlowQueryLog()
+
+
+@click.command('slow-queries')
+@click.option('-n', default=10, help="How many queries to show.")
+@click.option('--plans/--no-plans', default=True)
+@with_appcontext
+def slow_queries_command(n, plans):
+    """Show the slowest logged queries, with their plans."""
+
+    for entry in slow_query_log.slowest(n):
+        click.echo(f"{entry['ms']:>10.1f} ms  {entry['route']}  {entry['at']}")
+        click.echo(f"    {entry['statement']}")
+        click.echo(f"    {entry['parameters']}")
+        if plans and entry['plan']:
+            for line in entry['plan'].splitlines():
+                click.echo(f"        {line}")
+        click.echo()
@@ -0,0 +1,86 @@
+"""Periodic log lines of each worker's in-process counters.
+
+Several features (the degrader, for one) count what they do in a
+`Counter` of their own process, which no other process can read. Every
+`STATS_INTERVAL` seconds a thread in each serving process writes the
+counters it was given, with its pid, as one JSON line to the
+`warbler.stats` logger (standard error, unless it is given a handler).
+They are totals since the process started, so rates come from the
+difference between two lines.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+
+class StatsLog:
+    """Logs the counters it was given, every `interval` seconds."""
+
+    def __init__(self):
+        self.interval = 0
+        self.counters = {}
+        self.logger = logging.getLogger('warbler.stats')
+        self.logger.propagate = False
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def add(self, name, counter):
+        """Log `counter` (a `Counter`, or any mapping) under `name`."""
+
+        self.counters[name] = counter
+
+    def init_app(self, app):
+        app.config.setdefault('STATS_INTERVAL', 60)
+
+        self.app = app
+        self.interval = app.config['STATS_INTERVAL']
+
+        if not self.logger.handlers:
+            self.logger.addHandler(logging.StreamHandler())
+        self.logger.setLevel(logging.INFO)
+
+        if self.interval:
+            app.before_request(self.start)
+
+    def snapshot(self):
+        """Current totals, as `{name: {key: count}}`."""
+
+        return {name: dict(counter) for name, counter in self.counters.items()}
+
+    def report(self):
+        """Write one line with every counter."""
+
+        self.logger.info(json.dumps(dict(
+            self.snapshot(), at=datetime.utcnow().isoformat(), pid=os.getpid())))
+
+    def start(self):
+        """Start this process's reporting thread, unless it's running.
+
+        Called before each request; threads don't survive a fork, so each
+        worker starts its own.
+        """
+
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self.run, name='stats-log', daemon=True).start()
+
+    def run(self):
+        while self.interval:
+            time.sleep(self.interval)
+            try:
+                self.report()
+            except Exception:
+                self.app.logger.exception("Logging stats failed")
+        self._pid = None
+
+
+stats_log = StatsLog()
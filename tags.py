@@ -0,0 +1,185 @@
+"""Hashtag and mention index, maintained when messages are written.
+
+New messages are indexed by an `index_messages` job (see jobs.py), and a
+username change re-resolves the mentions of the old and new names in a
+`reindex_mentions` job. Archived messages keep their index rows in the
+cold tier's own tables (see archive.py); functions taking a `tier` work
+on either.
+"""
+
+import re
+from collections import namedtuple
+
+import click
+from flask.cli import with_appcontext
+from markupsafe import Markup, escape
+
+from jobs import jobs
+from models import (db, User, Message, MessageTag, Mention, ArchivedMessage,
+                    ArchivedMessageTag, ArchivedMention)
+
+TAG_RE = re.compile(r'(?<![\w&])#(\w{1,100})')
+
+MENTION_RE = re.compile(r'(?<![\w@])@(\w{1,100})')
+
+Tier = namedtuple('Tier', 'message tag mention')
+
+HOT = Tier(Message, MessageTag, Mention)
+
+COLD = Tier(ArchivedMessage, ArchivedMessageTag, ArchivedMention)
+
+
+def extract_tags(text):
+    """Set of (lowercased) hashtags in `text`."""
+
+    return {tag.lower() for tag in TAG_RE.findall(text)}
+
+
+def extract_mentions(text):
+    """Set of usernames @-mentioned in `text`."""
+
+    return set(MENTION_RE.findall(text))
+
+
+def index_messages(messages, tier=HOT):
+    """Add the tag and mention rows for `messages`, `(id, text)` pairs.
+
+    Mentioned usernames are resolved with one query for the whole batch
+    and each side table gets one multi-row INSERT. Doesn't commit.
+    """
+
+    tag_rows = []
+    mentions = []
+
+    for id, text in messages:
+        tag_rows.extend({'tag': tag, 'message_id': id}
+                        for tag in extract_tags(text))
+        mentions.extend((username, id) for username in extract_mentions(text))
+
+    mention_rows = []
+    if mentions:
+        user_ids = dict(db.session
+                        .query(User.username, User.id)
+                        .filter(User.username.in_({name for name, id in mentions})))
+        mention_rows = [{'user_id': user_ids[name], 'message_id': id}
+                        for name, id in mentions if name in user_ids]
+
+    if tag_rows:
+        db.session.execute(tier.tag.__table__.insert().values(tag_rows))
+    if mention_rows:
+        db.session.execute(tier.mention.__table__.insert().values(mention_rows))
+
+    return len(tag_rows), len(mention_rows)
+
+
+def reindex(message_ids, tier=HOT):
+    """Replace the index rows of messages `message_ids`. Doesn't commit."""
+
+    for model in (tier.tag, tier.mention):
+        (model.query
+         .filter(model.message_id.in_(message_ids))
+         .delete(synchronize_session=False))
+
+    return index_messages(db.session
+                          .query(tier.message.id, tier.message.text)
+                          .filter(tier.message.id.in_(message_ids))
+                          .all(), tier)
+
+
+@jobs.handler('index_messages', batch_size=100)
+def index_messages_job(payloads):
+    reindex({payload['message_id'] for payload in payloads})
+
+
+@jobs.handler('reindex_mentions', batch_size=20)
+def reindex_mentions_job(payloads):
+    """Re-resolve mentions of usernames that changed hands.
+
+    Each payload has the `old` and `new` username of a renamed user.
+    """
+
+    names = {payload[side] for payload in payloads for side in ('old', 'new')}
+
+    for tier in (HOT, COLD):
+        column = tier.message.text
+        message_ids = [id for id, in (db.session
+                                      .query(tier.message.id)
+                                      .filter(db.or_(*[column.contains(f'@{name}', autoescape=True)
+                                                       for name in names])))]
+        if message_ids:
+            reindex(message_ids, tier)
+
+
+def tagged_messages(tag, tier=HOT):
+    """Query for the messages of `tier` with hashtag `tag`."""
+
+    return (tier.message
+            .query
+            .join(tier.tag, tier.tag.message_id == tier.message.id)
+            .filter(tier.tag.tag == tag.lower()))
+
+
+def mentioning_messages(user_id, tier=HOT):
+    """Query for the messages of `tier` that mention user `user_id`."""
+
+    return (tier.message
+            .query
+            .join(tier.mention, tier.mention.message_id == tier.message.id)
+            .filter(tier.mention.user_id == user_id))
+
+
+def linkify_tags(text):
+    """Jinja filter: escape `text` and link its hashtags to their pages."""
+
+    return Markup(TAG_RE.sub(
+        lambda m: f'<a href="/tags/{m.group(1).lower()}">#{m.group(1)}</a>',
+        str(escape(text))))
+
+
+def backfill(batch_size=1000, echo=None):
+    """(Re)build the tag and mention index for every message.
+
+    Works through each tier's messages in id order, one batch per
+    transaction; each batch's old index rows are deleted first, so it's
+    safe to rerun.
+    """
+
+    total = 0
+
+    for tier in (HOT, COLD):
+        after = 0
+
+        while True:
+            batch = (db.session
+                     .query(tier.message.id, tier.message.text)
+                     .filter(tier.message.id > after)
+                     .order_by(tier.message.id)
+                     .limit(batch_size)
+                     .all())
+            if not batch:
+                break
+
+            first, after = batch[0].id, batch[-1].id
+            for model in (tier.tag, tier.mention):
+                (model.query
+                 .filter(model.message_id.between(first, after))
+                 .delete(synchronize_session=False))
+
+            index_messages(batch, tier)
+            db.session.commit()
+
+            total += len(batch)
+            if echo:
+                echo(f"Indexed messages up to #{after} ({total} so far)")
+
+    return total
+
+
+@click.command('backfill-tags')
+@click.option('--batch-size', type=int, default=1000)
+@with_appcontext
+def backfill_command(batch_size):
+    """Build the hashtag and mention index for existing messages."""
+
+    total = backfill(batch_size, echo=click.echo)
+    click.echo(f"Indexed {total} messages")
@@ -0,0 +1,94 @@
+"""Daily analytics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_analytics.py
+
+
+import os
+import tempfile
+from datetime import date, datetime
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, UserDailyStats
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "postgresql:///warbler-test")
+
+from app import app
+from analytics import byte_ranges, csv_stats, database_stats, save
+
+db.create_all()
+
+DAY = date(2019, 3, 1)
+
+
+class AnalyticsTestCase(TestCase):
+    """Test per-user daily stats, from the database and from CSVs."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        for id, name in ((1, "one"), (2, "two")):
+            user = User.signup(name, f"{name}@test.com", "password", None)
+            user.id = id
+        db.session.flush()
+
+        db.session.add_all([
+            Message(id=1, text="Morning", timestamp=datetime(2019, 3, 1, 9, 15), user_id=1),
+            Message(id=2, text="Evening", timestamp=datetime(2019, 3, 1, 21, 5), user_id=1),
+            Message(id=3, text="Late", timestamp=datetime(2019, 3, 2, 0, 5), user_id=2),
+        ])
+        db.session.flush()
+
+        db.session.add_all([
+            Follows(user_being_followed_id=1, user_following_id=2),
+            Likes(user_id=2, message_id=1),
+            UserDailyStats(day=date(2019, 2, 28), user_id=2, followers=1,
+                           hourly=bytes(96)),
+        ])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_database_stats(self):
+        """Are messages, likes and follower growth counted per user?"""
+
+        self.assertEqual(save(DAY, database_stats(DAY)), 2)
+
+        one = UserDailyStats.query.get((DAY, 1))
+        self.assertEqual((one.messages, one.likes_received, one.followers,
+                          one.follower_growth), (2, 1, 1, 1))
+        self.assertEqual(one.hours()[9], 1)
+        self.assertEqual(one.hours()[21], 1)
+        self.assertEqual(sum(one.hours()), 2)
+
+        two = UserDailyStats.query.get((DAY, 2))
+        self.assertEqual((two.messages, two.likes_given, two.followers,
+                          two.follower_growth), (0, 1, 0, -1))
+
+    def test_csv_stats(self):
+        """Do CSVs split across processes give the same counts?"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'messages.csv'), 'w') as file:
+                file.write("text,timestamp,user_id\n")
+                for i in range(100):
+                    file.write(f"\"Hi, {i}\",2019-03-01 {i % 24:02}:30:00.000001,{i % 3 + 1}\n")
+                file.write("Tomorrow,2019-03-02 01:00:00,1\n")
+            with open(os.path.join(directory, 'follows.csv'), 'w') as file:
+                file.write("user_being_followed_id,user_following_id\n2,1\n2,3\n")
+            with open(os.path.join(directory, 'likes.csv'), 'w') as file:
+                file.write("user_id,message_id\n1,2\n3,2\n3,101\n")
+
+            self.assertEqual(len(byte_ranges(os.path.join(directory, 'messages.csv'), 4)), 4)
+            stats = csv_stats(directory, DAY, workers=4, chunk_size=7)
+
+        self.assertEqual(list(stats.counts['messages']), [0, 34, 33, 33])
+        self.assertEqual(stats.hourly.sum(), 100)
+        self.assertEqual(stats.hourly[1].sum(), 34)
+        self.assertEqual(list(stats.counts['followers']), [0, 0, 2])
+        self.assertEqual(list(stats.counts['likes_given']), [0, 1, 0, 2])
+        self.assertEqual(list(stats.counts['likes_received']), [0, 1, 2, 0])
@@ -0,0 +1,72 @@
+"""Version bus tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_bus.py
+
+
+import os
+import time
+from unittest import TestCase
+
+from models import db, BusListener, VersionBump
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "postgresql:///warbler-test")
+
+from app import app
+from bus import bus
+from versions import versions
+
+db.create_all()
+
+
+class BusTestCase(TestCase):
+    """Test publishing and applying of version bumps between processes."""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        VersionBump.query.delete()
+        BusListener.query.delete()
+        db.session.commit()
+
+        bus.last_id = None
+        bus.poll()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+
+    def test_publish(self):
+        """Is a local bump written for others, and not applied twice here?"""
+
+        before = versions.stamp('user:901')[0]
+        versions.bump('user:901')
+
+        bump = VersionBump.query.one()
+        self.assertEqual((bump.names, bump.origin), ('user:901', bus.origin))
+
+        bus.poll()
+        self.assertEqual(versions.stamp('user:901')[0], before + 1)
+
+    def test_apply_other_process(self):
+        """Are another process's bumps applied, with their lag recorded?"""
+
+        before = versions.stamp('user:902', 'message:902')
+        db.session.add(VersionBump(names='message:902 user:902', origin='elsewhere:1',
+                                   sent_at=time.time() - 0.25))
+        db.session.commit()
+
+        bus.poll()
+        bus.poll()
+
+        self.assertEqual(versions.stamp('user:902', 'message:902'),
+                         tuple(version + 1 for version in before))
+        p50, worst = bus.lag()
+        self.assertGreaterEqual(worst, 250)
+
+        bus.report()
+        self.assertEqual(BusListener.query.get(bus.origin).last_id,
+                         VersionBump.query.one().id)
@@ -0,0 +1,208 @@
+"""Background job queue tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import os
+import threading
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, Job, Mention, Message, User
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "postgresql:///warbler-test")
+
+from app import app, CURR_USER_KEY
+from jobs import jobs
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class JobsTestCase(TestCase):
+    """Test enqueueing, batching and retrying of jobs."""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        Job.query.delete()
+        db.session.commit()
+
+        self.batches = []
+        self.failures = 0
+
+        @jobs.handler('test_batch', batch_size=2)
+        def batch(payloads):
+            self.batches.append(payloads)
+
+        @jobs.handler('test_flaky')
+        def flaky(payloads):
+            self.failures += 1
+            raise ValueError("flaky")
+
+    def tearDown(self):
+        del jobs.handlers['test_batch'], jobs.handlers['test_flaky']
+        db.session.rollback()
+        self.ctx.pop()
+
+    def test_batches(self):
+        """Are jobs of one kind run together, up to the batch size?"""
+
+        for n in range(3):
+            jobs.enqueue('test_batch', {'n': n})
+        db.session.commit()
+
+        self.assertEqual(jobs.run_pending(), 3)
+        self.assertEqual(self.batches, [[{'n': 0}, {'n': 1}], [{'n': 2}]])
+        self.assertEqual({job.state for job in Job.query}, {'done'})
+
+    def test_idempotency_key(self):
+        """Is a pending job with the same key enqueued only once?"""
+
+        self.assertTrue(jobs.enqueue('test_batch', {'n': 1}, key='one'))
+        self.assertFalse(jobs.enqueue('test_batch', {'n': 2}, key='one'))
+        db.session.commit()
+
+        jobs.run_pending()
+        self.assertEqual(self.batches, [[{'n': 1}]])
+
+        # Once done, the key is free again.
+        self.assertTrue(jobs.enqueue('test_batch', {'n': 3}, key='one'))
+
+    def test_retry_with_backoff(self):
+        """Is a failing job retried later, then marked failed?"""
+
+        jobs.enqueue('test_flaky', {})
+        db.session.commit()
+
+        jobs.run_pending()
+        job = Job.query.one()
+        self.assertEqual((job.state, job.attempts), ('queued', 1))
+        self.assertIn("flaky", job.error)
+        self.assertGreater(job.run_at, datetime.utcnow() + timedelta(seconds=5))
+
+        # Nothing is due until the backoff has passed.
+        self.assertEqual(jobs.run_pending(), 0)
+
+        for attempt in range(app.config['JOBS_MAX_ATTEMPTS'] - 1):
+            Job.query.update({'run_at': datetime.utcnow()})
+            db.session.commit()
+            jobs.run_pending()
+
+        job = Job.query.one()
+        self.assertEqual((job.state, job.attempts), ('failed', 5))
+        self.assertEqual(self.failures, 5)
+
+    def test_expired_lease_is_reclaimed(self):
+        """Are a crashed worker's jobs claimed again after their lease?"""
+
+        jobs.enqueue('test_batch', {'n': 1})
+        db.session.commit()
+
+        kind, token, claimed = jobs.claim()
+        self.assertEqual(len(claimed), 1)
+        self.assertEqual(jobs.claim()[2], [])
+
+        Job.query.update({'locked_until': datetime.utcnow() - timedelta(seconds=1)})
+        db.session.commit()
+
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(Job.query.one().attempts, 2)
+
+    def test_unfinished_batch_is_leased(self):
+        """Is a batch whose completion fails rolled back, and left leased?"""
+
+        @jobs.handler('test_unfinished')
+        def unfinished(payloads):
+            db.session.add(Message(text=None, user_id=None))
+
+        messages = Message.query.count()
+        try:
+            jobs.enqueue('test_unfinished', {})
+            db.session.commit()
+
+            self.assertEqual(jobs.run_pending(), 1)
+        finally:
+            del jobs.handlers['test_unfinished']
+
+        job = Job.query.one()
+        self.assertEqual(job.state, 'running')
+        self.assertIsNotNone(job.locked_until)
+        self.assertEqual(Message.query.count(), messages)
+
+    def test_work_survives_errors(self):
+        """Does a worker carry on after pruning fails?"""
+
+        stop = threading.Event()
+        calls = []
+
+        def prune():
+            calls.append(1)
+            if len(calls) == 2:
+                stop.set()
+            raise RuntimeError("database went away")
+
+        jobs.enqueue('test_batch', {'n': 1})
+        db.session.commit()
+
+        with patch.object(jobs, 'prune', side_effect=prune):
+            jobs.work(stop, prune_every=-1)
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.batches, [[{'n': 1}]])
+
+    def test_rename_reindexes_mentions(self):
+        """Does a username change move mentions of the new name to its user?"""
+
+        User.query.delete()
+        user = User.signup("old", "old@test.com", "password", None)
+        db.session.commit()
+        user_id = user.id
+
+        db.session.add(Message(text="Hello @new", user_id=user_id))
+        db.session.commit()
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        client.post("/users/profile", data={"username": "new", "email": "old@test.com",
+                                            "password": "password"})
+
+        jobs.run_pending()
+        self.assertEqual([m.user_id for m in Mention.query.all()], [user_id])
+
+    def test_author_snapshot_follows_profile(self):
+        """Are a profile's new username and avatar copied onto its messages?"""
+
+        User.query.delete()
+        user = User.signup("before", "before@test.com", "password", None)
+        db.session.commit()
+        user_id = user.id
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        client.post("/messages/new", data={"text": "Snapshot"})
+
+        msg = Message.query.one()
+        self.assertEqual(msg.author_username, "before")
+        self.assertEqual(msg.author_image_url, "/static/images/default-pic.png")
+
+        client.post("/users/profile", data={"username": "after", "email": "before@test.com",
+                                            "image_url": "/after.png", "password": "password"})
+        jobs.run_pending()
+        self.assertEqual(Message.query.one().author_username, "before")
+
+        # Once the consistency window has passed, the job brings them up to date.
+        Job.query.filter_by(kind='update_authors').update({'run_at': datetime.utcnow()})
+        db.session.commit()
+        jobs.run_pending()
+
+        msg = Message.query.one()
+        self.assertEqual((msg.author_username, msg.author_image_url), ("after", "/after.png"))
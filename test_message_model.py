@@ -4,7 +4,8 @@ from sqlalchemy import exc
 
 from models import db, User, Message, Likes
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "postgresql:///warbler-test")
 
 # Now we can import app
 
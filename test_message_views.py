@@ -6,21 +6,31 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, connect_db, Message, User
+from models import (db, connect_db, Message, User, MessageTag, Mention,
+                    ArchivedMessage, ArchivedLike, Job, Follows, Likes)
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
-# connected to the database
+# connected to the database; TEST_DATABASE_URL=sqlite:///test.db runs
+# them on an embedded SQLite file instead of Postgres)
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "postgresql:///warbler-test")
 
 
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from archive import archive_messages
+from export import export_records
+from jobs import jobs
+from search import parse_cursor, scan_messages, search_messages
+from tags import reindex
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -41,6 +51,7 @@ class MessageViewTestCase(TestCase):
 
         User.query.delete()
         Message.query.delete()
+        Job.query.delete()
 
         self.client = app.test_client()
 
@@ -187,3 +198,238 @@ class MessageViewTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 200)
             self.assertIn("Access unauthorized.", html)
+
+    def test_timeline_new(self):
+        """Does the new-warbles check count only newer followed messages?"""
+
+        other = User.signup("other", "other@test.com", "password", None)
+        db.session.commit()
+
+        m1 = Message(text="old", user_id=self.testuser.id)
+        db.session.add(m1)
+        db.session.commit()
+        m2 = Message(text="new", user_id=self.testuser.id)
+        m3 = Message(text="not followed", user_id=other.id)
+        db.session.add_all([m2, m3])
+        db.session.commit()
+        since, newest = m1.id, m2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get(f"/api/timeline/new?since={since}")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.get_json(), {'count': 1, 'newest': newest})
+
+    def test_timeline_stream_resumes(self):
+        """Does a reconnecting stream resume after its Last-Event-ID?"""
+
+        m1 = Message(text="announced", user_id=self.testuser.id)
+        db.session.add(m1)
+        db.session.commit()
+        m2 = Message(text="not yet", user_id=self.testuser.id)
+        db.session.add(m2)
+        db.session.commit()
+        since, newest = m1.id, m2.id
+
+        heartbeat = app.config['LIVE_HEARTBEAT']
+        app.config['LIVE_HEARTBEAT'] = 0.01
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                resp = c.get("/api/timeline/stream?since=0", buffered=False,
+                             headers={'Last-Event-ID': str(since)})
+                chunks = iter(resp.response)
+                next(chunks)
+                event = next(chunks)
+                resp.close()
+        finally:
+            app.config['LIVE_HEARTBEAT'] = heartbeat
+
+        event = event.decode() if isinstance(event, bytes) else event
+        self.assertTrue(event.startswith(f"id: {newest}\n"))
+        self.assertIn(f'"ids": [{newest}]', event)
+
+    def test_home_timeline(self):
+        """Does the homepage show own and followed messages, with likes, from both tiers?"""
+
+        followed = User.signup("followed", "followed@test.com", "password", None)
+        other = User.signup("other", "other@test.com", "password", None)
+        db.session.commit()
+
+        db.session.add_all([
+            Follows(user_being_followed_id=followed.id, user_following_id=self.testuser.id),
+            Message(id=8181, text="liked long ago", user_id=followed.id,
+                    timestamp=datetime(2010, 1, 1)),
+            Message(id=8282, text="followed today", user_id=followed.id,
+                    timestamp=datetime.utcnow()),
+            Message(id=8383, text="mine today", user_id=self.testuser.id,
+                    timestamp=datetime.utcnow(), author_username="snapshot",
+                    author_image_url="/static/images/snapshot.png"),
+            Message(id=8484, text="not followed", user_id=other.id,
+                    timestamp=datetime.utcnow()),
+        ])
+        db.session.flush()
+        db.session.add(Likes(user_id=self.testuser.id, message_id=8181))
+        db.session.commit()
+        archive_messages(datetime(2015, 1, 1))
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            html = c.get("/").get_data(as_text=True)
+
+            self.assertIn("followed today", html)
+            self.assertIn("mine today", html)
+            self.assertNotIn("not followed", html)
+            self.assertLess(html.index("followed today"), html.index("liked long ago"))
+            self.assertIn('action="users/unlike/8181"', html)
+            self.assertIn('action="/users/add_like/8282"', html)
+            # Snapshots are shown as they are; messages without one, from `users`.
+            self.assertIn(">@snapshot</a>", html)
+            self.assertNotIn(">@testuser</a>", html)
+            self.assertIn(">@followed</a>", html)
+
+    def test_add_message_indexes_tags(self):
+        """Are a new message's hashtags and mentions indexed?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Hi @testuser, #Flask and #flask!"})
+            self.assertEqual(MessageTag.query.count(), 0)
+            self.assertEqual(jobs.run_pending(), 1)
+
+            msg = Message.query.one()
+            self.assertEqual([t.tag for t in MessageTag.query.all()], ['flask'])
+            self.assertEqual([(m.user_id, m.message_id) for m in Mention.query.all()],
+                             [(self.testuser.id, msg.id)])
+
+            resp = c.get("/tags/FLASK")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('<a href="/tags/flask">#Flask</a>', html)
+
+            resp = c.get(f"/users/{self.testuser.id}/mentions")
+
+            self.assertIn('#flask', resp.get_data(as_text=True))
+
+    def test_search(self):
+        """Are messages found by their words, and paged?"""
+
+        db.session.add_all([
+            Message(text="warbling about databases", user_id=self.testuser.id),
+            Message(text="databases, databases everywhere", user_id=self.testuser.id),
+            Message(text="nothing to see", user_id=self.testuser.id),
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/search?q=databases")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("warbling about databases", html)
+            self.assertIn("databases everywhere", html)
+            self.assertNotIn("nothing to see", html)
+
+        app.config['MESSAGES_PER_PAGE'] = 1
+        try:
+            with self.client as c:
+                html = c.get("/search?q=databases").get_data(as_text=True)
+                self.assertIn("databases everywhere", html)
+                self.assertNotIn("warbling about databases", html)
+                self.assertIn("/search?", html)
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 50
+
+        with self.client as c:
+            for after in ("garbage", "1.5", "x:y"):
+                resp = c.get(f"/search?q=databases&after={after}")
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn("databases everywhere", resp.get_data(as_text=True))
+
+        with patch('search.MAX_CANDIDATES', 1):
+            messages, cursor = search_messages("databases")
+            self.assertEqual([m.text for m in messages], ["databases, databases everywhere"])
+            self.assertIsNone(cursor)
+
+        messages, cursor = scan_messages("DATABASES", None, 1)
+        self.assertEqual(len(messages), 1)
+        messages, cursor = scan_messages("DATABASES", parse_cursor(cursor), 1)
+        self.assertEqual([m.text for m in messages], ["warbling about databases"])
+        self.assertIsNone(cursor)
+
+    def test_archived_messages(self):
+        """Are archived messages moved, yet still shown on profile pages?"""
+
+        old = Message(id=6161, text="from long ago", user_id=self.testuser.id,
+                      timestamp=datetime(2010, 1, 1))
+        new = Message(id=7171, text="from today", user_id=self.testuser.id,
+                      timestamp=datetime.utcnow())
+        db.session.add_all([old, new])
+        db.session.commit()
+
+        moved = archive_messages(datetime(2015, 1, 1))
+
+        self.assertEqual(moved, 1)
+        self.assertEqual([m.id for m in Message.query.all()], [7171])
+        self.assertEqual([m.id for m in ArchivedMessage.query.all()], [6161])
+
+        with self.client as c:
+            html = c.get(f"/users/{self.testuser.id}").get_data(as_text=True)
+
+            self.assertLess(html.index("from today"), html.index("from long ago"))
+
+            resp = c.get("/messages/6161")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("from long ago", resp.get_data(as_text=True))
+
+    def test_archived_messages_indexed(self):
+        """Do archived messages keep their tags, mentions, search and likes?"""
+
+        old = Message(id=6262, text="#vintage databases for @testuser",
+                      user_id=self.testuser.id, timestamp=datetime(2010, 1, 1))
+        db.session.add(old)
+        db.session.flush()
+        reindex([6262])
+        db.session.commit()
+
+        archive_messages(datetime(2015, 1, 1))
+        user_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            for path in ("/tags/vintage", f"/users/{user_id}/mentions",
+                         "/search?q=vintage"):
+                html = c.get(path).get_data(as_text=True)
+                self.assertIn("databases for @testuser", html, path)
+
+            resp = c.post("/users/add_like/6262")
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(ArchivedLike.query.filter_by(message_id=6262).count(), 1)
+
+            html = c.get(f"/users/{user_id}/likes").get_data(as_text=True)
+            self.assertIn("databases for @testuser", html)
+            self.assertEqual(User.query.get(user_id).counts()['likes'], 1)
+            self.assertEqual(User.query.get(user_id).counts()['messages'], 1)
+
+            exported = {(r['type'], r['id']) for r in export_records(user_id)}
+            self.assertLessEqual({('message', 6262), ('like', 6262)}, exported)
+
+            c.post("/users/unlike/6262")
+            self.assertEqual(ArchivedLike.query.count(), 0)
+
+            self.assertEqual(c.post("/users/add_like/999999").status_code, 404)
@@ -0,0 +1,105 @@
+"""Request profiling tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiling.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from flask import Flask, Response
+
+from models import db
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "postgresql:///warbler-test")
+
+from app import app
+from profiling import ProfilerMiddleware, check_token, make_token
+
+db.create_all()
+
+
+class ProfilingTestCase(TestCase):
+    """Test profiling tokens, on-demand profiles and sampling."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.config = {key: app.config[key] for key in
+                       ('PROFILE_DIR', 'PROFILE_SAMPLE_RATE', 'PROFILE_FLUSH_EVERY')}
+        app.config['PROFILE_DIR'] = self.directory.name
+
+    def tearDown(self):
+        app.config.update(self.config)
+        self.directory.cleanup()
+
+    def test_token(self):
+        """Is a token only good for the path it was signed for?"""
+
+        token = make_token(app, '/users')
+
+        self.assertTrue(check_token(app, token, '/users'))
+        self.assertFalse(check_token(app, token, '/login'))
+        self.assertFalse(check_token(app, token + 'x', '/users'))
+        self.assertFalse(check_token(app, 'garbage', '/users'))
+
+    def test_on_demand_profile(self):
+        """Does a request with a token leave a folded profile behind?"""
+
+        token = make_token(app, '/users')
+
+        resp = app.test_client().get('/users', headers={'X-Warbler-Profile': token})
+        resp.close()
+
+        self.assertEqual(resp.status_code, 200)
+        names = os.listdir(self.directory.name)
+        self.assertEqual(len(names), 1)
+        self.assertTrue(names[0].startswith('list_users-'))
+
+        app.test_client().get('/users', headers={'X-Warbler-Profile': 'garbage'}).close()
+
+        self.assertEqual(len(os.listdir(self.directory.name)), 1)
+
+    def test_sampled_requests_merge(self):
+        """Are sampled stacks added to what other processes have flushed?"""
+
+        app.config['PROFILE_SAMPLE_RATE'] = 1
+        app.config['PROFILE_FLUSH_EVERY'] = 2
+        path = os.path.join(self.directory.name, 'sampled-list_users.folded')
+        with open(path, 'w') as f:
+            f.write("elsewhere (other.py:1) 5\n")
+
+        client = app.test_client()
+        for _ in range(2):
+            client.get('/users').close()
+
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertIn("elsewhere (other.py:1) 5", lines)
+
+    def test_streamed_response(self):
+        """Is a sampled streamed response passed on as it's produced?"""
+
+        streaming = Flask(__name__)
+        streaming.config['PROFILE_SAMPLE_RATE'] = 1
+        profiler = ProfilerMiddleware(streaming)
+        streaming.wsgi_app = profiler
+
+        @streaming.route('/stream')
+        def stream():
+            def events():
+                yield "first\n"
+                yield "second\n"
+            return Response(events())
+
+        resp = streaming.test_client().get('/stream', buffered=False)
+        chunks = iter(resp.response)
+
+        self.assertEqual(next(chunks), b"first\n")
+        self.assertEqual(profiler.sampled['stream'], 0)
+
+        resp.close()
+
+        self.assertEqual(profiler.sampled['stream'], 1)
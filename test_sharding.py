@@ -0,0 +1,178 @@
+"""Sharding tests, on two SQLite shard databases."""
+
+# run these tests like:
+#
+#    python -m unittest test_sharding.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, Message, ShardAssignment, User
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "postgresql:///warbler-test")
+
+from app import app, CURR_USER_KEY
+from export import export_records
+from importer import import_lines
+from sharding import ID_STRIDE, shard_metadata, shards
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+SHARD_DIR = tempfile.mkdtemp()
+app.config['SQLALCHEMY_BINDS'] = {
+    name: f"sqlite:///{os.path.join(SHARD_DIR, name)}.db"
+    for name in ('shard0', 'shard1')
+}
+
+
+class ShardingTestCase(TestCase):
+    """Test routing of messages, likes and follows to users' shards."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        shards.configure(['shard0', 'shard1'])
+        for name in shards.names:
+            shard_metadata.drop_all(shards.engine(name))
+        shards.create_tables()
+
+        for id, name in ((1, "one"), (2, "two"), (3, "three")):
+            user = User.signup(name, f"{name}@test.com", "password", None)
+            user.id = id
+            db.session.flush()
+            shards.place(id)
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        shards.configure([])
+        db.session.rollback()
+        self.ctx.pop()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def post(self, user_id, text):
+        self.login(user_id)
+        return self.client.post("/messages/new", data={"text": text})
+
+    def shard_rows(self, name, query):
+        return shards.engine(name).execute(query).fetchall()
+
+    def test_messages_follow_their_author(self):
+        """Are messages stored on their author's shard, with its id range?"""
+
+        self.post(1, "From shard one")
+        self.post(2, "From shard zero")
+
+        one = self.shard_rows('shard1', Message.__table__.select())
+        zero = self.shard_rows('shard0', Message.__table__.select())
+
+        self.assertEqual([m.text for m in one], ["From shard one"])
+        self.assertEqual([m.text for m in zero], ["From shard zero"])
+        self.assertEqual(one[0].id, ID_STRIDE + 1)
+        self.assertEqual(zero[0].id, 1)
+
+    def test_timeline_gathers_shards(self):
+        """Does the timeline merge messages from followed users' shards?"""
+
+        self.post(2, "Followed on shard zero")
+        self.post(1, "Mine on shard one")
+
+        self.login(1)
+        self.client.post("/users/follow/2")
+        html = self.client.get("/").get_data(as_text=True)
+
+        self.assertIn("Followed on shard zero", html)
+        self.assertIn("Mine on shard one", html)
+
+        html = self.client.get("/users/2/followers").get_data(as_text=True)
+        self.assertIn("@one", html)
+
+    def test_move_user(self):
+        """Does a moved user's data go with them, and stay readable?"""
+
+        self.post(1, "Moving house")
+        message_id = ID_STRIDE + 1
+
+        moved = shards.move_user(1, 'shard0')
+
+        self.assertEqual(moved, 1)
+        self.assertEqual(ShardAssignment.query.get(1).shard, 'shard0')
+        self.assertEqual(self.shard_rows('shard1', Message.__table__.select()), [])
+
+        self.login(1)
+        resp = self.client.get(f"/messages/{message_id}")
+        self.assertIn("Moving house", resp.get_data(as_text=True))
+
+    def test_import_export(self):
+        """Are imports written to, and exports read from, users' shards?"""
+
+        summary = import_lines(1, ['{"type": "message", "text": "Imported"}',
+                                   '{"type": "follow", "username": "two"}'])
+
+        self.assertEqual((summary['messages'], summary['follows']), (1, 1))
+        one = self.shard_rows('shard1', Message.__table__.select())
+        self.assertEqual([(m.id, m.text) for m in one], [(ID_STRIDE + 1, "Imported")])
+
+        self.login(2)
+        self.client.post(f"/users/add_like/{ID_STRIDE + 1}")
+
+        records = list(export_records(1))
+        self.assertIn({'type': 'following', 'id': 2, 'username': "two"}, records)
+        self.assertEqual([r['text'] for r in records if r['type'] == 'message'],
+                         ["Imported"])
+
+        records = list(export_records(2))
+        self.assertIn({'type': 'follower', 'id': 1, 'username': "one"}, records)
+        self.assertEqual([(r['id'], r['user_id']) for r in records if r['type'] == 'like'],
+                         [(ID_STRIDE + 1, 1)])
+
+    def test_live_updates_off(self):
+        """Are live updates refused, and not offered, while sharded?"""
+
+        self.login(1)
+
+        self.assertEqual(self.client.get("/api/timeline/new?since=0").status_code, 501)
+        self.assertEqual(self.client.get("/api/timeline/stream").status_code, 501)
+        self.assertNotIn("EventSource", self.client.get("/").get_data(as_text=True))
+
+    def test_indexes_off(self):
+        """Are tag, mention and search pages refused while sharded?"""
+
+        self.post(1, "#sharded hello @two")
+
+        for path in ("/tags/sharded", "/users/2/mentions", "/search?q=hello"):
+            self.assertEqual(self.client.get(path).status_code, 501, path)
+
+    def test_writes_refused_while_moving(self):
+        """Are a user's writes turned away while their rows are moving?"""
+
+        ShardAssignment.query.get(1).moving = True
+        db.session.commit()
+
+        resp = self.post(1, "Too soon")
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn('Retry-After', resp.headers)
+
+    def test_plan_rebalance(self):
+        """Are users planned off the fuller shard until loads are close?"""
+
+        for i in range(10):
+            self.post(1, f"Busy {i}")
+        for i in range(2):
+            self.post(3, f"Quiet {i}")
+
+        self.assertEqual(shards.plan_rebalance(), [(3, 'shard1', 'shard0')])
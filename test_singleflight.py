@@ -0,0 +1,124 @@
+"""Single-flight and version stamp tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_singleflight.py
+
+
+import os
+import threading
+from unittest import TestCase
+
+from models import db, Likes, Message, User
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "postgresql:///warbler-test")
+
+from app import app
+from singleflight import SingleFlight
+from versions import versions
+
+db.create_all()
+
+
+class SingleFlightTestCase(TestCase):
+    """Test coalescing of concurrent computations."""
+
+    def test_concurrent_calls_share_result(self):
+        """Do callers arriving mid-computation get the leader's result?"""
+
+        flights = SingleFlight(timeout=5)
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return "page"
+
+        results = []
+        leader = threading.Thread(
+            target=lambda: results.append(flights.run('k', compute)))
+        leader.start()
+        started.wait(5)
+
+        follower = threading.Thread(
+            target=lambda: results.append(flights.run('k', compute)))
+        follower.start()
+        while flights._calls[('k', ())].waiters < 1:
+            pass
+        release.set()
+        leader.join()
+        follower.join()
+
+        self.assertEqual(results, ["page", "page"])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flights.saved['k'], 1)
+
+    def test_different_stamps_not_shared(self):
+        """Does a new version stamp start a computation of its own?"""
+
+        flights = SingleFlight()
+
+        self.assertEqual(flights.run('k', lambda: 1, stamp=(1,)), 1)
+        self.assertEqual(flights.run('k', lambda: 2, stamp=(2,)), 2)
+        self.assertEqual(flights.stats['leaders'], 2)
+
+    def test_timeout_computes_own_result(self):
+        """Does a caller stop waiting after the timeout?"""
+
+        flights = SingleFlight(timeout=0.01)
+        release = threading.Event()
+        leader = threading.Thread(
+            target=lambda: flights.run('k', lambda: release.wait(5)))
+        leader.start()
+        while not flights._calls:
+            pass
+
+        self.assertEqual(flights.run('k', lambda: "own"), "own")
+        self.assertEqual(flights.stats['timeouts'], 1)
+
+        release.set()
+        leader.join()
+
+
+class VersionsTestCase(TestCase):
+    """Test version bumps on commit."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.user = User.signup("versions", "versions@test.com", "password", None)
+        db.session.commit()
+        self.message = Message(text="versioned", user_id=self.user.id)
+        db.session.add(self.message)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_like_bumps_message_and_user(self):
+        """Does committing a like change the message's and liker's stamps?"""
+
+        user_id, message_id = self.user.id, self.message.id
+        before = versions.stamp(f'user:{user_id}', f'message:{message_id}')
+
+        db.session.add(Likes(user_id=user_id, message_id=message_id))
+        db.session.commit()
+
+        after = versions.stamp(f'user:{user_id}', f'message:{message_id}')
+        self.assertEqual([b + 1 for b in before], list(after))
+
+    def test_rollback_does_not_bump(self):
+        """Are changes that never commit left out?"""
+
+        user_id = self.user.id
+        before = versions.stamp(f'user:{user_id}')
+
+        db.session.add(Message(text="rolled back", user_id=user_id))
+        db.session.flush()
+        db.session.rollback()
+
+        self.assertEqual(versions.stamp(f'user:{user_id}'), before)
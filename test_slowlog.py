@@ -0,0 +1,85 @@
+"""Slow-query log tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_slowlog.py
+
+
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from sqlalchemy import exc
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "postgresql:///warbler-test")
+
+from app import app
+from slowlog import redact, slow_query_log
+
+db.create_all()
+
+
+class SlowQueryLogTestCase(TestCase):
+    """Test logging of slow statements."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.old = (slow_query_log.threshold, slow_query_log.path)
+        slow_query_log.open(os.path.join(self.dir.name, "slow.log"))
+        slow_query_log._explained.clear()
+
+    def tearDown(self):
+        threshold, path = self.old
+        slow_query_log.threshold = threshold
+        slow_query_log.open(path)
+        self.dir.cleanup()
+
+    def test_redact(self):
+        """Is text hidden but numbers and dates kept?"""
+
+        when = datetime(2020, 1, 2)
+
+        self.assertEqual(
+            redact({'username_1': 'bob', 'id_1': 7, 'password': 12, 'ts': when}),
+            {'username_1': '<str len=3>', 'id_1': 7, 'password': '<redacted>',
+             'ts': '2020-01-02T00:00:00'})
+        self.assertEqual(redact((1, 'x', None)), [1, '<str len=1>', None])
+
+    def test_slow_statement_logged(self):
+        """Is a statement over the threshold logged with its plan?"""
+
+        slow_query_log.threshold = 0.000001
+
+        User.query.filter(User.username == "nobody").all()
+        entries = slow_query_log.slowest(50)
+
+        entry = [e for e in entries if 'FROM users' in e['statement']][0]
+        self.assertIsNone(entry['route'])
+        parameters = entry['parameters']
+        if isinstance(parameters, dict):
+            # Named (e.g. psycopg2's pyformat) parameters.
+            parameters = list(parameters.values())
+        self.assertIn('<str len=6>', parameters)
+        self.assertTrue(entry['plan'])
+
+    def test_fast_statement_skipped(self):
+        """Are statements under the threshold left out?"""
+
+        slow_query_log.threshold = 60000
+
+        User.query.all()
+
+        self.assertEqual(slow_query_log.slowest(), [])
+
+    def test_failed_statement_forgotten(self):
+        """Is the start time of a statement that raises dropped?"""
+
+        with db.engine.connect() as conn:
+            with self.assertRaises(exc.DBAPIError):
+                conn.execute("SELECT * FROM no_such_table")
+
+            self.assertEqual(conn.info.get('slowlog_start'), [])
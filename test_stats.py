@@ -0,0 +1,131 @@
+"""Stats log tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_stats.py
+
+
+import json
+import logging
+import os
+import threading
+import time
+from unittest import TestCase
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "postgresql:///warbler-test")
+
+from app import app, compressor, degrader, limiter, CURR_USER_KEY
+from singleflight import flights
+from stats import stats_log
+
+db.create_all()
+
+
+class Lines(logging.Handler):
+    """Keeps the JSON lines logged to it."""
+
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+        self.logged = threading.Event()
+
+    def emit(self, record):
+        self.lines.append(json.loads(record.getMessage()))
+        self.logged.set()
+
+
+class StatsLogTestCase(TestCase):
+    """Test periodic logging of in-process counters."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        user = User.signup("stats", "stats@test.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+        self.handler = Lines()
+        stats_log.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        stats_log.logger.removeHandler(self.handler)
+        db.session.rollback()
+
+    def test_report(self):
+        """Is every counter written, with the process's pid?"""
+
+        resp = app.test_client().get(f"/users/{self.user_id}")
+        self.assertEqual(resp.status_code, 200)
+
+        stats_log.report()
+        line = self.handler.lines[-1]
+
+        self.assertEqual(line['pid'], os.getpid())
+        self.assertEqual(line['degrade'], dict(degrader.stats))
+        self.assertGreaterEqual(line['degrade']['fresh'], 1)
+
+    def test_rate_limit_rejections(self):
+        """Are the rate limiter's rejections, per rule, in the line?"""
+
+        before = limiter.rejected['search']
+        limiter.reject('search')
+
+        stats_log.report()
+        line = self.handler.lines[-1]
+
+        self.assertEqual(line['ratelimit_rejected']['search'], before + 1)
+
+    def test_compression(self):
+        """Are the compressor's responses, bytes and CPU time in the line?"""
+
+        before = compressor.stats['gzip_responses']
+        resp = app.test_client().get(f"/users/{self.user_id}",
+                                     headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+
+        stats_log.report()
+        line = self.handler.lines[-1]
+
+        self.assertEqual(line['compression']['gzip_responses'], before + 1)
+        self.assertGreater(line['compression']['gzip_bytes_in'],
+                           line['compression']['gzip_bytes_out'])
+
+    def test_singleflight(self):
+        """Are the single-flight's computations run and shared in the line?"""
+
+        before = flights.stats['leaders']
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            c.get(f"/users/{self.user_id}")
+
+        stats_log.report()
+        line = self.handler.lines[-1]
+
+        self.assertGreater(line['singleflight']['leaders'], before)
+
+    def test_reported_periodically(self):
+        """Does a worker's thread write a line every interval?"""
+
+        interval, pid = stats_log.interval, stats_log._pid
+        self.addCleanup(setattr, stats_log, 'interval', interval)
+        self.addCleanup(setattr, stats_log, '_pid', pid)
+
+        stats_log.interval = 0.01
+        stats_log._pid = None
+        stats_log.start()
+
+        self.assertTrue(self.handler.logged.wait(5))
+        self.assertIn('degrade', self.handler.lines[0])
+
+        # An interval of 0 stops the thread (which then forgets its pid).
+        stats_log.interval = 0
+        for _ in range(500):
+            if stats_log._pid is None:
+                break
+            time.sleep(0.01)
+        self.assertIsNone(stats_log._pid)
@@ -0,0 +1,59 @@
+"""Template bytecode cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_templating.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "postgresql:///warbler-test")
+
+from app import app
+from templating import init_bytecode_cache, precompile_command
+
+db.create_all()
+
+
+class TemplatingTestCase(TestCase):
+    """Test precompiling templates into, and loading them from, the cache."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.config = app.config['JINJA_CACHE_DIR']
+        self.cache = app.jinja_env.bytecode_cache
+
+        app.config['JINJA_CACHE_DIR'] = self.directory.name
+        init_bytecode_cache(app)
+        app.jinja_env.cache.clear()
+
+    def tearDown(self):
+        app.config['JINJA_CACHE_DIR'] = self.config
+        app.jinja_env.bytecode_cache = self.cache
+        app.jinja_env.cache.clear()
+        self.directory.cleanup()
+
+    def test_precompile(self):
+        """Are templates compiled into the cache, and later loaded from it?"""
+
+        result = app.test_cli_runner().invoke(precompile_command)
+
+        self.assertEqual(result.exit_code, 0)
+        templates = app.jinja_env.list_templates(filter_func=lambda n: n.endswith('.html'))
+        self.assertIn(f"Compiled {len(templates)} templates", result.output)
+        self.assertEqual(len(os.listdir(self.directory.name)), len(templates))
+
+        # A new worker's first render reads the cache instead of compiling.
+        app.jinja_env.cache.clear()
+        with patch.object(app.jinja_env, 'compile',
+                          side_effect=AssertionError("compiled")) as compile:
+            resp = app.test_client().get("/signup")
+
+        self.assertEqual(resp.status_code, 200)
+        compile.assert_not_called()
@@ -12,9 +12,11 @@ from models import db, User, Message, Follows
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
-# connected to the database
+# connected to the database; TEST_DATABASE_URL=sqlite:///test.db runs
+# them on an embedded SQLite file instead of Postgres)
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "postgresql:///warbler-test")
 
 # Now we can import app
 
@@ -5,22 +5,36 @@
 #    FLASK_ENV=production python -m unittest test_user_views.py
 
 
+import gzip
+import json
 import os
+import threading
+import time
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, connect_db, Message, User, Follows, Likes
+from flask import _request_ctx_stack
+from sqlalchemy import exc
+
+from models import db, connect_db, Message, User, Follows, Likes, MessageTag
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
-# connected to the database
+# connected to the database; TEST_DATABASE_URL=sqlite:///test.db runs
+# them on an embedded SQLite file instead of Postgres)
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', "postgresql:///warbler-test")
 
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, degrader, limiter, page_cache, CURR_USER_KEY
+from availability import Availability, availability
+from importer import import_lines
+from limits import MemoryStore
+from warmup import warm_up_command
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -57,6 +71,13 @@ class UserViewTestCase(TestCase):
         db.session.add_all([self.u1, self.u2])
         db.session.commit()
 
+    def tearDown(self):
+        # A streamed page read inside `with self.client` can leave its
+        # request context pushed (Flask 1.0); popped by a later test, it
+        # would take that test's session with it.
+        while _request_ctx_stack.top is not None:
+            _request_ctx_stack.top.pop()
+
     def test_list_users(self):
         """Do all users get listed?"""
 
@@ -86,6 +107,23 @@ class UserViewTestCase(TestCase):
             self.assertIn('second text for user', html)
             self.assertIn('testuser', html)
 
+    def test_show_users_timing(self):
+        """Are the profile's queries gathered and timed, follow button included?"""
+
+        self.setup_follows()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 2323
+
+            resp = c.get("/users/1212")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Unfollow', html)
+            self.assertIn('following;dur=', resp.headers['Server-Timing'])
+            self.assertIn('gather-', resp.headers['Server-Timing'])
+
     def setup_follows(self):
         u3 = User.signup("testuser3", "test3@test.com", "password3", None)
         u3.id = 4545
@@ -401,4 +439,349 @@ class UserViewTestCase(TestCase):
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn("Unauthorized, can not delete like.", html)
\ No newline at end of file
+            self.assertIn("Unauthorized, can not delete like.", html)
+
+    def test_login_rate_limited(self):
+        """Are repeated logins from one client turned away with a 429?"""
+
+        limiter.store.clear()
+        limiter.rejected.clear()
+        attempts, per = limiter.rules['login']
+
+        with self.client as c:
+            for i in range(attempts):
+                resp = c.post('/login', data={"username": "nobody",
+                                              "password": "wrongpass"})
+                self.assertEqual(resp.status_code, 200)
+
+            resp = c.post('/login', data={"username": "nobody",
+                                          "password": "wrongpass"})
+
+            self.assertEqual(resp.status_code, 429)
+            self.assertIn('Retry-After', resp.headers)
+            self.assertEqual(limiter.rejected['login'], 1)
+
+        limiter.store.clear()
+
+    def test_rate_limit_buckets_drawn_together(self):
+        """Does a request the user's bucket turns away leave the IP's alone?"""
+
+        store = MemoryStore()
+
+        self.assertTrue(store.take(['ip', 'user'], 0.001, 1))
+        self.assertFalse(store.take(['ip', 'other-user'], 0.001, 1))
+        self.assertTrue(store.take(['ip2', 'other-user'], 0.001, 1))
+
+        store = MemoryStore()
+        store.take(['user'], 0.001, 1)
+
+        self.assertFalse(store.take(['ip', 'user'], 0.001, 1))
+        self.assertTrue(store.take(['ip'], 0.001, 1))
+
+    def test_rate_limit_store_bounded(self):
+        """Are the least recently used buckets dropped past MAX_KEYS?"""
+
+        store = MemoryStore()
+        store.MAX_KEYS = 2
+
+        store.take(['a'], 0.001, 1)
+        store.take(['b'], 0.001, 1)
+        self.assertFalse(store.take(['a'], 0.001, 1))
+        store.take(['c'], 0.001, 1)
+
+        self.assertEqual(list(store._buckets), ['a', 'c'])
+        self.assertTrue(store.take(['b'], 0.001, 1))
+
+    def test_list_users_paginated(self):
+        """Does /users page by id and link to the next page?"""
+
+        app.config['USERS_PER_PAGE'] = 1
+
+        try:
+            with self.client as c:
+                resp = c.get("/users")
+                html = resp.get_data(as_text=True)
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn('@testuser<', html)
+                self.assertNotIn('@testuser2', html)
+                self.assertIn(f'/users?after={self.u1.id}', html)
+
+                resp = c.get(f"/users?after={self.u1.id}")
+                html = resp.get_data(as_text=True)
+
+                self.assertIn('@testuser2', html)
+                self.assertNotIn('/users?after=', html)
+        finally:
+            app.config['USERS_PER_PAGE'] = 48
+
+    def test_export_data(self):
+        """Does the export stream the user's data as gzipped NDJSON?"""
+
+        self.setup_follows()
+        m = Message(id=3131, text="exported warble", user_id=self.u1.id)
+        db.session.add(m)
+        db.session.commit()
+        timestamp = m.timestamp.isoformat()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+
+            resp = c.get(f"/users/{self.u1.id}/export")
+            records = [json.loads(line) for line in
+                       gzip.decompress(resp.get_data()).splitlines()]
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'application/gzip')
+            self.assertIn({'type': 'message', 'id': 3131, 'user_id': self.u1.id,
+                           'text': 'exported warble',
+                           'timestamp': timestamp}, records)
+            self.assertEqual(
+                sorted(r['username'] for r in records if r['type'] == 'following'),
+                ['abcdef', 'testuser3'])
+            self.assertEqual(
+                sorted(r['username'] for r in records if r['type'] == 'follower'),
+                ['abcdef', 'testuser2'])
+
+    def test_export_data_other_user(self):
+        """Can a user export someone else's data?"""
+
+        u1_id = self.u1.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2.id
+
+            resp = c.get(f"/users/{u1_id}/export", follow_redirects=True)
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Access unauthorized.", html)
+
+    def test_import_data(self):
+        """Are NDJSON messages and follows imported in bulk?"""
+
+        u1_id = self.u1.id
+        lines = [
+            {"type": "message", "text": "imported one",
+             "timestamp": "2015-03-01T10:00:00"},
+            {"type": "message", "text": "imported two #history"},
+            {"type": "message", "text": ""},
+            {"type": "follow", "username": "testuser2"},
+            {"type": "follow", "username": "nobody-here"},
+        ]
+        body = "\n".join(json.dumps(line) for line in lines) + "\nnot json\n"
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u1_id
+
+            resp = c.post("/users/import", data=body,
+                          content_type="application/x-ndjson")
+            summary = resp.get_json()
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(summary['messages'], 2)
+            self.assertEqual(summary['follows'], 1)
+            self.assertEqual(summary['skipped'], 3)
+            self.assertEqual([e['line'] for e in summary['errors']], [3, 6])
+
+        msg = Message.query.filter_by(text="imported one").one()
+        self.assertEqual(msg.user_id, u1_id)
+        self.assertEqual(msg.timestamp.year, 2015)
+        self.assertEqual(Follows.query.filter_by(user_following_id=u1_id).count(), 1)
+
+        tagged = Message.query.filter_by(text="imported two #history").one()
+        self.assertEqual([t.message_id for t in MessageTag.query.filter_by(tag='history')],
+                         [tagged.id])
+
+    def test_import_batches(self):
+        """Does each batch index its hashtags against the right messages?"""
+
+        u1_id = self.u1.id
+        lines = [json.dumps({"type": "message", "text": f"batched #tag{n}"})
+                 for n in range(5)]
+
+        summary = import_lines(u1_id, lines, batch_size=2)
+
+        self.assertEqual(summary['messages'], 5)
+        for n in range(5):
+            msg = Message.query.filter_by(text=f"batched #tag{n}").one()
+            self.assertEqual([t.message_id for t in MessageTag.query.filter_by(tag=f'tag{n}')],
+                             [msg.id])
+
+    def test_import_data_no_user(self):
+        """Is an anonymous import refused?"""
+
+        with self.client as c:
+            resp = c.post("/users/import", data='{"type": "follow"}')
+
+            self.assertEqual(resp.status_code, 401)
+
+    def test_compressed_response(self):
+        """Is a (streamed) page gzipped for clients that accept it?"""
+
+        with self.client as c:
+            resp = c.get("/users", headers={'Accept-Encoding': 'gzip'})
+            html = gzip.decompress(resp.get_data()).decode('utf-8')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', resp.headers['Vary'])
+            self.assertIn('@testuser2', html)
+
+            resp = c.get("/users")
+
+            self.assertNotIn('Content-Encoding', resp.headers)
+
+    def test_signup_taken_username(self):
+        """Is a taken username turned away before the password is hashed?"""
+
+        availability.rebuild()
+
+        with self.client as c, \
+                patch('models.bcrypt.generate_password_hash') as hash_password:
+            resp = c.post("/signup", data={"username": "testuser",
+                                           "email": "fresh@test.com",
+                                           "password": "password"})
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Username already taken", html)
+            hash_password.assert_not_called()
+
+    def test_users_available(self):
+        """Does the availability endpoint report taken names and emails?"""
+
+        availability.rebuild()
+
+        with self.client as c:
+            resp = c.get("/api/users/available?username=testuser&email=new@test.com")
+
+            self.assertEqual(resp.get_json(), {'username': False, 'email': True})
+
+            resp = c.get("/api/users/available?username=brand-new")
+
+            self.assertEqual(resp.get_json(), {'username': True})
+
+    def test_availability_renamed(self):
+        """Is a username taken by a profile edit reported as taken?"""
+
+        availability.rebuild()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1212
+
+            c.post("/users/profile", data={"username": "renamed",
+                                           "email": "test@test.com",
+                                           "password": "testuser"})
+
+            resp = c.get("/api/users/available?username=renamed")
+
+            self.assertEqual(resp.get_json(), {'username': False})
+            self.assertIn("renamed", availability.usernames)
+
+    def test_availability_single_rebuild(self):
+        """Do other requests keep the old filter while one rebuilds it?"""
+
+        checker = Availability(refresh=60)
+        checker.rebuild()
+        checker.built_at -= 120
+        started, release = threading.Event(), threading.Event()
+        rebuild = checker.rebuild
+
+        def slow_rebuild():
+            started.set()
+            release.wait(5)
+            rebuild()
+
+        with patch.object(checker, 'rebuild', side_effect=slow_rebuild) as rebuilding:
+            thread = threading.Thread(target=checker._fresh)
+            thread.start()
+            started.wait(5)
+
+            self.assertEqual(checker.taken(username="brand-new"), {'username': False})
+
+            release.set()
+            thread.join(5)
+
+        self.assertEqual(rebuilding.call_count, 1)
+        self.assertLess(time.monotonic() - checker.built_at, 60)
+
+    def test_warm_up(self):
+        """Does warm-up run the cache primers, rendering hot profiles?"""
+
+        self.setup_follows()
+        page_cache.clear()
+
+        result = app.test_cli_runner().invoke(warm_up_command)
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('cache:availability', result.output)
+        self.assertIn('cache:hot_profiles', result.output)
+        self.assertIn('/users/1212?', page_cache.entries)
+
+    def test_show_users_stale_when_db_slow(self):
+        """Is the last good profile served, marked stale, while the DB is slow?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1212
+
+            resp = c.get("/users/2323")
+            self.assertNotIn("Posted while slow", resp.get_data(as_text=True))
+
+            db.session.add(Message(text="Posted while slow", user_id=2323))
+            db.session.commit()
+
+            degrader.latency = 10 ** 6
+            degrader.sampled_at = time.monotonic()
+            self.addCleanup(setattr, degrader, 'latency', 0.0)
+
+            with patch.object(degrader, 'refresh') as refresh:
+                resp = c.get("/users/2323")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Response is Stale', resp.headers['Warning'])
+            self.assertIn("may be out of date", html)
+            self.assertNotIn("Posted while slow", html)
+            refresh.assert_called_once()
+
+    def test_degrader_failed_statement(self):
+        """Is a statement that raises still timed, and its start time dropped?"""
+
+        sampled_at = degrader.sampled_at
+
+        with db.engine.connect() as conn:
+            with self.assertRaises(exc.DBAPIError):
+                conn.execute("SELECT * FROM no_such_table")
+
+            self.assertEqual(conn.info.get('degrade_start'), [])
+        self.assertGreater(degrader.sampled_at, sampled_at)
+
+    def test_show_users_page_cache(self):
+        """Are anonymous profile views cached until the profile changes?"""
+
+        with self.client as c:
+            resp = c.get("/users/2323")
+            self.assertEqual(resp.headers['X-Page-Cache'], 'MISS')
+
+            resp = c.get("/users/2323")
+            self.assertEqual(resp.headers['X-Page-Cache'], 'HIT')
+            self.assertNotIn("Fresh warble", resp.get_data(as_text=True))
+
+            db.session.add(Message(text="Fresh warble", user_id=2323))
+            db.session.commit()
+
+            resp = c.get("/users/2323")
+            self.assertEqual(resp.headers['X-Page-Cache'], 'MISS')
+            self.assertIn("Fresh warble", resp.get_data(as_text=True))
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1212
+
+            resp = c.get("/users/2323")
+            self.assertNotIn('X-Page-Cache', resp.headers)
@@ -0,0 +1,102 @@
+"""Version stamps for cached and shared page data.
+
+Every user and message has a version, starting at 0, that goes up each
+time a commit changes something shown about it: `user:<id>` for a
+profile, its counters or its message list, `message:<id>` for a message
+and its likes. Keys built from `versions.stamp(...)` change with the data
+behind them, so nothing computed before a write is reused after it.
+
+ORM changes are picked up from session events. Bulk statements that skip
+the ORM (imports, archiving) call `versions.bump` themselves. Functions
+in `versions.listeners` are called with the names of every bump; bus.py
+uses this to share bumps with other worker processes, which `apply` them.
+"""
+
+import threading
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from models import Follows, Likes, Message, User
+
+
+def changed_names(instance):
+    """Version names affected by a flushed change to `instance`."""
+
+    if isinstance(instance, Message):
+        return {f'user:{instance.user_id}', f'message:{instance.id}'}
+
+    if isinstance(instance, Likes):
+        return {f'user:{instance.user_id}', f'message:{instance.message_id}'}
+
+    if isinstance(instance, Follows):
+        return {f'user:{instance.user_following_id}',
+                f'user:{instance.user_being_followed_id}'}
+
+    if isinstance(instance, User):
+        names = {f'user:{instance.id}'}
+        state = inspect(instance)
+        for attr, prefix in (('following', 'user'), ('followers', 'user'),
+                             ('likes', 'message')):
+            history = state.attrs[attr].history
+            for other in [*(history.added or ()), *(history.deleted or ())]:
+                names.add(f'{prefix}:{other.id}')
+        return names
+
+    return set()
+
+
+class Versions:
+    """In-process version counters, bumped when changes commit."""
+
+    def __init__(self):
+        self.listeners = []
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def bump(self, *names):
+        """Move `names` on, and tell the listeners."""
+
+        self.apply(*names)
+        for listener in self.listeners:
+            listener(names)
+
+    def apply(self, *names):
+        """Move `names` on, for a bump made elsewhere."""
+
+        with self._lock:
+            for name in names:
+                self._versions[name] = self._versions.get(name, 0) + 1
+
+    def stamp(self, *names):
+        """Current versions of `names`, as a tuple to build keys from."""
+
+        with self._lock:
+            return tuple(self._versions.get(name, 0) for name in names)
+
+    def track(self):
+        """Bump versions for ORM changes as their transactions commit."""
+
+        if event.contains(Session, 'after_flush', self._after_flush):
+            return
+
+        event.listen(Session, 'after_flush', self._after_flush)
+        event.listen(Session, 'after_commit', self._after_commit)
+        event.listen(Session, 'after_rollback', self._after_rollback)
+
+    def _after_flush(self, session, flush_context):
+        pending = session.info.setdefault('versions_pending', set())
+        for instance in (*session.new, *session.dirty, *session.deleted):
+            pending |= changed_names(instance)
+
+    def _after_commit(self, session):
+        pending = session.info.pop('versions_pending', None)
+        if pending:
+            self.bump(*pending)
+
+    def _after_rollback(self, session):
+        session.info.pop('versions_pending', None)
+
+
+versions = Versions()
+versions.track()
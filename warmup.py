@@ -0,0 +1,90 @@
+"""Per-worker warm-up, run before a worker takes traffic.
+
+Pre-fork servers should call `warm_up(app)` in each worker once it has
+loaded the app; for gunicorn, in gunicorn.conf.py:
+
+    def post_worker_init(worker):
+        from warmup import warm_up
+        warm_up(worker.wsgi)
+
+`flask warm-up` runs the same stages and prints their times.
+"""
+
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy.orm import configure_mappers
+
+from models import db
+from templating import compile_templates
+
+# (name, function of app) pairs of hot caches to fill; see `primer`.
+primers = []
+
+
+def primer(name):
+    """Decorator registering `function(app)` to fill a cache on warm-up."""
+
+    def decorator(function):
+        primers.append((name, function))
+        return function
+    return decorator
+
+
+def open_connections(app):
+    """Open the pool's connections now rather than on the first requests.
+
+    Connections inherited from a pre-fork parent are dropped first; they
+    must not be shared between processes.
+    """
+
+    engine = db.get_engine(app)
+    engine.dispose()
+
+    size = app.config.get('WARMUP_CONNECTIONS')
+    if size is None:
+        size = engine.pool.size() if hasattr(engine.pool, 'size') else 1
+
+    connections = [engine.connect() for _ in range(max(size, 1))]
+    for connection in connections:
+        connection.execute("SELECT 1")
+    for connection in connections:
+        connection.close()
+
+
+def warm_up(app):
+    """Run every warm-up stage; return `{stage: milliseconds}`."""
+
+    stages = [
+        ('connections', open_connections),
+        ('mappers', lambda app: configure_mappers()),
+        ('templates', compile_templates),
+    ] + [(f"cache:{name}", function) for name, function in primers]
+
+    timings = {}
+
+    with app.app_context():
+        for name, stage in stages:
+            started = time.perf_counter()
+            try:
+                stage(app)
+            except Exception:
+                app.logger.exception("Warm-up stage %s failed", name)
+            timings[name] = (time.perf_counter() - started) * 1000
+            app.logger.info("Warm-up %s: %.1f ms", name, timings[name])
+
+        db.session.remove()
+
+    app.logger.info("Warm-up done in %.1f ms", sum(timings.values()))
+    return timings
+
+
+@click.command('warm-up')
+@with_appcontext
+def warm_up_command():
+    """Run the worker warm-up stages and show how long each took."""
+
+    for name, ms in warm_up(current_app).items():
+        click.echo(f"{ms:8.1f} ms  {name}")